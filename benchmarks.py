@@ -0,0 +1,570 @@
+import argparse
+import csv
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from instrumentation import current_rss_bytes
+
+# The hyphenated script names can't be imported with a normal import statement
+reservoir = importlib.import_module('reservoir-sampling')
+
+## Synthetic CMS-shaped data
+
+# Raw column names of the Physician & Other Practitioners by Provider and Service file
+CMS_COLUMNS = ['Rndrng_NPI', 'Rndrng_Prvdr_Last_Org_Name', 'Rndrng_Prvdr_First_Name',
+               'Rndrng_Prvdr_MI', 'Rndrng_Prvdr_Crdntls', 'Rndrng_Prvdr_Ent_Cd',
+               'Rndrng_Prvdr_St1', 'Rndrng_Prvdr_St2', 'Rndrng_Prvdr_City',
+               'Rndrng_Prvdr_State_Abrvtn', 'Rndrng_Prvdr_State_FIPS', 'Rndrng_Prvdr_Zip5',
+               'Rndrng_Prvdr_RUCA', 'Rndrng_Prvdr_RUCA_Desc', 'Rndrng_Prvdr_Cntry',
+               'Rndrng_Prvdr_Type', 'Rndrng_Prvdr_Mdcr_Prtcptg_Ind', 'HCPCS_Cd', 'HCPCS_Desc',
+               'HCPCS_Drug_Ind', 'Place_Of_Srvc', 'Tot_Benes', 'Tot_Srvcs', 'Tot_Bene_Day_Srvcs',
+               'Avg_Sbmtd_Chrg', 'Avg_Mdcr_Alowd_Amt', 'Avg_Mdcr_Pymt_Amt', 'Avg_Mdcr_Stdzd_Amt']
+
+STATES = ['CA', 'TX', 'FL', 'NY', 'PA', 'IL', 'OH', 'GA', 'NC', 'MI', 'NJ', 'VA', 'WA', 'AZ',
+          'MA', 'TN', 'IN', 'MO', 'MD', 'WI', 'CO', 'MN', 'SC', 'AL', 'LA', 'KY', 'OR', 'OK',
+          'CT', 'UT', 'IA', 'NV', 'AR', 'MS', 'KS', 'NM', 'NE', 'ID', 'WV', 'HI', 'NH', 'ME',
+          'RI', 'MT', 'DE', 'SD', 'ND', 'AK', 'DC', 'VT', 'WY', 'PR']
+
+PROVIDER_TYPES = ['Internal Medicine', 'Family Practice', 'Nurse Practitioner', 'Cardiology',
+                  'Physician Assistant', 'Dermatology', 'Ophthalmology', 'Diagnostic Radiology',
+                  'Orthopedic Surgery', 'Emergency Medicine', 'Physical Therapist in Private Practice',
+                  'Clinical Laboratory', 'Anesthesiology', 'Gastroenterology', 'Urology']
+
+PROCEDURES = [('99213', 'Established patient office or other outpatient visit, 20-29 minutes', 'N'),
+              ('99214', 'Established patient office or other outpatient visit, 30-39 minutes', 'N'),
+              ('99215', 'Established patient office or other outpatient visit, 40-54 minutes', 'N'),
+              ('66984', 'Removal of cataract with insertion of prosthetic lens', 'N'),
+              ('J0178', 'Injection, aflibercept, 1 mg', 'Y'),
+              ('J2777', 'Injection, faricimab-svoa, 0.1 mg', 'Y'),
+              ('93000', 'Routine electrocardiogram (ECG) using at least 12 leads with interpretation and report', 'N'),
+              ('36415', 'Insertion of needle into vein for collection of blood sample', 'N'),
+              ('97110', 'Therapeutic exercise to develop strength, endurance, range of motion, and flexibility, each 15 minutes', 'N'),
+              ('71046', 'X-ray of chest, 2 views', 'N'),
+              ('G0439', 'Annual wellness visit, includes a personalized prevention plan of service (pps), subsequent visit', 'N'),
+              ('11721', 'Removal of tissue from 6 or more finger or toe nails', 'N')]
+
+RUCA = [('1', 'Metropolitan area core: primary flow within an urbanized area of 50,000 and greater'),
+        ('4', 'Micropolitan area core: primary flow within an Urban Cluster of 10,000 to 49,999'),
+        ('10', 'Rural areas: primary flow to a tract outside a UA or UC')]
+
+
+def write_synthetic_medicare_csv(file_name, num_rows, seed=0):
+    """
+    Writes a csv file with the same columns and value formats as the raw CMS file.
+
+    args:
+        file_name (str): path of the csv file to write
+        num_rows (int): number of data rows
+        seed: seed for the random generator so files can be reproduced
+
+    returns:
+        size of the written file in bytes
+    """
+    rng = random.Random(seed)
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(CMS_COLUMNS)
+        for i in range(num_rows):
+            # Every provider (8 consecutive rows) has one state, RUCA code and specialty
+            if i % 8 == 0:
+                state, (ruca, ruca_desc), provider_type = rng.choice(STATES), rng.choice(RUCA), rng.choice(PROVIDER_TYPES)
+            code, desc, drug = rng.choice(PROCEDURES)
+            benes = rng.randint(11, 400)
+            services = benes + rng.randint(0, 2000)
+            allowed = rng.uniform(5, 2500)
+            writer.writerow([1000000000 + i // 8, f'LAST{i // 8 % 9973}', f'FIRST{i // 8 % 7919}', 'A', 'M.D.', 'I',
+                             f'{i // 8 % 9999} MAIN ST', '', 'SPRINGFIELD', state, '17', f'{i // 8 % 99999:05d}',
+                             ruca, ruca_desc, 'US', provider_type, 'Y', code, desc, drug,
+                             rng.choice('FO'), benes, services, rng.randint(benes, services),
+                             f'{allowed * 2.5:,.2f}', f'{allowed:.2f}', f'{allowed * 0.78:.2f}', f'{allowed * 0.8:.2f}'])
+    return os.path.getsize(file_name)
+
+
+def ensure_synthetic_csv(file_name, num_rows, seed=0):
+    """
+    Reuses an existing synthetic file of the requested size, writing it only if needed.
+    """
+    if not os.path.exists(file_name):
+        start = time.perf_counter()
+        size = write_synthetic_medicare_csv(file_name, num_rows, seed)
+        print(f'Wrote {num_rows:,} rows ({size / 1e9:.2f} GB) to {file_name} in {time.perf_counter() - start:.1f}s')
+    return file_name
+
+## Benchmarks
+
+def bench_sampling(file_name, sample_size):
+    """
+    Times the per-row reservoir_sampling loop against the skip-ahead and memory-mapped
+    samplers on one file.
+    """
+    size = os.path.getsize(file_name)
+    for name, func in [('reservoir_sampling', reservoir.reservoir_sampling),
+                       ('reservoir_sampling_skip', lambda f, k: reservoir.reservoir_sampling_skip(f, k, seed=1)),
+                       ('reservoir_sampling_mmap', lambda f, k: reservoir.reservoir_sampling_mmap(f, k, seed=1))]:
+        start = time.perf_counter()
+        header, sample = func(file_name, sample_size)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<26} {elapsed:8.2f}s  {size / elapsed / 1e6:8.1f} MB/s  ({len(sample):,} rows kept)')
+
+
+def bench_parallel_sampling(file_name, sample_size, process_counts):
+    """
+    Times reservoir_sampling_parallel for each worker count to show how it scales with cores.
+    The speedup is relative to the first worker count in the list.
+    """
+    size = os.path.getsize(file_name)
+    first = None
+    for processes in process_counts:
+        start = time.perf_counter()
+        header, sample = reservoir.reservoir_sampling_parallel(file_name, sample_size, processes=processes, seed=1)
+        elapsed = time.perf_counter() - start
+        first = first or elapsed
+        print(f'reservoir_sampling_parallel processes={processes:<3} {elapsed:8.2f}s  '
+              f'{size / elapsed / 1e6:8.1f} MB/s  speedup x{first / elapsed:.1f}')
+
+
+def bench_load(row_counts, batch_size=10000, directory='.'):
+    """
+    Times loading synthetic files of each size into SQLite with pandas to_sql and with the bulk loader.
+    """
+    etl = importlib.import_module('data-etl')
+    for num_rows in row_counts:
+        file_name = ensure_synthetic_csv(os.path.join(directory, f'synthetic_medicare_data_{num_rows}.csv'), num_rows)
+        results = {}
+        for name, bulk in [('to_sql', False), ('bulk', True)]:
+            database_file = os.path.join(directory, f'bench_{name}_{num_rows}.db')
+            if os.path.exists(database_file):
+                os.remove(database_file)
+            start = time.perf_counter()
+            etl.run_etl(file_name, database_file, batch_size=batch_size, bulk=bulk)
+            results[name] = time.perf_counter() - start
+            os.remove(database_file)
+        print(f'load {num_rows:>11,} rows  to_sql {results["to_sql"]:8.2f}s  bulk {results["bulk"]:8.2f}s  '
+              f'speedup x{results["to_sql"] / results["bulk"]:.2f}')
+
+
+def bench_cleaner(num_rows, seed=0):
+    """
+    Compares calling convert_numberobj_to_float once per column with the batch cleaner
+    convert_numberobjs_to_numeric on the seven CMS number columns, timing both and
+    measuring their peak allocations with tracemalloc.
+    """
+    import pandas as pd
+    from handler_funcs import convert_numberobj_to_float, convert_numberobjs_to_numeric
+
+    etl = importlib.import_module('data-etl')
+    columns = [column for column in etl.NUMERIC_COLUMNS if column != 'sampling_weight']
+    rng = random.Random(seed)
+    formats = ['{:.2f}', '{:,.2f}', '${:,.2f}', '{:.0f}']
+    df = pd.DataFrame({column: [rng.choice(formats).format(rng.uniform(0, 5000)) if rng.random() > 0.01 else ''
+                                for _ in range(num_rows)] for column in columns})
+
+    def per_column(frame):
+        for column in columns:
+            frame = convert_numberobj_to_float(frame, column)
+        return frame
+
+    def batch(frame):
+        return convert_numberobjs_to_numeric(frame, columns)[0]
+
+    for name, func in [('convert_numberobj_to_float', per_column), ('convert_numberobjs_to_numeric', batch)]:
+        frame = df.copy()
+        tracemalloc.start()
+        start = time.perf_counter()
+        frame = func(frame)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{name:<31} {num_rows:>10,} rows  {elapsed:8.3f}s  peak alloc {peak / 2**20:8.1f} MB  '
+              f'result {frame[columns].memory_usage(index=False).sum() / 2**20:6.1f} MB')
+
+
+def _cold_and_warm(func, repeats):
+    # First call, then the best of repeats calls after it
+    start = time.perf_counter()
+    func()
+    cold = time.perf_counter() - start
+    warm = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        warm.append(time.perf_counter() - start)
+    return cold, min(warm)
+
+
+def bench_cache(num_rows, repeats=5, directory='.'):
+    """
+    Times every shipped query against the SQLite database and against its Parquet cache.
+
+    Cold is the first run on a new connection (SQLite) or the first read of the cache in
+    this process, warm is the best of the next repeats runs. The operating system's page
+    cache isn't dropped, so cold doesn't include reading the files from disk.
+    """
+    import sqlite3
+    import pandas as pd
+    import columnar_cache
+    from sql_queries import SHIPPED_QUERIES, bind_params
+
+    etl = importlib.import_module('data-etl')
+    file_name = ensure_synthetic_csv(os.path.join(directory, f'synthetic_medicare_data_{num_rows}.csv'), num_rows)
+    database_file = os.path.join(directory, f'bench_cache_{num_rows}.db')
+    if not os.path.exists(database_file):
+        etl.run_etl(file_name, database_file)
+    cache_dir = columnar_cache.cache_path(database_file)
+
+    for name, (query, params) in SHIPPED_QUERIES.items():
+        sql_connect = sqlite3.connect(database_file)
+        sqlite_cold, sqlite_warm = _cold_and_warm(lambda: pd.read_sql_query(query, sql_connect, params=bind_params(params)),
+                                                 repeats)
+        sql_connect.close()
+        cache_cold, cache_warm = _cold_and_warm(lambda: columnar_cache.CACHE_QUERIES[name](cache_dir, **params), repeats)
+        print(f'{name:<38} sqlite cold {sqlite_cold * 1000:8.1f} ms  warm {sqlite_warm * 1000:8.1f} ms  '
+              f'parquet cold {cache_cold * 1000:8.1f} ms  warm {cache_warm * 1000:8.1f} ms')
+
+
+def bench_startup(database_file, modules=('data_visualization', 'established_patients', 'pie_chart'), target=0.1):
+    """
+    Times importing each analysis module and running a first query in a new Python process.
+
+    The first query time runs from after the imports to the first result, including
+    opening the QueryEngine and its connection, and is compared with target seconds.
+    Also checks that no plotting library was loaded, since nothing was drawn.
+    """
+    import subprocess
+
+    script = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+from query_engine import QueryEngine
+imported = time.perf_counter()
+with QueryEngine({database_file!r}) as engine:
+    engine.run('top_procedures_by_total_cost', limit=10)
+done = time.perf_counter()
+print(json.dumps({{'imports': imported - start, 'first_query': done - imported,
+                  'plotting': sorted(name for name in ('matplotlib', 'seaborn') if name in sys.modules)}}))
+"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script.format(module=module, database_file=os.path.abspath(database_file))],
+                                cwd=here, capture_output=True, text=True, check=True).stdout
+        total = time.perf_counter() - start
+        times = json.loads(output.splitlines()[-1])
+        verdict = 'ok' if times['first_query'] < target else f'over the {target * 1000:.0f} ms target'
+        print(f'{module:<22} process {total * 1000:7.1f} ms  imports {times["imports"] * 1000:7.1f} ms  '
+              f'first query {times["first_query"] * 1000:6.1f} ms ({verdict})  '
+              f'plotting libraries loaded: {", ".join(times["plotting"]) or "none"}')
+
+
+def bench_stream(file_name, sample_size, directory='.'):
+    """
+    Times answering the top procedures question with one streaming pass over the whole
+    file (stream_aggregate.py) against sampling it, loading the sample and querying it.
+    """
+    import stream_aggregate
+    from query_engine import QueryEngine
+
+    etl = importlib.import_module('data-etl')
+    size = os.path.getsize(file_name)
+    start = time.perf_counter()
+    aggregator = stream_aggregate.aggregate_file(file_name)
+    aggregator.top_procedures_by_total_cost(10)
+    stream = time.perf_counter() - start
+    print(f'stream_aggregate          {stream:8.2f}s  {size / stream / 1e6:8.1f} MB/s  '
+          f'({aggregator.rows:,} rows, {len(aggregator.keys):,} groups, exact)')
+
+    sample_file = os.path.join(directory, 'bench_stream_sample.csv')
+    database_file = os.path.join(directory, 'bench_stream_sample.db')
+    if os.path.exists(database_file):
+        os.remove(database_file)
+    start = time.perf_counter()
+    header, sample = reservoir.reservoir_sampling_skip(file_name, sample_size, seed=1)
+    with open(sample_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(sample)
+    etl.run_etl(sample_file, database_file)
+    with QueryEngine(database_file) as engine:
+        engine.run('top_procedures_by_total_cost', limit=10)
+    path = time.perf_counter() - start
+    print(f'sample + ETL + query      {path:8.2f}s  {size / path / 1e6:8.1f} MB/s  ({len(sample):,} sampled rows)  '
+          f'stream speedup x{path / stream:.2f}')
+    os.remove(sample_file)
+
+
+def _scan_csv_reader(file_name, columns, numeric):
+    # The per-row way: csv.reader, keeping the projected fields and converting the numbers
+    with open(file_name, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        indexes = [(header.index(column), column in numeric) for column in columns]
+        rows = 0
+        for row in reader:
+            [float(row[index].replace('$', '').replace(',', '') or 'nan') if number else row[index]
+             for index, number in indexes]
+            rows += 1
+    return rows
+
+
+def _scan_read_csv(file_name, columns, numeric):
+    # pandas' C parser, reading only the projected columns
+    import pandas as pd
+    rows = 0
+    for chunk in pd.read_csv(file_name, usecols=columns, chunksize=200000):
+        rows += len(chunk)
+    return rows
+
+
+def _scan_mmap(file_name, columns, numeric):
+    from mmap_scan import CSVScanner
+    with CSVScanner(file_name) as scanner:
+        return sum(len(block[columns[0]]) for block in scanner.scan(columns, numeric))
+
+
+def bench_scan(file_name, sample_size):
+    """
+    Times reading projected columns of the raw file with csv.reader, pd.read_csv and the
+    memory-mapped scanner (mmap_scan.py) in GB/s, then the samplers, stream_aggregate and
+    the ETL's read stage with each reader.
+    """
+    import stream_aggregate
+
+    etl = importlib.import_module('data-etl')
+    size = os.path.getsize(file_name)
+
+    def report(name, func):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        print(f'{name:<44} {elapsed:8.2f}s  {size / elapsed / 1e9:6.3f} GB/s')
+        return result
+
+    amounts = ['Tot_Srvcs', 'Avg_Mdcr_Alowd_Amt']
+    projections = {'amounts': (amounts, amounts),
+                   'amounts + keys': (list(stream_aggregate.RAW_COLUMNS), amounts)}
+    for label, (columns, numeric) in projections.items():
+        for name, scan in [('csv.reader', _scan_csv_reader), ('pd.read_csv', _scan_read_csv), ('mmap_scan', _scan_mmap)]:
+            report(f'{name} ({label})', lambda: scan(file_name, columns, numeric))
+
+    for name in ['reservoir_sampling_skip', 'reservoir_sampling_mmap']:
+        report(name, lambda: getattr(reservoir, name)(file_name, sample_size, seed=1))
+    for reader in ['pandas', 'mmap']:
+        report(f'stream_aggregate reader={reader}', lambda: stream_aggregate.aggregate_file(file_name, reader=reader))
+    for reader in ['pandas', 'mmap']:
+        report(f'ETL read stage reader={reader}',
+               lambda: sum(len(chunk) for chunk in etl.READERS[reader](file_name, 100000)))
+
+
+## Benchmark suite: every stage of the pipeline at several sizes, saved as json so a run
+## can be compared with an earlier one
+
+def _measure(func, interval=0.005):
+    # Runs func and returns (result, seconds, peak RSS in bytes while it ran), the RSS
+    # polled from a background thread since the stages allocate in C as well as Python
+    peak = [current_rss_bytes()]
+    done = threading.Event()
+
+    def poll():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], current_rss_bytes())
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+    finally:
+        seconds = time.perf_counter() - start
+        done.set()
+        thread.join()
+    return result, seconds, max(peak[0], current_rss_bytes())
+
+
+def _record(results, stage, name, rows, seconds, peak_rss=None, size=None):
+    # One result of the suite, printed as it's added
+    record = {'stage': stage, 'name': name, 'rows': rows, 'seconds': seconds,
+              'rows_per_sec': rows / seconds if seconds > 0 else None}
+    if size is not None:
+        record['mb_per_sec'] = size / seconds / 1e6 if seconds > 0 else None
+    if peak_rss is not None:
+        record['peak_rss_mb'] = peak_rss / 2**20
+    results.append(record)
+    line = f'{stage:<8} {name:<45} {rows:>11,} rows  {seconds:9.3f}s'
+    if record['rows_per_sec']:
+        line += f'  {record["rows_per_sec"]:>13,.0f} rows/sec'
+    if record.get('mb_per_sec'):
+        line += f'  {record["mb_per_sec"]:8.1f} MB/s'
+    if peak_rss is not None:
+        line += f'  peak RSS {record["peak_rss_mb"]:,.0f} MB'
+    print(line)
+
+
+def bench_suite(row_counts, sample_size=50000, repeats=3, directory='.', chart_formats=('png',)):
+    """
+    Times sampling, the ETL, every shipped query and every chart on synthetic files of each size
+
+    For each size: reservoir_sampling, reservoir_sampling_skip and reservoir_sampling_mmap on the csv, run_etl
+    into a new database (in total and per ETL stage), each query in
+    sql_queries.SHIPPED_QUERIES on the SQLite and Parquet backends (best of repeats,
+    without the result cache) and drawing and saving each chart of render_charts.
+
+    args:
+        row_counts (list): sizes of the synthetic csv files
+        sample_size (int): rows kept by the samplers
+        repeats (int): runs per query, the fastest is kept
+        directory (str): directory for the csv files, databases and charts
+        chart_formats (tuple): file formats every chart is saved in
+
+    returns:
+        dict with the machine description ('machine') and a list of results ('results'),
+        each with stage, name, rows (of the synthetic file), seconds, rows_per_sec and
+        where measured mb_per_sec and peak_rss_mb
+    """
+    import columnar_cache
+    import render_charts
+    from query_engine import QueryEngine
+    from sql_queries import SHIPPED_QUERIES
+
+    etl = importlib.import_module('data-etl')
+    results = []
+    for num_rows in row_counts:
+        file_name = ensure_synthetic_csv(os.path.join(directory, f'synthetic_medicare_data_{num_rows}.csv'), num_rows)
+        size = os.path.getsize(file_name)
+
+        for name, func in [('reservoir_sampling', lambda: reservoir.reservoir_sampling(file_name, sample_size)),
+                           ('reservoir_sampling_skip', lambda: reservoir.reservoir_sampling_skip(file_name, sample_size, seed=1)),
+                           ('reservoir_sampling_mmap', lambda: reservoir.reservoir_sampling_mmap(file_name, sample_size, seed=1))]:
+            _, seconds, peak = _measure(func)
+            _record(results, 'sampling', name, num_rows, seconds, peak, size)
+
+        database_file = os.path.join(directory, f'bench_suite_{num_rows}.db')
+        if os.path.exists(database_file):
+            os.remove(database_file)
+        columnar_cache.clear_cache(columnar_cache.cache_path(database_file))
+        report, seconds, peak = _measure(lambda: etl.run_etl(file_name, database_file))
+        _record(results, 'etl', 'run_etl', num_rows, seconds, peak, size)
+        previous = 0.0
+        for stage, stats in report.items():
+            # Stage times include the stages before them, as in print_stage_report
+            _record(results, 'etl', stage, stats['rows'], stats['seconds'] - previous, stats['peak_rss'])
+            previous = stats['seconds']
+
+        with QueryEngine(database_file, result_cache=False) as engine:
+            for backend in engine.PREFERENCE:
+                # The Parquet cache is only written when pyarrow is installed
+                if not engine.backends[backend].available():
+                    print(f"{backend} backend not available, skipping its queries")
+                    continue
+                engine.backend = backend
+                for name, (_, params) in SHIPPED_QUERIES.items():
+                    best = min(_measure(lambda: engine.run(name, **params))[1] for _ in range(repeats))
+                    _record(results, 'query', f'{backend}:{name}', num_rows, best)
+            engine.backend = 'auto'
+            jobs = render_charts.chart_jobs(engine)
+
+        out_dir = os.path.join(directory, f'bench_charts_{num_rows}')
+        os.makedirs(out_dir, exist_ok=True)
+        for job in jobs:
+            _, seconds, peak = _measure(lambda: render_charts._draw(job, out_dir, chart_formats))
+            _record(results, 'render', job[0], num_rows, seconds, peak)
+        shutil.rmtree(out_dir)
+
+    machine = {'python': platform.python_version(), 'platform': platform.platform(),
+               'processor': platform.processor(), 'cpus': os.cpu_count(),
+               'argv': sys.argv, 'time': datetime.now().isoformat(timespec='seconds')}
+    return {'machine': machine, 'results': results}
+
+
+def compare_results(current, baseline, tolerance=0.2, min_seconds=0.01):
+    """
+    Compares the results of bench_suite with a baseline from an earlier run
+
+    Results are matched by stage, name and rows. One is a regression when it took more
+    than (1 + tolerance) times as long as in the baseline and more than min_seconds, as
+    the shortest timings are mostly noise.
+
+    returns:
+        list of (stage, name, rows, baseline seconds, current seconds) of the regressions
+    """
+    before = {(record['stage'], record['name'], record['rows']): record['seconds'] for record in baseline['results']}
+    regressions = []
+    for record in current['results']:
+        key = (record['stage'], record['name'], record['rows'])
+        if key not in before or not before[key]:
+            continue
+        ratio = record['seconds'] / before[key]
+        flag = ''
+        if ratio > 1 + tolerance and record['seconds'] > min_seconds:
+            regressions.append((*key, before[key], record['seconds']))
+            flag = '  REGRESSION'
+        print(f'{key[0]:<8} {key[1]:<45} {key[2]:>11,} rows  {before[key]:9.3f}s -> {record["seconds"]:9.3f}s  '
+              f'x{ratio:.2f}{flag}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the medicare data pipeline')
+    parser.add_argument('--only', nargs='+', default=['sampling', 'parallel', 'load', 'cleaner', 'cache'],
+                        choices=['sampling', 'parallel', 'load', 'cleaner', 'cache', 'suite', 'startup', 'stream',
+                                 'scan'],
+                        help='benchmarks to run')
+    parser.add_argument('--rows', type=int, default=10_000_000, help='rows in the synthetic csv')
+    parser.add_argument('--sample-size', type=int, default=50000)
+    parser.add_argument('--file', default='synthetic_medicare_data.csv')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='worker counts for the parallel sampler')
+    parser.add_argument('--load-rows', type=int, nargs='+', default=[50000, 1000000, 10000000],
+                        help='synthetic file sizes for the load benchmark')
+    parser.add_argument('--batch-size', type=int, default=10000, help='rows per INSERT batch')
+    parser.add_argument('--cleaner-rows', type=int, default=1000000, help='rows for the cleaner microbenchmark')
+    parser.add_argument('--cache-rows', type=int, default=1000000, help='rows loaded for the SQLite vs Parquet query benchmark')
+    parser.add_argument('--repeats', type=int, default=5, help='warm runs per query')
+    parser.add_argument('--suite-rows', type=int, nargs='+', default=[50000, 1000000, 10000000],
+                        help='synthetic file sizes for the benchmark suite')
+    parser.add_argument('--database', default='medicare_database.db', help='database for the startup benchmark')
+    parser.add_argument('--output', default='benchmark_results.json', help='json file for the suite results')
+    parser.add_argument('--baseline', help='suite results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a regression (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    if 'sampling' in args.only or 'parallel' in args.only:
+        ensure_synthetic_csv(args.file, args.rows)
+    if 'sampling' in args.only:
+        bench_sampling(args.file, args.sample_size)
+    if 'parallel' in args.only:
+        bench_parallel_sampling(args.file, args.sample_size, args.processes)
+    if 'load' in args.only:
+        bench_load(args.load_rows, args.batch_size)
+    if 'cleaner' in args.only:
+        bench_cleaner(args.cleaner_rows)
+    if 'cache' in args.only:
+        bench_cache(args.cache_rows, args.repeats)
+    if 'stream' in args.only:
+        ensure_synthetic_csv(args.file, args.rows)
+        bench_stream(args.file, args.sample_size)
+    if 'scan' in args.only:
+        ensure_synthetic_csv(args.file, args.rows)
+        bench_scan(args.file, args.sample_size)
+    if 'startup' in args.only:
+        bench_startup(args.database)
+    if 'suite' in args.only:
+        suite = bench_suite(args.suite_rows, args.sample_size, args.repeats)
+        with open(args.output, 'w') as file:
+            json.dump(suite, file, indent=1)
+        print(f'Wrote {len(suite["results"])} results to {args.output}')
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = compare_results(suite, json.load(file), args.tolerance)
+            print(f'{len(regressions)} regressions over {args.tolerance:.0%} against {args.baseline}')
+            if regressions:
+                sys.exit(1)
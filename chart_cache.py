@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import matplotlib
+import pandas as pd
+from charts import STYLE_VERSION
+
+## Content-addressed store of rendered chart files: a chart is saved under a hash of
+## the data it was drawn from, how it was drawn and the chart style, so a batch render
+## only redraws the charts whose aggregates (or drawing code) changed since the last run
+
+class ChartCache:
+    """
+    Directory of rendered charts named by the hash of their inputs
+
+    Next to every file is a small json file with the seconds it took to render, so
+    the time saved by the charts that didn't need drawing can be reported.
+
+    args:
+        cache_dir (str): directory for the cached files, created if needed
+
+    The rendered, skipped and seconds_saved counters (see stats) show how much work
+    the cache saved.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.skipped = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def key(df, draw, kwargs, file_format):
+        """
+        Returns the hash of everything a chart file depends on: the values, columns and
+        types of the query result, the draw function and its arguments, the file format,
+        charts.STYLE_VERSION and the matplotlib version
+        """
+        digest = hashlib.sha256()
+        digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        description = [list(map(str, df.columns)), list(map(str, df.dtypes)),
+                       f'{draw.__module__}.{draw.__qualname__}', kwargs, file_format,
+                       STYLE_VERSION, matplotlib.__version__]
+        digest.update(json.dumps(description, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _path(self, key, file_format):
+        return os.path.join(self.cache_dir, f'{key}.{file_format}')
+
+    def fetch(self, key, file_format, path):
+        """
+        Copies the cached chart for key to path and returns True, or returns False if it isn't cached
+        """
+        cached = self._path(key, file_format)
+        try:
+            shutil.copyfile(cached, path)
+            with open(f'{cached}.json') as file:
+                seconds = json.load(file)['seconds']
+        except (OSError, ValueError, KeyError):
+            return False
+        with self._lock:
+            self.skipped += 1
+            self.seconds_saved += seconds
+        return True
+
+    def store(self, key, file_format, path, seconds):
+        """
+        Adds the chart just rendered to path to the cache, with the seconds it took
+        """
+        cached = self._path(key, file_format)
+        # Written to a temporary name first so a reader never sees half a file
+        shutil.copyfile(path, f'{cached}.{os.getpid()}.tmp')
+        os.replace(f'{cached}.{os.getpid()}.tmp', cached)
+        with open(f'{cached}.json', 'w') as file:
+            json.dump({'seconds': seconds}, file)
+        with self._lock:
+            self.rendered += 1
+
+    def clear(self):
+        """
+        Removes every cached chart
+        """
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stats(self):
+        """
+        Returns the number of chart files rendered and skipped, and the render seconds saved
+        """
+        with self._lock:
+            return {'rendered': self.rendered, 'skipped': self.skipped, 'seconds_saved': self.seconds_saved}
@@ -0,0 +1,189 @@
+import functools
+import matplotlib
+import matplotlib.lines as mlines
+import pandas as pd
+
+## Drawing code for every chart, kept apart from the queries: each function draws a
+## query result onto a matplotlib Figure it is given. The scripts pass a pyplot figure
+## and show it; render_charts.py reuses one off-screen figure per worker process.
+## seaborn is imported by the functions that use it, since it takes longer to import
+## than all the rest
+
+# Version of the chart style, part of the key of every chart in chart_cache.py. Bump
+# it whenever the drawing code changes, so the cached charts are drawn again
+STYLE_VERSION = 3
+
+
+def _label_colors(labels):
+    # One color of the tab20 colormap for each unique label, in order of appearance:
+    # returns the unique labels and an RGBA row for every value
+    codes, unique = pd.factorize(labels)
+    return unique, matplotlib.colormaps['tab20'].resampled(len(unique))(codes)
+
+
+def _legend_handle(color):
+    # Fixed size marker, so the legend doesn't depend on the data coordinates
+    return mlines.Line2D([], [], marker='o', linestyle='', markersize=10, color=color, alpha=0.5)
+
+
+def _no_data_if_empty(draw):
+    # An empty query result is drawn as a "No data" note instead of raising, so a
+    # chart without rows doesn't stop the whole batch
+    @functools.wraps(draw)
+    def draw_or_note(fig, df, *args, **kwargs):
+        if df.empty:
+            ax = fig.add_subplot()
+            ax.text(0.5, 0.5, 'No data', ha='center', va='center', fontsize=16, transform=ax.transAxes)
+            ax.set_axis_off()
+            return fig
+        return draw(fig, df, *args, **kwargs)
+    return draw_or_note
+
+
+@_no_data_if_empty
+def draw_top_procedures_by_medicare_cost(fig, df, limit):
+    """
+    Bar chart of the top_procedures_by_medicare_cost query
+    """
+    import seaborn as sns
+
+    fig.set_size_inches(12, 6)
+    ax = fig.add_subplot()
+    sns.barplot(x='average_cost', y='hcpcs_description', data=df, ax=ax)
+    ax.set_xlabel('Average Medicare Allowed Amount')
+    ax.set_ylabel('Procedure')
+    ax.set_title(f'Top {limit} Most Expensive Procedures')
+    return fig
+
+
+@_no_data_if_empty
+def draw_top_procedures_by_total_cost(fig, df, legend_limit=20):
+    """
+    Scatter of cost vs. volume for the top_procedures_by_total_cost query, one color per procedure
+
+    All the bubbles are one scatter collection, so hundreds of procedures draw about
+    as fast as ten. The legend lists the first legend_limit procedures
+    """
+    df = df.reset_index(drop=True)
+    fig.set_size_inches(12, 8)
+    ax = fig.add_subplot()
+
+    # Assign colors to unique hcpcs_description categories
+    unique_desc, colors = _label_colors(df['hcpcs_description'])
+
+    #Plot bubbles
+    ax.scatter(x=df['average_cost'], y=df['total_services'], s=df['total_spending']/10000, alpha=0.5, c=colors)
+
+    ax.set_xlabel('Average Medicare Allowed Amount')
+    ax.set_ylabel('Total Number of Services')
+    ax.set_title('Procedure Cost vs. Volume (Bubble Size = Total Spending)')
+    ax.grid(True)
+
+    # Add a legend, from the first row of each procedure
+    first = df.drop_duplicates('hcpcs_description').head(legend_limit)
+    ax.legend(handles=[_legend_handle(color) for color in colors[first.index.to_numpy()]],
+              labels=[f"{desc} (${total_spending:,.0f})"
+                      for desc, total_spending in zip(first['hcpcs_description'], first['total_spending'])],
+              frameon=False, labelspacing=1, bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    fig.tight_layout(rect=[0, 0, 0.85, 1])
+    return fig
+
+
+@_no_data_if_empty
+def draw_top_procedures_by_total_cost_bubble(fig, df, legend_limit=20):
+    """
+    Bubble chart of the top_procedures_by_total_cost query, with the procedures numbered by rank
+
+    All the bubbles are one scatter collection; the rank numbers and the legend are
+    drawn for the first legend_limit ranks only, so the chart stays readable (and
+    quick to draw) with hundreds of procedures
+    """
+    df = df.reset_index(drop=True)
+
+   # Calculate the rank based on total_spending
+    ranks = df['total_spending'].rank(ascending=False, method='dense').astype(int).to_numpy()
+
+    # Generate the figure
+    fig.set_size_inches(12, 8)
+    ax = fig.add_subplot()
+
+    # Assign colors to unique hcpcs_description categories
+    unique_desc, colors = _label_colors(df['hcpcs_description'])
+
+    # Plot every procedure bubble at once
+    ax.scatter(x=df['average_cost'], y=df['total_services'],
+               s=df['total_spending']/10000, # Bubble scale
+               alpha=0.5, c=colors)
+
+    # Add the rank number inside the top bubbles
+    labeled = (ranks <= legend_limit).nonzero()[0]
+    for x, y, rank in zip(df['average_cost'].to_numpy()[labeled], df['total_services'].to_numpy()[labeled], ranks[labeled]):
+        ax.text(x=x, y=y, s=str(rank), ha='center', va='center', fontsize=9, color='black')
+
+    # Add Labels and title
+    ax.set_xlabel('Average Medicare Allowed Amount($)')
+    ax.set_ylabel('Total Number of Services')
+    ax.set_title('Procedure Cost vs. Volume (Bubble Size = Total Spending)')
+    ax.grid(True)
+
+    # Custom legend, from the first row of each procedure
+    first = df.drop_duplicates('hcpcs_description').index.to_numpy()
+    first = first[ranks[first] <= legend_limit]
+    ax.legend(handles=[_legend_handle(color) for color in colors[first]],
+              labels=[f"{rank}. {desc} (${total_spending:,.0f})" for desc, rank, total_spending in
+                      zip(df['hcpcs_description'].to_numpy()[first], ranks[first], df['total_spending'].to_numpy()[first])],
+              loc='upper left',
+              bbox_to_anchor=(1.05, 1),
+              ncol=1, #Column label
+              fontsize='medium',
+              title="Procedure Ranks and Total Spending", #Label Title
+              borderpad=1,  #Padding size in pixel
+              handlelength=3, #Line up the right hand side
+              labelspacing=1.5 #Spread out the spacing
+              )
+
+    # Tweak layout
+    fig.tight_layout(rect=[0, 0, 0.75, 1]) #Make space for graph again
+    return fig
+
+
+@_no_data_if_empty
+def draw_top_procedures_by_provider(fig, df):
+    """
+    Bar chart of the top_procedures_by_provider query
+    """
+    fig.set_size_inches(14, 8)
+    ax = fig.add_subplot()
+    ax.bar(df['provider_type'], df['total_services'], color='skyblue')
+    ax.set_xlabel("Medical Providers", size=14)
+    ax.set_ylabel("Number of Medical Procedures", size=14)
+    ax.set_title('Medical Provider vs Procedures', size=16)
+    ax.grid(True)
+    return fig
+
+
+@_no_data_if_empty
+def draw_cost_by_speciality_and_state(fig, df):
+    """
+    Bar chart of the total spending of a specialty in each state (analyze_cost_by_speciality_and_state query)
+    """
+    import seaborn as sns
+
+    fig.set_size_inches(6.4, 4.8)
+    ax = fig.add_subplot()
+    sns.barplot(x=df["provider_type"], y=df["total_spending"], hue=df["state"], ax=ax)
+    return fig
+
+
+@_no_data_if_empty
+def draw_state_pie(fig, df, title):
+    """
+    Pie chart of the share of each state in df (state and total_services columns)
+    """
+    fig.set_size_inches(8, 8)
+    ax = fig.add_subplot()
+    ax.pie(df['total_services'], labels=df['state'], autopct='%1.1f%%', startangle=140)
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
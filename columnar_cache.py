@@ -0,0 +1,268 @@
+import importlib.util
+import os
+import re
+import shutil
+import pandas as pd
+
+# pyarrow is optional, and only imported when the cache is used (see _import_arrow):
+# pyarrow.dataset alone takes about a third of a second to import, which every
+# query on SQLite would otherwise pay
+pa = ds = pq = None
+
+## Columnar cache of the cleaned rows: Parquet files partitioned by state, written by
+## the ETL next to the SQLite database, so an analysis that needs a few columns (or a
+## few states) reads only those instead of whole rows
+
+# Directory partitioning the cache by state (provider_state_abbreviation=CA/...)
+PARTITION_COLUMN = 'provider_state_abbreviation'
+
+# Codec for the Parquet column chunks
+COMPRESSION = 'zstd'
+
+
+def available():
+    """
+    Returns whether pyarrow is installed, without importing it
+    """
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _import_arrow():
+    global pa, ds, pq
+    if pq is None:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+
+def cache_path(database_file):
+    """
+    Returns the cache directory that belongs to a SQLite database file (medicare_database.db -> medicare_database.parquet)
+    """
+    return os.path.splitext(database_file)[0] + '.parquet'
+
+
+def _dataset(cache_dir):
+    # States are read back as plain strings, a missing state as null
+    _import_arrow()
+    partitioning = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive')
+    return ds.dataset(cache_dir, format='parquet', partitioning=partitioning)
+
+
+def _arrow_table(chunk, column_dtypes):
+    # Categorical and text columns are stored as dictionary-encoded strings and every
+    # number column gets the arrow type of its COLUMN_DTYPES entry (not the type pandas
+    # inferred for the chunk), so every chunk has the same schema
+    arrays = {}
+    for column in chunk.columns:
+        dtype = column_dtypes.get(column)
+        values = chunk[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # The categorical codes already are the dictionary indices
+            codes = values.cat.codes.to_numpy().astype('int32')
+            arrays[column] = pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                                            pa.array(values.cat.categories.astype(str), type=pa.string()))
+        elif dtype is None or dtype == 'category':
+            arrays[column] = pa.array(values.astype('string'), type=pa.string()).dictionary_encode()
+        else:
+            arrays[column] = pa.array(values.to_numpy(), type=pa.from_numpy_dtype(dtype))
+    return pa.table(arrays)
+
+
+def _next_part(cache_dir):
+    # Parts are numbered per run, so an incremental load adds files instead of rewriting them
+    parts = [int(match.group(1)) for _, _, files in os.walk(cache_dir) for name in files
+             if (match := re.fullmatch(r'part-(\d+)\.parquet', name))]
+    return max(parts, default=-1) + 1
+
+
+def cache_chunks(chunks, cache_dir, column_dtypes, row_group_size=32768):
+    """
+    Writes every chunk to the Parquet cache in cache_dir and passes it on unchanged
+
+    Each state gets one file per run (provider_state_abbreviation=<state>/part-<n>.parquet).
+    A state's rows are buffered across chunks and written as row groups of row_group_size
+    rows, so small states don't end up as many tiny row groups.
+
+    args:
+        chunks: cleaned (and compacted) dataframe chunks
+        cache_dir (str): cache directory, added to if it already exists
+        column_dtypes (dict): column -> dtype from compact_chunks (columns not in it are text)
+        row_group_size (int): number of rows per row group
+    """
+    _import_arrow()
+    part = _next_part(cache_dir)
+    writers = {}
+    buffers = {}
+
+    def write(state):
+        table = pa.concat_tables(buffers.pop(state))
+        if state not in writers:
+            directory = os.path.join(cache_dir, f'{PARTITION_COLUMN}={state}')
+            os.makedirs(directory, exist_ok=True)
+            writers[state] = pq.ParquetWriter(os.path.join(directory, f'part-{part}.parquet'),
+                                              table.schema, compression=COMPRESSION)
+        writers[state].write_table(table, row_group_size=row_group_size)
+
+    try:
+        for chunk in chunks:
+            # Sorted by state, every state's rows are one slice of the table
+            states = chunk[PARTITION_COLUMN].astype(object).fillna('__HIVE_DEFAULT_PARTITION__').to_numpy()
+            order = states.argsort(kind='stable')
+            states = states[order]
+            table = _arrow_table(chunk.drop(columns=PARTITION_COLUMN), column_dtypes).take(pa.array(order))
+            bounds = (states[1:] != states[:-1]).nonzero()[0] + 1
+            for start, end in zip([0, *bounds], [*bounds, len(states)]):
+                state = states[start]
+                buffers.setdefault(state, []).append(table.slice(start, end - start))
+                if sum(len(rows) for rows in buffers[state]) >= row_group_size:
+                    write(state)
+            yield chunk
+        for state in list(buffers):
+            write(state)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def clear_cache(cache_dir):
+    """
+    Removes the cache directory, if there is one
+    """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+def read_cache(cache_dir, columns, filters=None):
+    """
+    Reads columns of the cached rows into a dataframe
+
+    Only the requested columns are read from disk. filters are pushed down to the
+    scan: a filter on provider_state_abbreviation skips the other states' directories,
+    and row groups whose min/max statistics can't match are skipped.
+
+    args:
+        cache_dir (str): cache directory written by cache_chunks
+        columns (list): columns to read
+        filters: list of (column, op, value) tuples that must all hold (as in
+            pandas.read_parquet, e.g. [('provider_type', '==', 'Cardiology')]), or None
+
+    returns:
+        dataframe with the columns, text columns as categoricals
+    """
+    _import_arrow()
+    expression = pq.filters_to_expression(filters) if filters else None
+    return _dataset(cache_dir).to_table(columns=columns, filter=expression).to_pandas()
+
+
+## The shipped queries (see sql_queries.py) computed from the cache, returning the same
+## columns as the SQL versions so the charts can use either
+
+def _like_to_regex(pattern):
+    # SQLite LIKE: % is any run of characters, _ any one character, ASCII case-insensitive
+    parts = ['.*' if char == '%' else '.' if char == '_' else re.escape(char) for char in pattern]
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+def _procedures_matching(cache_dir, pattern):
+    # Matches the distinct descriptions once, not every row, like the hcpcs_search index
+    columns = ['hcpcs_code', 'hcpcs_description']
+    procedures = _dataset(cache_dir).to_table(columns=columns).group_by(columns).aggregate([]).to_pandas()
+    regex = _like_to_regex(pattern)
+    matches = procedures['hcpcs_description'].astype(str).map(lambda text: bool(regex.fullmatch(text)))
+    return procedures.loc[matches.to_numpy()].astype(str).reset_index(drop=True)
+
+
+def _read_matching(cache_dir, columns, pattern, filters=()):
+    # Rows whose own description matches pattern. The matching codes are pushed down to
+    # the reader, then rows of those codes with another description are dropped
+    procedures = _procedures_matching(cache_dir, pattern)
+    read = columns if 'hcpcs_description' in columns else columns + ['hcpcs_description']
+    df = read_cache(cache_dir, read, [('hcpcs_code', 'in', procedures['hcpcs_code'].unique().tolist()), *filters])
+    df = df[df['hcpcs_description'].astype(str).isin(procedures['hcpcs_description'])]
+    return df[columns]
+
+
+def _cost_aggregates(df, keys):
+    grouped = df.groupby(keys, observed=True, sort=False)
+    return grouped.agg(average_cost=('average_medicare_allowed_amount', 'mean'),
+                       total_services=('number_of_services', 'sum')).reset_index()
+
+
+def top_procedures_by_medicare_cost(cache_dir, limit):
+    df = read_cache(cache_dir, ['hcpcs_description', 'average_medicare_allowed_amount'])
+    df = df.groupby('hcpcs_description', observed=True)['average_medicare_allowed_amount'].mean()
+    df = df.rename('average_cost').reset_index()
+    return df.sort_values('average_cost', ascending=False).head(limit).reset_index(drop=True)
+
+
+def top_procedures_by_total_cost(cache_dir, limit):
+    df = read_cache(cache_dir, ['hcpcs_description', 'average_medicare_allowed_amount', 'number_of_services'])
+    df = _cost_aggregates(df, ['hcpcs_description'])
+    df['total_spending'] = df['average_cost'] * df['total_services']
+    return df.sort_values('total_spending', ascending=False).head(limit).reset_index(drop=True)
+
+
+def top_procedures_by_provider(cache_dir, pattern, limit):
+    df = _read_matching(cache_dir, ['provider_type', 'hcpcs_description', 'average_medicare_allowed_amount', 'number_of_services'],
+                        pattern)
+    df = _cost_aggregates(df, ['provider_type', 'hcpcs_description'])
+    df = df[['provider_type', 'hcpcs_description', 'total_services', 'average_cost']]
+    return df.sort_values('total_services', ascending=False).head(limit).reset_index(drop=True)
+
+
+def cost_by_specialty_and_state(cache_dir, specialty):
+    df = read_cache(cache_dir, ['provider_type', PARTITION_COLUMN, 'average_medicare_allowed_amount', 'number_of_services'],
+                    [('provider_type', '==', specialty)])
+    df = _cost_aggregates(df.rename(columns={PARTITION_COLUMN: 'state'}), ['provider_type', 'state'])
+    df['total_spending'] = df['average_cost'] * df['total_services']
+    return df.sort_values('total_spending', ascending=False).reset_index(drop=True)
+
+
+def state_services_for_provider_and_procedure(cache_dir, pattern, provider):
+    df = _read_matching(cache_dir, [PARTITION_COLUMN, 'number_of_services'], pattern, [('provider_type', '==', provider)])
+    df = df.groupby(PARTITION_COLUMN, sort=False)['number_of_services'].sum()
+    df = df.rename('total_services').rename_axis('state').reset_index()
+    return df.sort_values('total_services', ascending=False).reset_index(drop=True)
+
+
+def state_services_for_procedure(cache_dir, pattern):
+    df = _read_matching(cache_dir, [PARTITION_COLUMN, 'number_of_services'], pattern)
+    df = df.groupby(PARTITION_COLUMN, sort=False)['number_of_services'].sum()
+    df = df.rename('total_services').rename_axis('state').reset_index()
+    return df.sort_values('total_services', ascending=False).reset_index(drop=True)
+
+
+def state_services_for_providers_and_procedure(cache_dir, pattern, providers):
+    df = _read_matching(cache_dir, ['provider_type', PARTITION_COLUMN, 'number_of_services'], pattern,
+                        [('provider_type', 'in', list(providers))])
+    df = df.groupby(['provider_type', PARTITION_COLUMN], observed=True)['number_of_services'].sum()
+    df = df.rename('total_services').rename_axis(['provider_type', 'state']).reset_index()
+    df['provider_type'] = df['provider_type'].astype(str)
+    return df.sort_values(['provider_type', 'total_services'], ascending=[True, False]).reset_index(drop=True)
+
+
+def state_services_for_procedures(cache_dir, procedures):
+    # One read of the rows of every matching code, each (code, description) then counted
+    # for every procedure whose pattern it matches
+    matching = pd.concat([_procedures_matching(cache_dir, pattern).assign(procedure=name)
+                          for name, pattern in procedures.items()], ignore_index=True)
+    df = read_cache(cache_dir, ['hcpcs_code', 'hcpcs_description', PARTITION_COLUMN, 'number_of_services'],
+                    [('hcpcs_code', 'in', matching['hcpcs_code'].unique().tolist())])
+    df = df.astype({'hcpcs_code': str, 'hcpcs_description': str}).merge(matching, on=['hcpcs_code', 'hcpcs_description'])
+    df = df.groupby(['procedure', PARTITION_COLUMN])['number_of_services'].sum()
+    df = df.rename('total_services').rename_axis(['procedure', 'state']).reset_index()
+    return df.sort_values(['procedure', 'total_services'], ascending=[True, False]).reset_index(drop=True)
+
+
+# The cache version of every query in sql_queries.SHIPPED_QUERIES, by the same name
+CACHE_QUERIES = {
+    'top_procedures_by_medicare_cost': top_procedures_by_medicare_cost,
+    'top_procedures_by_total_cost': top_procedures_by_total_cost,
+    'top_procedures_by_provider': top_procedures_by_provider,
+    'analyze_cost_by_speciality_and_state': cost_by_specialty_and_state,
+    'generate_pie_charts_by_provider': state_services_for_provider_and_procedure,
+    'generate_pie_chart_for_proc_by_state': state_services_for_procedure,
+    'state_services_for_providers': state_services_for_providers_and_procedure,
+    'state_services_for_procedures': state_services_for_procedures,
+}
@@ -1,87 +1,138 @@
+import csv
+import hashlib
+import io
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
 import pandas as pd
 import sqlite3
-from handler_funcs import convert_numberobj_to_float
+from handler_funcs import convert_numberobjs_to_numeric
+import instrumentation
+from instrumentation import current_rss_bytes, timed
+from sql_queries import check_query_plans
+import columnar_cache
 
 ## Load file into pandas dataframe to clean and transform data
 
-# Read data into pandas dataframe
-df = pd.read_csv('sampled_medicare_data.csv', low_memory=False)
+# Rename colums to readable and SQL-friendly headings
+COLUMN_NAMES = { 'Rndrng_NPI': 'national_provider_identifier',
+                'Rndrng_Prvdr_Last_Org_Name' : 'provider_last_org_name',
+                'Rndrng_Prvdr_First_Name' : 'provider_first_name',
+                'Rndrng_Prvdr_MI' : 'provider_middle_name_initial',
+                'Rndrng_Prvdr_Crdntls' : 'provider_credentials',
+                'Rndrng_Prvdr_Ent_Cd' : 'provider_entity_type',
+                'Rndrng_Prvdr_St1' : 'provider_street_address_1',
+                'Rndrng_Prvdr_St2' : 'provider_street_address_2',
+                'Rndrng_Prvdr_City' : 'provider_city',
+                'Rndrng_Prvdr_State_Abrvtn' : 'provider_state_abbreviation',
+                'Rndrng_Prvdr_State_FIPS' : 'provider_fips_code',
+                'Rndrng_Prvdr_Zip5' : 'provider_zip_code',
+                'Rndrng_Prvdr_RUCA' : 'provider_ruca_code',
+                'Rndrng_Prvdr_RUCA_Desc' : 'provider_ruca_description',
+                'Rndrng_Prvdr_Cntry' : 'provider_country',
+                'Rndrng_Prvdr_Type' : 'provider_type',
+                'Rndrng_Prvdr_Mdcr_Prtcptg_Ind' : 'provider_medicare_participation_indicator',
+                'HCPCS_Cd' : 'hcpcs_code',
+                'HCPCS_Desc' : 'hcpcs_description',
+                'HCPCS_Drug_Ind' : 'hcpcs_drug_indicator',
+                'Place_Of_Srvc' : 'place_of_service',
+                'Tot_Benes' : 'number_of_beneficiaries',
+                'Tot_Srvcs' : 'number_of_services',
+                'Tot_Bene_Day_Srvcs' : 'number_of_unique_beneficiary_services',
+                'Avg_Sbmtd_Chrg' : 'average_submitted_charge_amount',
+                'Avg_Mdcr_Alowd_Amt' : 'average_medicare_allowed_amount',
+                'Avg_Mdcr_Pymt_Amt' : 'average_medicare_payment_amount',
+                'Avg_Mdcr_Stdzd_Amt' : 'average_medicare_standard_pay',
+                'Smpl_Wt' : 'sampling_weight'}
 
+# Number amounts to change to numeric float type
+# (stratified and weighted samples also carry an inclusion weight for each row)
+NUMERIC_COLUMNS = ['average_submitted_charge_amount',
+                   'number_of_beneficiaries',
+                   'number_of_services',
+                   'number_of_unique_beneficiary_services',
+                   'average_medicare_allowed_amount',
+                   'average_medicare_payment_amount',
+                   'average_medicare_standard_pay',
+                   'sampling_weight']
 
+# In-memory dtype of every column after cleaning. Low-cardinality text columns are
+# dictionary-encoded as categoricals and whole counts are downcast to 32 bits. Amounts
+# stay float64, since they are written to SQLite as they are held in memory
+COLUMN_DTYPES = {'national_provider_identifier': 'int64',
+                 'provider_credentials': 'category',
+                 'provider_entity_type': 'category',
+                 'provider_state_abbreviation': 'category',
+                 'provider_fips_code': 'category',
+                 'provider_ruca_code': 'float64',
+                 'provider_ruca_description': 'category',
+                 'provider_country': 'category',
+                 'provider_type': 'category',
+                 'provider_medicare_participation_indicator': 'category',
+                 'hcpcs_code': 'category',
+                 'hcpcs_description': 'category',
+                 'hcpcs_drug_indicator': 'category',
+                 'place_of_service': 'category',
+                 'number_of_beneficiaries': 'int32',
+                 'number_of_services': 'float64',
+                 'number_of_unique_beneficiary_services': 'int32',
+                 'average_submitted_charge_amount': 'float64',
+                 'average_medicare_allowed_amount': 'float64',
+                 'average_medicare_payment_amount': 'float64',
+                 'average_medicare_standard_pay': 'float64',
+                 'sampling_weight': 'float64'}
 
+# Raw columns read_chunks reads as text: codes, names and the categorical columns. Without
+# it pandas guesses per chunk, and a chunk whose HCPCS codes are all digits reads them as
+# numbers, which then don't match the text (code, description) keys loaded before
+TEXT_COLUMNS = [raw for raw, column in COLUMN_NAMES.items() if COLUMN_DTYPES.get(column, 'category') == 'category']
 
-# Rename colums to readable and SQL-friendly headings
-df.rename(columns = { 'Rndrng_NPI': 'national_provider_identifier', 
-                    'Rndrng_Prvdr_Last_Org_Name' : 'provider_last_org_name', 
-                    'Rndrng_Prvdr_First_Name' : 'provider_first_name',
-                    'Rndrng_Prvdr_MI' : 'provider_middle_name_initial',
-                    'Rndrng_Prvdr_Crdntls' : 'provider_credentials',
-                    'Rndrng_Prvdr_Ent_Cd' : 'provider_entity_type',
-                    'Rndrng_Prvdr_St1' : 'provider_street_address_1',
-                    'Rndrng_Prvdr_St2' : 'provider_street_address_2',
-                    'Rndrng_Prvdr_City' : 'provider_city',
-                    'Rndrng_Prvdr_State_Abrvtn' : 'provider_state_abbreviation',
-                    'Rndrng_Prvdr_State_FIPS' : 'provider_fips_code',
-                    'Rndrng_Prvdr_Zip5' : 'provider_zip_code',
-                    'Rndrng_Prvdr_RUCA' : 'provider_ruca_code',
-                    'Rndrng_Prvdr_RUCA_Desc' : 'provider_ruca_description',
-                    'Rndrng_Prvdr_Cntry' : 'provider_country',
-                    'Rndrng_Prvdr_Type' : 'provider_type',
-                    'Rndrng_Prvdr_Mdcr_Prtcptg_Ind' : 'provider_medicare_participation_indicator',
-                    'HCPCS_Cd' : 'hcpcs_code',
-                    'HCPCS_Desc' : 'hcpcs_description',
-                    'HCPCS_Drug_Ind' : 'hcpcs_drug_indicator',
-                    'Place_Of_Srvc' : 'place_of_service',
-                    'Tot_Benes' : 'number_of_beneficiaries',
-                    'Tot_Srvcs' : 'number_of_services',
-                    'Tot_Bene_Day_Srvcs' : 'number_of_unique_beneficiary_services',
-                    'Avg_Sbmtd_Chrg' : 'average_submitted_charge_amount',
-                    'Avg_Mdcr_Alowd_Amt' : 'average_medicare_allowed_amount',
-                    'Avg_Mdcr_Pymt_Amt' : 'average_medicare_payment_amount',
-                    'Avg_Mdcr_Stdzd_Amt' : 'average_medicare_standard_pay'}, inplace=True)
-
-
-# print(df.info())
-# print(df.shape)
-# print(df.columns)
-
-# Remove duplicate rows for national_provider_identifier
-df.drop_duplicates(subset=['national_provider_identifier'], keep='first', inplace=True)
-print('Duplicates removed!')
-
-
-# Change the number amounts to numeric float type 
-
-df = convert_numberobj_to_float(df, 'average_submitted_charge_amount')
-df = convert_numberobj_to_float(df, 'number_of_beneficiaries')
-df = convert_numberobj_to_float(df, 'number_of_services')
-df = convert_numberobj_to_float(df, 'number_of_unique_beneficiary_services')
-df = convert_numberobj_to_float(df, 'average_medicare_allowed_amount')
-df = convert_numberobj_to_float(df, 'average_medicare_payment_amount')
-df = convert_numberobj_to_float(df, 'average_medicare_standard_pay')
-
-# print(df.info())
-
-#***********************************************************************************
-
-## Create and load data in a SQL database
-
-# Create database filename
-database_file = 'medicare_database.db'
-
-# Create the file and connect to sqlite 
-sql_connect = sqlite3.connect(database_file)
-
-# Cursor object to execute sql commands
-cursor = sql_connect.cursor()
-
-print("[SQL] Connected to the database successfully!")
-
-# Create the sql table
-create_table_sql = """
-CREATE TABLE medicare_database (
-    national_provider_identifier INTEGER PRIMARY KEY, 
-    provider_last_org_name TEXT, 
+# Columns describing the rendering provider, stored once per provider in the providers table
+PROVIDER_COLUMNS = ['national_provider_identifier',
+                    'provider_last_org_name',
+                    'provider_first_name',
+                    'provider_middle_name_initial',
+                    'provider_credentials',
+                    'provider_entity_type',
+                    'provider_street_address_1',
+                    'provider_street_address_2',
+                    'provider_city',
+                    'provider_state_abbreviation',
+                    'provider_fips_code',
+                    'provider_zip_code',
+                    'provider_ruca_code',
+                    'provider_ruca_description',
+                    'provider_country',
+                    'provider_type',
+                    'provider_medicare_participation_indicator']
+
+# Columns describing the procedure, stored once per procedure in the hcpcs table
+HCPCS_COLUMNS = ['hcpcs_code',
+                 'hcpcs_description',
+                 'hcpcs_drug_indicator']
+
+# Columns of the services fact table, one row per provider and service line
+SERVICE_COLUMNS = ['national_provider_identifier',
+                   'hcpcs_id',
+                   'place_of_service',
+                   'number_of_beneficiaries',
+                   'number_of_services',
+                   'number_of_unique_beneficiary_services',
+                   'average_submitted_charge_amount',
+                   'average_medicare_allowed_amount',
+                   'average_medicare_payment_amount',
+                   'average_medicare_standard_pay',
+                   'sampling_weight']
+
+# Create the sql tables: a providers dimension, an hcpcs lookup and a narrow services
+# fact table with integer keys to both. Every service line of a provider is kept.
+# The medicare_database view joins them back into the original flat layout
+CREATE_TABLES_SQL = """
+CREATE TABLE providers (
+    national_provider_identifier INTEGER PRIMARY KEY,
+    provider_last_org_name TEXT,
     provider_first_name TEXT,
     provider_middle_name_initial TEXT,
     provider_credentials TEXT,
@@ -96,10 +147,21 @@ CREATE TABLE medicare_database (
     provider_ruca_description TEXT,
     provider_country TEXT,
     provider_type TEXT,
-    provider_medicare_participation_indicator TEXT,
+    provider_medicare_participation_indicator TEXT
+);
+
+CREATE TABLE hcpcs (
+    hcpcs_id INTEGER PRIMARY KEY,
     hcpcs_code TEXT,
     hcpcs_description TEXT,
     hcpcs_drug_indicator TEXT,
+    UNIQUE (hcpcs_code, hcpcs_description)
+);
+
+CREATE TABLE services (
+    service_id INTEGER PRIMARY KEY,
+    national_provider_identifier INTEGER REFERENCES providers,
+    hcpcs_id INTEGER REFERENCES hcpcs,
     place_of_service TEXT,
     number_of_beneficiaries INTEGER,
     number_of_services REAL,
@@ -107,21 +169,748 @@ CREATE TABLE medicare_database (
     average_submitted_charge_amount REAL,
     average_medicare_allowed_amount REAL,
     average_medicare_payment_amount REAL,
-    average_medicare_standard_pay REAL
+    average_medicare_standard_pay REAL,
+    sampling_weight REAL
+);
+
+CREATE VIEW medicare_database AS
+SELECT
+    p.national_provider_identifier,
+    p.provider_last_org_name,
+    p.provider_first_name,
+    p.provider_middle_name_initial,
+    p.provider_credentials,
+    p.provider_entity_type,
+    p.provider_street_address_1,
+    p.provider_street_address_2,
+    p.provider_city,
+    p.provider_state_abbreviation,
+    p.provider_fips_code,
+    p.provider_zip_code,
+    p.provider_ruca_code,
+    p.provider_ruca_description,
+    p.provider_country,
+    p.provider_type,
+    p.provider_medicare_participation_indicator,
+    h.hcpcs_code,
+    h.hcpcs_description,
+    h.hcpcs_drug_indicator,
+    s.place_of_service,
+    s.number_of_beneficiaries,
+    s.number_of_services,
+    s.number_of_unique_beneficiary_services,
+    s.average_submitted_charge_amount,
+    s.average_medicare_allowed_amount,
+    s.average_medicare_payment_amount,
+    s.average_medicare_standard_pay,
+    s.sampling_weight,
+    s.service_id
+FROM services AS s
+JOIN providers AS p ON p.national_provider_identifier = s.national_provider_identifier
+JOIN hcpcs AS h ON h.hcpcs_id = s.hcpcs_id;
+"""
+
+# Secondary indexes, built only after all the data is loaded so the inserts don't
+# have to keep them up to date row by row. The provider index serves the
+# specialty/state breakdowns and the services index serves the joins
+SECONDARY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_provider_type_state ON providers (provider_type, provider_state_abbreviation);",
+    "CREATE INDEX IF NOT EXISTS idx_services_provider ON services (national_provider_identifier);",
+]
+
+# Indexes of earlier versions that no query uses since the charts read medicare_rollup,
+# dropped from existing databases so loads don't keep them up to date
+OBSOLETE_INDEXES = ['idx_hcpcs_totals', 'idx_services_hcpcs_totals']
+
+# Procedure x specialty x state cube of additive partial aggregates, so the charts
+# don't re-run the same GROUP BY over the raw rows. Sums and counts can be added up
+# across groups and across loads, and averages recombined as sum / count
+ROLLUP_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS medicare_rollup (
+    hcpcs_code TEXT,
+    hcpcs_description TEXT,
+    provider_type TEXT,
+    provider_state_abbreviation TEXT,
+    row_count INTEGER,
+    allowed_amount_count INTEGER,
+    sum_allowed_amount REAL,
+    sum_services REAL,
+    PRIMARY KEY (hcpcs_code, hcpcs_description, provider_type, provider_state_abbreviation)
+);
+"""
+ROLLUP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_rollup_provider_state ON medicare_rollup (provider_type, provider_state_abbreviation);",
+]
+
+# Trigram full-text index over the distinct procedure descriptions, so that
+# hcpcs_description LIKE '%...%' filters can find the matching hcpcs codes without
+# scanning the table. Falls back to a plain table on SQLite builds without FTS5 trigram
+SEARCH_INDEX_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS hcpcs_search USING fts5(hcpcs_code UNINDEXED, hcpcs_description, tokenize='trigram');
+"""
+SEARCH_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS hcpcs_search (hcpcs_code TEXT, hcpcs_description TEXT);
+"""
+
+# Watermark for every source file: how far into the file has been loaded, and a
+# fingerprint of the bytes just before that point to notice if the file was replaced
+INGESTED_FILES_SQL = """
+CREATE TABLE IF NOT EXISTS ingested_files (
+    file_name TEXT PRIMARY KEY,
+    byte_offset INTEGER,
+    fingerprint TEXT,
+    row_count INTEGER,
+    loaded_at TEXT
+);
+"""
+
+# The service_id range of every load of a source file. Services have no natural key, so
+# these are what lets the rows of a changed file be deleted before it is read again
+INGESTED_SERVICES_SQL = """
+CREATE TABLE IF NOT EXISTS ingested_services (
+    file_name TEXT,
+    first_service_id INTEGER,
+    last_service_id INTEGER
 );
 """
 
-# Execute CREATE TABLE in database
-cursor.execute(create_table_sql)
-sql_connect.commit()
+# Settings used while bulk loading: write-ahead log, no fsync per commit, temp data
+# in memory and a 256 MB page cache
+BULK_LOAD_PRAGMAS = {'journal_mode': 'WAL',
+                     'synchronous': 'OFF',
+                     'temp_store': 'MEMORY',
+                     'cache_size': -262144}
+
+## Streaming pipeline: every stage takes and yields dataframe chunks, so only one
+## chunk of the file is held in memory at a time no matter how big the file is
+
+class _ByteRange(io.RawIOBase):
+    # Read-only view of the bytes [start, end) of a file
+    def __init__(self, file_name, start, end):
+        self.file = open(file_name, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining)
+        if size <= 0:
+            return 0
+        read = self.file.readinto(memoryview(buffer)[:size])
+        self.remaining -= read
+        return read
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def read_chunks(file_name, chunksize, start=None, end=None):
+    """
+    Reads the csv file into pandas dataframes of chunksize rows each
+
+    With start and end, only the rows in that byte range are read (start must be the
+    beginning of a row), using the column names from the file's header. The TEXT_COLUMNS
+    are always read as text.
+    """
+    dtype = dict.fromkeys(TEXT_COLUMNS, str)
+    if start is None and end is None:
+        yield from pd.read_csv(file_name, chunksize=chunksize, dtype=dtype, low_memory=False)
+        return
+
+    with open(file_name, newline='') as file:
+        header = next(csv.reader(file))
+    with io.BufferedReader(_ByteRange(file_name, start, end)) as data:
+        yield from pd.read_csv(data, header=None, names=header, chunksize=chunksize, dtype=dtype, low_memory=False)
+
+
+def read_chunks_mmap(file_name, chunksize, start=None, end=None):
+    """
+    Reads the csv file like read_chunks, through a memory map with mmap_scan.CSVScanner
+
+    The columns stored as numbers (see COLUMN_DTYPES) are parsed straight into float
+    arrays, '$' and ',' included, and the categorical columns are decoded once per
+    distinct value. Other text columns, zip codes included, are kept as text. Chunks
+    hold about chunksize rows, as many as fit in chunksize * mmap_scan.ROW_BYTES bytes.
+    """
+    from mmap_scan import ROW_BYTES, CSVScanner
+
+    raw_names = {name: raw for raw, name in COLUMN_NAMES.items()}
+    numeric = [raw_names[column] for column, dtype in COLUMN_DTYPES.items() if dtype != 'category']
+    categorical = [raw_names[column] for column, dtype in COLUMN_DTYPES.items() if dtype == 'category']
+    with CSVScanner(file_name, block_size=chunksize * ROW_BYTES) as scanner:
+        yield from scanner.frames(numeric=numeric, start=start, end=end, categorical=categorical)
+
+
+# Readers run_etl can read the csv file with
+READERS = {'pandas': read_chunks, 'mmap': read_chunks_mmap}
+
+
+def rename_chunks(chunks):
+    """
+    Renames the raw CMS columns of every chunk to the SQL column names
+    """
+    for chunk in chunks:
+        yield chunk.rename(columns=COLUMN_NAMES)
+
+
+def clean_chunks(chunks, coerced=None):
+    """
+    Converts the number amounts in each chunk to numeric
+
+    Every service line is kept; a provider's repeated details are folded into one
+    providers row when the chunk is split for loading (see split_chunk).
+
+    args:
+        chunks: dataframe chunks with the renamed columns
+        coerced (dict): optional dict to add the number of values coerced to 0 per column to
+    """
+    for chunk in chunks:
+        columns = [column for column in NUMERIC_COLUMNS if column in chunk.columns]
+        chunk, chunk_coerced = convert_numberobjs_to_numeric(chunk, columns)
+        if coerced is not None:
+            for column, count in chunk_coerced.items():
+                coerced[column] = coerced.get(column, 0) + count
+        yield chunk
+
+
+def compact_chunks(chunks, dictionaries, memory=None):
+    """
+    Applies COLUMN_DTYPES to every chunk
+
+    Categorical columns share one dictionary per column across all chunks of a load, so
+    a value keeps the same integer code in every chunk (the columnar cache writes the
+    codes as its dictionary indices).
+
+    args:
+        chunks: cleaned dataframe chunks
+        dictionaries (dict): column -> {value: code}, filled in as new values are seen
+        memory (dict): optional dict to add rows and bytes before/after compaction to
+    """
+    for chunk in chunks:
+        before = chunk.memory_usage(deep=True).sum()
+        for column, dtype in COLUMN_DTYPES.items():
+            if column not in chunk.columns:
+                continue
+            if dtype == 'category':
+                codes = dictionaries.setdefault(column, {})
+                for value in chunk[column].dropna().unique():
+                    if value not in codes:
+                        codes[value] = len(codes)
+                chunk[column] = pd.Categorical(chunk[column], categories=list(codes))
+            else:
+                chunk[column] = chunk[column].astype(dtype)
+        if memory is not None:
+            memory['rows'] = memory.get('rows', 0) + len(chunk)
+            memory['before'] = memory.get('before', 0) + before
+            memory['after'] = memory.get('after', 0) + chunk.memory_usage(deep=True).sum()
+        yield chunk
+
+
+def read_hcpcs_ids(sql_connect):
+    """
+    Reads the hcpcs table back into a (hcpcs_code, hcpcs_description) -> hcpcs_id dict for split_chunk
+    """
+    rows = sql_connect.execute("SELECT hcpcs_code, hcpcs_description, hcpcs_id FROM hcpcs;").fetchall()
+    return {(code, description): hcpcs_id for code, description, hcpcs_id in rows}
+
+
+def split_chunk(chunk, hcpcs_ids):
+    """
+    Splits a cleaned chunk into the rows of the providers, hcpcs and services tables
+
+    Procedures not in hcpcs_ids yet are given the next free hcpcs_id and added to it, so
+    only those are returned for the hcpcs table. A provider repeated within the chunk is
+    returned once; providers already loaded from an earlier chunk are left to INSERT OR IGNORE.
+
+    args:
+        chunk: cleaned (and compacted) dataframe chunk
+        hcpcs_ids (dict): (hcpcs_code, hcpcs_description) -> hcpcs_id of every procedure loaded so far
+
+    returns:
+        dict of table name -> dataframe with that table's columns
+    """
+    providers = chunk[PROVIDER_COLUMNS].drop_duplicates(subset=['national_provider_identifier'], keep='first')
+
+    # A missing code or description is stored as '' so it can still be matched as a key
+    keys = chunk[['hcpcs_code', 'hcpcs_description']].astype(object).fillna('')
+    procedures = chunk[HCPCS_COLUMNS].astype(object).assign(**keys).drop_duplicates(subset=list(keys.columns))
+    is_new = [key not in hcpcs_ids for key in zip(procedures['hcpcs_code'], procedures['hcpcs_description'])]
+    procedures = procedures[is_new]
+    next_id = max(hcpcs_ids.values(), default=0) + 1
+    procedures.insert(0, 'hcpcs_id', range(next_id, next_id + len(procedures)))
+    hcpcs_ids.update(zip(zip(procedures['hcpcs_code'], procedures['hcpcs_description']), procedures['hcpcs_id']))
+
+    # Look up the hcpcs_id of every row at once through a (code, description) index
+    ids = pd.Series(list(hcpcs_ids.values()), index=pd.MultiIndex.from_tuples(list(hcpcs_ids)))
+    services = chunk[[column for column in SERVICE_COLUMNS if column in chunk.columns]].copy()
+    services.insert(1, 'hcpcs_id', ids.reindex(pd.MultiIndex.from_frame(keys)).to_numpy())
+
+    return {'providers': providers, 'hcpcs': procedures, 'services': services}
+
+
+def _insert_or_ignore(table, conn, keys, data_iter):
+    # Keeps the first row for a provider that was already loaded by an earlier chunk,
+    # the same as drop_duplicates(keep='first') over the whole file
+    columns = ', '.join(keys)
+    placeholders = ', '.join('?' * len(keys))
+    conn.executemany(f'INSERT OR IGNORE INTO {table.name} ({columns}) VALUES ({placeholders})', data_iter)
+
+
+def insert_chunks(chunks, sql_connect, batch_size, hcpcs_ids):
+    """
+    Splits every chunk with split_chunk and inserts the parts into the providers, hcpcs
+    and services tables in batches of batch_size rows
+    """
+    for chunk in chunks:
+        for table, rows in split_chunk(chunk, hcpcs_ids).items():
+            rows.to_sql(table, sql_connect, if_exists='append', index=False,
+                        chunksize=batch_size, method=_insert_or_ignore)
+        yield chunk
+
+
+@contextmanager
+def bulk_load_settings(sql_connect):
+    """
+    Applies BULK_LOAD_PRAGMAS for the duration of a load, then puts the previous values back
+    """
+    previous = {name: sql_connect.execute(f"PRAGMA {name};").fetchone()[0] for name in BULK_LOAD_PRAGMAS}
+    for name, value in BULK_LOAD_PRAGMAS.items():
+        sql_connect.execute(f"PRAGMA {name} = {value};")
+    try:
+        yield sql_connect
+    finally:
+        sql_connect.commit()
+        for name, value in previous.items():
+            sql_connect.execute(f"PRAGMA {name} = {value};")
+
+
+def bulk_insert_chunks(chunks, sql_connect, batch_size, hcpcs_ids):
+    """
+    Splits every chunk with split_chunk and inserts the parts into the providers, hcpcs
+    and services tables with executemany, committing every batch_size rows
+
+    The same INSERT statement is reused for every batch, so SQLite prepares it once per
+    table and column layout instead of pandas building a statement for each call.
+    """
+    statements = {}
+    for chunk in chunks:
+        for table, frame in split_chunk(chunk, hcpcs_ids).items():
+            columns = tuple(frame.columns)
+            if (table, columns) not in statements:
+                statements[table, columns] = (f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                                              f"VALUES ({', '.join('?' * len(columns))});")
+            insert_sql = statements[table, columns]
+
+            # tolist() gives plain Python values that sqlite3 can bind (NaN is stored as NULL)
+            rows = zip(*(frame[column].tolist() for column in columns))
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                sql_connect.executemany(insert_sql, batch)
+                sql_connect.commit()
+        yield chunk
+
+
+@timed('etl.build_rollup')
+def build_rollup(sql_connect, where='true'):
+    """
+    Adds the rows of medicare_database matching where to the medicare_rollup cube
+
+    Groups already in the cube have the new partial aggregates added to them, so the
+    same function builds the cube from scratch or folds in a batch of new rows
+    (e.g. where='service_id > 1000').
+    TOTAL() is used instead of SUM() so an all-NULL group adds 0 rather than NULL.
+    (SQLite needs the WHERE clause to tell the upsert's ON CONFLICT from a join.)
+    """
+    sql_connect.execute(ROLLUP_TABLE_SQL)
+    sql_connect.execute(f"""
+        INSERT INTO medicare_rollup
+        SELECT
+            hcpcs_code,
+            hcpcs_description,
+            provider_type,
+            provider_state_abbreviation,
+            COUNT(*),
+            COUNT(average_medicare_allowed_amount),
+            TOTAL(average_medicare_allowed_amount),
+            TOTAL(number_of_services)
+        FROM medicare_database
+        WHERE {where}
+        GROUP BY hcpcs_code, hcpcs_description, provider_type, provider_state_abbreviation
+        ON CONFLICT (hcpcs_code, hcpcs_description, provider_type, provider_state_abbreviation) DO UPDATE SET
+            row_count = row_count + excluded.row_count,
+            allowed_amount_count = allowed_amount_count + excluded.allowed_amount_count,
+            sum_allowed_amount = sum_allowed_amount + excluded.sum_allowed_amount,
+            sum_services = sum_services + excluded.sum_services;
+    """)
+    for index_sql in ROLLUP_INDEXES:
+        sql_connect.execute(index_sql)
+    sql_connect.commit()
+
+
+@timed('etl.build_indexes')
+def build_indexes(sql_connect):
+    """
+    Builds the SECONDARY_INDEXES and the hcpcs_search index, and refreshes the query planner statistics
+
+    hcpcs_search is filled from the procedures in the hcpcs table.
+    """
+    for index in OBSOLETE_INDEXES:
+        sql_connect.execute(f"DROP INDEX IF EXISTS {index};")
+    for index_sql in SECONDARY_INDEXES:
+        sql_connect.execute(index_sql)
+
+    try:
+        sql_connect.execute(SEARCH_INDEX_SQL)
+    except sqlite3.OperationalError:
+        sql_connect.execute(SEARCH_TABLE_SQL)
+    sql_connect.execute("DELETE FROM hcpcs_search;")
+    sql_connect.execute("""
+        INSERT INTO hcpcs_search (hcpcs_code, hcpcs_description)
+        SELECT hcpcs_code, hcpcs_description FROM hcpcs;
+    """)
+
+    sql_connect.execute("ANALYZE;")
+    sql_connect.commit()
+
+
+## Incremental ingestion: each run loads only the part of a source file that is past
+## its watermark, appending to the tables, and folds just the new services into the
+## rollup cube and search index
+
+def file_fingerprint(file_name, offset, size=1 << 20):
+    """
+    Returns a hash of the header and of the (up to) size bytes just before offset
+    """
+    digest = hashlib.sha256(str(offset).encode())
+    with open(file_name, 'rb') as file:
+        digest.update(file.readline())
+        file.seek(max(0, offset - size))
+        digest.update(file.read(min(offset, size)))
+    return digest.hexdigest()
+
+
+def pending_byte_range(sql_connect, file_name):
+    """
+    Returns the (start, end) byte range of file_name that hasn't been loaded yet, and
+    whether the file was loaded before but has changed since
+
+    The range starts at the recorded watermark if the file still matches its fingerprint
+    there, and right after the header otherwise (a new or replaced file).
+    """
+    path = os.path.realpath(file_name)
+    end = os.path.getsize(file_name)
+    with open(file_name, 'rb') as file:
+        data_start = len(file.readline())
+
+    sql_connect.execute(INGESTED_FILES_SQL)
+    loaded = sql_connect.execute("SELECT byte_offset, fingerprint FROM ingested_files WHERE file_name = ?;",
+                                 (path,)).fetchone()
+    if loaded is None:
+        return data_start, end, False
+    offset, fingerprint = loaded
+    if offset <= end and file_fingerprint(file_name, offset) == fingerprint:
+        return offset, end, False
+    print(f"[ETL] {file_name} changed since it was loaded, reading it again from the start")
+    return data_start, end, True
+
+
+def forget_file(sql_connect, file_name):
+    """
+    Deletes the services loaded from file_name by earlier loads, and its watermark, so
+    the file can be read again from the start without its rows being counted twice
+
+    returns:
+        number of services deleted
+    """
+    path = os.path.realpath(file_name)
+    sql_connect.execute(INGESTED_SERVICES_SQL)
+    ranges = sql_connect.execute("SELECT first_service_id, last_service_id FROM ingested_services WHERE file_name = ?;",
+                                 (path,)).fetchall()
+    deleted = 0
+    for first, last in ranges:
+        deleted += sql_connect.execute("DELETE FROM services WHERE service_id BETWEEN ? AND ?;", (first, last)).rowcount
+    sql_connect.execute("DELETE FROM ingested_services WHERE file_name = ?;", (path,))
+    sql_connect.execute("DELETE FROM ingested_files WHERE file_name = ?;", (path,))
+    sql_connect.commit()
+    return deleted
+
+
+def record_watermark(sql_connect, file_name, offset, row_count, service_ids=None):
+    """
+    Stores how far file_name has been loaded, adding row_count to its total, and the
+    (first, last) service_id range of the rows this load added
+    """
+    path = os.path.realpath(file_name)
+    sql_connect.execute(INGESTED_FILES_SQL)
+    sql_connect.execute(INGESTED_SERVICES_SQL)
+    if service_ids is not None and service_ids[0] <= service_ids[1]:
+        sql_connect.execute("INSERT INTO ingested_services (file_name, first_service_id, last_service_id) VALUES (?, ?, ?);",
+                            (path, *service_ids))
+    sql_connect.execute("""
+        INSERT INTO ingested_files (file_name, byte_offset, fingerprint, row_count, loaded_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (file_name) DO UPDATE SET
+            byte_offset = excluded.byte_offset,
+            fingerprint = excluded.fingerprint,
+            row_count = row_count + excluded.row_count,
+            loaded_at = excluded.loaded_at;
+    """, (path, offset, file_fingerprint(file_name, offset), row_count,
+          datetime.now().isoformat(timespec='seconds')))
+    sql_connect.commit()
+
+
+def rebuild_cache(sql_connect, database_file, chunksize):
+    """
+    Writes the columnar cache again from the medicare_database view
+
+    Used after services were deleted from the database, as rows can't be taken out of
+    the Parquet files one by one.
+    """
+    cache_dir = columnar_cache.cache_path(database_file)
+    columnar_cache.clear_cache(cache_dir)
+    columns = ', '.join(COLUMN_NAMES.values())
+    chunks = pd.read_sql_query(f"SELECT {columns} FROM medicare_database ORDER BY service_id;", sql_connect,
+                               chunksize=chunksize)
+    for chunk in columnar_cache.cache_chunks(compact_chunks(chunks, {}), cache_dir, COLUMN_DTYPES):
+        pass
+
+
+@timed('etl.merge_new_services')
+def merge_new_services(sql_connect, last_service_id, last_hcpcs_id):
+    """
+    Folds the services loaded after last_service_id into the rollup cube, and the
+    procedures added after last_hcpcs_id into the search index
+
+    returns:
+        number of services added
+    """
+    added = sql_connect.execute("SELECT COUNT(*) FROM services WHERE service_id > ?;",
+                                (last_service_id,)).fetchone()[0]
+    sql_connect.execute("""
+        INSERT INTO hcpcs_search (hcpcs_code, hcpcs_description)
+        SELECT hcpcs_code, hcpcs_description FROM hcpcs WHERE hcpcs_id > ?;
+    """, (last_hcpcs_id,))
+    build_rollup(sql_connect, f'service_id > {int(last_service_id)}')
+    sql_connect.commit()
+    sql_connect.execute("PRAGMA optimize;")
+    return added
+
+
+def _measured(chunks, stats):
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        stats['seconds'] += time.perf_counter() - start
+        stats['rows'] += len(chunk)
+        stats['peak_rss'] = max(stats['peak_rss'], current_rss_bytes())
+        yield chunk
+
+
+def measure_stage(name, chunks, report):
+    """
+    Passes chunks through unchanged while recording rows, time spent and peak RSS for a stage.
+
+    The time is measured around pulling each chunk, so it includes the stages before this
+    one; print_stage_report subtracts the previous stage to get each stage's own time.
+    """
+    stats = report.setdefault(name, {'rows': 0, 'seconds': 0.0, 'peak_rss': 0})
+    return _measured(chunks, stats)
+
+
+def stage_seconds(report):
+    """
+    Returns the time of every stage measured by measure_stage on its own, without the stages before it
+    """
+    previous = 0.0
+    seconds = {}
+    for name, stats in report.items():
+        seconds[name] = stats['seconds'] - previous
+        previous = stats['seconds']
+    return seconds
+
+
+def print_stage_report(report):
+    """
+    Prints rows/sec and peak RSS for every stage measured by measure_stage
+    """
+    for (name, stats), seconds in zip(report.items(), stage_seconds(report).values()):
+        rate = stats['rows'] / seconds if seconds > 0 else float('inf')
+        print(f"[ETL] {name:<8} {stats['rows']:>10,} rows  {seconds:8.2f}s  "
+              f"{rate:>12,.0f} rows/sec  peak RSS {stats['peak_rss'] / 2**20:,.0f} MB")
+
+
+@timed('etl.run_etl')
+def run_etl(file_name, database_file, chunksize=100000, batch_size=10000, bulk=True, incremental=False,
+            cache=True, reader='pandas', finalize=True):
+    """
+    Streams the csv file into the providers, hcpcs and services tables of a SQLite database,
+    and into the columnar cache next to it
+
+    args:
+        file_name (str): sampled (or full) CMS csv file
+        database_file (str): SQLite database file to create, or to add to when incremental
+        chunksize (int): number of csv rows read into memory at a time
+        batch_size (int): number of rows per INSERT batch
+        bulk (bool): load with bulk_insert_chunks and BULK_LOAD_PRAGMAS instead of pandas to_sql
+        incremental (bool): add to an existing database, loading only the rows of file_name
+            past its watermark. A file that changed since it was loaded replaces its earlier
+            rows. Without it the tables must not exist yet
+        cache (bool): also write the cleaned rows to the Parquet cache (see columnar_cache.py)
+        reader (str): 'pandas' to read the file with read_chunks, 'mmap' with read_chunks_mmap
+        finalize (bool): build the rollup cube and the indexes of a new database. pipeline.py
+            turns it off to run build_rollup and build_indexes as stages of their own
+
+    returns:
+        dict with rows, seconds and peak_rss per stage
+    """
+    if reader not in READERS:
+        raise ValueError(f"Unknown reader {reader!r}, expected one of {list(READERS)}")
+
+    # Create the file and connect to sqlite
+    sql_connect = sqlite3.connect(database_file, factory=instrumentation.connection_factory())
+
+    # Cursor object to execute sql commands
+    cursor = sql_connect.cursor()
+
+    print("[SQL] Connected to the database successfully!")
+
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'services';").fetchone()
+    append = incremental and exists is not None
+
+    replaced = False
+    if incremental:
+        start, end, replaced = pending_byte_range(sql_connect, file_name)
+        if start >= end:
+            print(f"[ETL] No new rows in {file_name}")
+            sql_connect.close()
+            return {}
+        watermark = end
+    else:
+        start, end = None, None
+        watermark = os.path.getsize(file_name)
+
+    if append:
+        if replaced:
+            deleted = forget_file(sql_connect, file_name)
+            print(f"[SQL] Deleted the {deleted} services loaded from {file_name} before")
+        # Earlier versions stored the categorical dictionaries in lookup_<column> tables
+        # that nothing read
+        lookups = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                 "AND name LIKE 'lookup\\_%' ESCAPE '\\';").fetchall()
+        for (table,) in lookups:
+            cursor.execute(f"DROP TABLE {table};")
+        # Services and procedures past these ids are the new ones to fold into the cube
+        hcpcs_ids = read_hcpcs_ids(sql_connect)
+        last_service_id = cursor.execute("SELECT COALESCE(MAX(service_id), 0) FROM services;").fetchone()[0]
+        last_hcpcs_id = max(hcpcs_ids.values(), default=0)
+    else:
+        # Execute CREATE TABLE in database
+        cursor.executescript(CREATE_TABLES_SQL)
+        print("[SQL] Tables created successfully!")
+        hcpcs_ids = {}
+        last_service_id = 0
+    sql_connect.commit()
+
+    if cache and not columnar_cache.available():
+        print("[ETL] pyarrow is not installed, skipping the columnar cache")
+        cache = False
+    if cache and not append:
+        columnar_cache.clear_cache(columnar_cache.cache_path(database_file))
+    # The cached rows of a changed file can't be deleted, so the cache is written again
+    # from the database once the file is loaded
+    rebuild = cache and append and replaced
+
+    report = {}
+    coerced = {}
+    memory = {}
+    dictionaries = {}
+    chunks = measure_stage('read', READERS[reader](file_name, chunksize, start, end), report)
+    chunks = measure_stage('rename', rename_chunks(chunks), report)
+    chunks = measure_stage('clean', clean_chunks(chunks, coerced), report)
+    chunks = measure_stage('compact', compact_chunks(chunks, dictionaries, memory), report)
+    if cache and not rebuild:
+        cache_dir = columnar_cache.cache_path(database_file)
+        chunks = measure_stage('cache', columnar_cache.cache_chunks(chunks, cache_dir, COLUMN_DTYPES), report)
+    if bulk:
+        with bulk_load_settings(sql_connect):
+            chunks = measure_stage('insert', bulk_insert_chunks(chunks, sql_connect, batch_size, hcpcs_ids), report)
+            for chunk in chunks:
+                pass
+    else:
+        chunks = measure_stage('insert', insert_chunks(chunks, sql_connect, batch_size, hcpcs_ids), report)
+        for chunk in chunks:
+            pass
+        sql_connect.commit()
+
+    if append and replaced:
+        # Services were deleted, so the cube is built again instead of added to
+        start_time = time.perf_counter()
+        sql_connect.execute("DROP TABLE IF EXISTS medicare_rollup;")
+        build_rollup(sql_connect)
+        build_indexes(sql_connect)
+        print(f"[SQL] Rollup cube and indexes rebuilt in {time.perf_counter() - start_time:.2f}s")
+    elif append:
+        start_time = time.perf_counter()
+        added = merge_new_services(sql_connect, last_service_id, last_hcpcs_id)
+        print(f"[SQL] {added} new services merged into the rollup cube and search index "
+              f"in {time.perf_counter() - start_time:.2f}s")
+    elif finalize:
+        start_time = time.perf_counter()
+        build_rollup(sql_connect)
+        print(f"[SQL] Rollup cube built in {time.perf_counter() - start_time:.2f}s")
+
+        start_time = time.perf_counter()
+        build_indexes(sql_connect)
+        print(f"[SQL] Indexes built in {time.perf_counter() - start_time:.2f}s")
+    if append or finalize:
+        for name, steps in check_query_plans(sql_connect).items():
+            print(f"[SQL] Warning: {name} scans the whole table: {'; '.join(steps)}")
+
+    if rebuild:
+        start_time = time.perf_counter()
+        rebuild_cache(sql_connect, database_file, chunksize)
+        print(f"[ETL] Columnar cache rebuilt in {time.perf_counter() - start_time:.2f}s")
+
+    rows_read = report['read']['rows'] if 'read' in report else 0
+    last_new_id = cursor.execute("SELECT COALESCE(MAX(service_id), 0) FROM services;").fetchone()[0]
+    record_watermark(sql_connect, file_name, watermark, rows_read, (last_service_id + 1, last_new_id))
+
+    num_services = cursor.execute("SELECT COUNT(*) FROM services;").fetchone()[0]
+    num_providers = cursor.execute("SELECT COUNT(*) FROM providers;").fetchone()[0]
+    num_procedures = cursor.execute("SELECT COUNT(*) FROM hcpcs;").fetchone()[0]
+    database_bytes = (cursor.execute("PRAGMA page_count;").fetchone()[0]
+                      * cursor.execute("PRAGMA page_size;").fetchone()[0])
+    print(f"[SQL] Data loaded successfully! {num_services} services by {num_providers} providers "
+          f"for {num_procedures} procedures, {database_bytes / max(num_services, 1):,.0f} database bytes per service")
+    print_stage_report(report)
+    for name, seconds in stage_seconds(report).items():
+        instrumentation.record(f'etl.{name}', seconds)
+    for column, count in coerced.items():
+        if count:
+            print(f"[ETL] {column}: {count} missing or invalid values set to 0")
+    if memory.get('rows'):
+        print(f"[ETL] Memory per row: {memory['before'] / memory['rows']:,.0f} bytes before, "
+              f"{memory['after'] / memory['rows']:,.0f} bytes after compaction")
 
-print("[SQL] Table created successfully!")
+    #Close the connection to the database
+    sql_connect.close()
+    return report
 
-print(len(df))
 
-df.to_sql('medicare_database', sql_connect, if_exists='append', index=False, chunksize=len(df))
+def main():
+    instrumentation.configure_from_env()
+    # Incremental, so running again (or on a new CMS file) only loads rows not loaded yet
+    run_etl('sampled_medicare_data.csv', 'medicare_database.db', incremental=True)
 
-print("[SQL] Data loaded successfully!")
 
-#Close the connection to the database
-sql_connect.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,174 +1,119 @@
 import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+from handler_funcs import combine_small_shares
+from instrumentation import configure_from_env, timed
+from query_engine import QueryEngine
+from sql_queries import ESTABLISHED_VISIT, SPECIALTIES, like_pattern
 
+# matplotlib and charts.py are imported by the functions that draw, so importing this
+# module doesn't pay for loading the plotting libraries
 
-# Connect to sql database
+# SQLite database written by data-etl.py (or its columnar cache)
 sql_filename = 'medicare_database.db'
-sql_connect = sqlite3.connect(sql_filename)
-cursor = sql_connect.cursor()
 
-print('[SQL] Connected to the database successfully!')
-
-def top_procedures_by_provider(sql_connect, limit):
+@timed('analysis.top_procedures_by_provider')
+def top_procedures_by_provider(engine, limit):
     """
     Generates a bar chart showing the top procedures for established patients, grouped by provider specialty
     
     args: 
-        sql_connect: The SQLite connection object
+        engine: The QueryEngine object
 
     """
 
-    query = f"""
-    SELECT
-        provider_type,
-        hcpcs_description,
-        SUM(number_of_services) AS total_services,
-        AVG(average_medicare_allowed_amount) AS average_cost
-    FROM
-        medicare_database
-    WHERE
-        hcpcs_description LIKE '%Established patient office or other outpatient visit%'
-    GROUP BY
-        provider_type, hcpcs_description
-    ORDER BY
-        total_services DESC
-    LIMIT {limit};
-    """
+    import matplotlib.pyplot as plt
+    from charts import draw_top_procedures_by_provider
 
     # Read results in df
-    df = pd.read_sql_query(query, sql_connect)
+    df = engine.run('top_procedures_by_provider', pattern=like_pattern(ESTABLISHED_VISIT), limit=limit)
 
     # Plot code
-    # Plot code here
-    plt.figure(figsize=(14, 8))
-    plt.bar(df['provider_type'], df['total_services'], color='skyblue')
-    plt.xlabel("Medical Providers", size=14)
-    plt.ylabel("Number of Medical Procedures", size=14)
-    plt.title('Medical Provider vs Procedures', size=16)
-    plt.grid(True)
+    draw_top_procedures_by_provider(plt.figure(), df)
     plt.show()
 
 
-def analyze_cost_by_speciality_and_state(sql_connect, specialty, limit_show = 10):
+@timed('analysis.analyze_cost_by_speciality_and_state')
+def analyze_cost_by_speciality_and_state(engine, specialty, limit_show = 10):
     """ Analyzes and visualizes the total spends by a specialty
 
     Args:
-        sql_connect: the SQLite connection object
+        engine: the QueryEngine object
         specialty : medical speciality or provider type name
     Raises:
         Exceptions from trying to connect to non valid entries.
     """
-    query = f"""
-    SELECT
-        provider_type,
-        provider_state_abbreviation AS state,
-        AVG(average_medicare_allowed_amount) AS average_cost,
-        SUM(number_of_services) AS total_services,
-        (AVG(average_medicare_allowed_amount) * SUM(number_of_services)) AS total_spending
-        FROM
-            medicare_database
-        WHERE provider_type = "{specialty}"
-        GROUP BY state
-        ORDER BY
-            total_spending DESC;
-        """
-    
-    df = pd.read_sql_query(query, sql_connect)
+    import matplotlib.pyplot as plt
+    from charts import draw_cost_by_speciality_and_state
+
+    df = engine.run('analyze_cost_by_speciality_and_state', specialty=specialty)
     shorten = df[:limit_show]
 
-    sns.barplot(x=shorten["provider_type"], y=shorten["total_spending"], hue=shorten["state"])
+    draw_cost_by_speciality_and_state(plt.figure(), shorten)
     plt.show()
 
 
-# top_procedures_by_provider(sql_connect, 10)
-
-top_providers = { "Internal Medicine" : 10,
-                    "Family Practice": 5, 
-                    "Nurse Practitioner": 5,
-                    "Cardiology" : 5,
-                    "Physicians Assistant": 5,
-                    "Dermatology": 5 }
-
-specialty = ["Internal Medicine", "Family Practice", "Nurse Practitioner", "Cardiology", "Physicians Assistant", "Dermatology"]
-                    
-# Run the function here
-# for name in top_providers:
-#     try: 
-#         analyze_cost_by_speciality_and_state(sql_connect, name, limit_show=top_providers[name])
-#     except sqlite3.OperationalError:
-#         print(f"OperationalError! Please check the {name} call")
-
-
-def generate_pie_charts_by_provider(sql_connect, provider_list):
+@timed('analysis.generate_pie_charts_by_provider')
+def generate_pie_charts_by_provider(engine, provider_list):
     """
     Generates pie charts showing the geographic distribution of
     "Established patient office or other outpatient visit" claims
     for each provider specialty in provider_list.
 
+    The state totals of every specialty come from one query, and the small states of
+    every specialty are combined at once, so the cost barely grows with the list.
+
     Args:
-        db (str): Path to the SQLite database file.
+        engine: The QueryEngine object.
         provider_list (list): A list of provider specialty names to analyze.
     """
+    import matplotlib.pyplot as plt
+    from charts import draw_state_pie
+
+    try:
+        # SQL Query for all the providers at once, loaded to panda
+        df = engine.run('state_services_for_providers', pattern=like_pattern(ESTABLISHED_VISIT),
+                        providers=list(provider_list))
+
+        #If no SQL connection, crash
+    except sqlite3.OperationalError as msg:
+        print("This type of call does not exist, will skip the charts : " + str(msg))
+        return
+
+    #Filter out points that satisfy the "Less Than 2.9%" value, for every provider
+    df = combine_small_shares(df, 'provider_type', 'state', 'total_services',
+                              threshold=0.029, other_label="Other (combined states < 2.9%)")
+    charts = dict(tuple(df.groupby('provider_type', sort=False)))
+
     #Iterate for each provider, show them the world
     for provider in provider_list:
-        try:
-            # SQL Query
-            query = f"""
-                SELECT
-                    provider_state_abbreviation AS state,
-                    SUM(number_of_services) AS total_services
-                FROM
-                    medicare_database
-                WHERE
-                    hcpcs_description LIKE '%Established patient office or other outpatient visit%'
-                    AND provider_type = "{provider}"
-                GROUP BY
-                    state
-                ORDER BY
-                    total_services DESC;
-                """
-            #Load it to panda and see
-            df = pd.read_sql_query(query, sql_connect)
-
-            #If no SQL connection, crash
-        except sqlite3.OperationalError as msg:
-            #If bad entry tell what object it is then skip.
-            print("This type of call does not exist, will skip to generate other calls : " + str(msg))
-            continue
-
-        try: #Check that the chart can exist
-
-            total = df['total_services'].sum()
-            
-            if total > 0 :
-                percentage = 0.029
-
-                #Filter out points that satisfy the "Less Than 2.9%" value
-                small_df = df[df['total_services'] < percentage*total]
-                main_df = df[df['total_services'] >= percentage*total]
-
-                #Determine
-                small_total = small_df["total_services"].sum()
-                other_state = pd.DataFrame([{"state": "Other (combined states < 2.9%)", "total_services": small_total}])
-                df = pd.concat([main_df, other_state], ignore_index = True)
-
-                # Create a pie chart
-                plt.figure(figsize=(8, 8))
-                plt.pie(df['total_services'], labels=df['state'], autopct='%1.1f%%', startangle=140) #Fill in the code
-                plt.title(f"Geographic Distribution of {provider} (Established Pt Visits)")
-                plt.tight_layout()
-                plt.show() #Show the graph
-
-            else:
-                print("No data to present!")
-
-            #Close it and end to generate another object
-        except KeyError as msg:#If chart does not exist, skip.
-            print("There is not a way to draw a "+name+" chart, will skip")
-
-generate_pie_charts_by_provider(sql_connect, specialty)
-
-
-sql_connect.close()
\ No newline at end of file
+        chart = charts.get(provider)
+
+        if chart is not None and chart['total_services'].sum() > 0:
+            # Create a pie chart
+            draw_state_pie(plt.figure(), chart, f"Geographic Distribution of {provider} (Established Pt Visits)")
+            plt.show() #Show the graph
+
+        else:
+            print(f"No data to present for {provider}!")
+
+
+def main():
+    configure_from_env()
+
+    # Connect to sql database (or its columnar cache)
+    with QueryEngine(sql_filename) as engine:
+        print('[SQL] Connected to the database successfully!')
+
+        # top_procedures_by_provider(engine, 10)
+
+        # Run the function here
+        # for name, limit_show in SPECIALTIES.items():
+        #     try:
+        #         analyze_cost_by_speciality_and_state(engine, name, limit_show=limit_show)
+        #     except sqlite3.OperationalError:
+        #         print(f"OperationalError! Please check the {name} call")
+
+        generate_pie_charts_by_provider(engine, list(SPECIALTIES))
+
+
+if __name__ == '__main__':
+    main()
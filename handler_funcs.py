@@ -1,5 +1,10 @@
+import re
+import numpy as np
 import pandas as pd
 
+# Currency symbols and thousands separators found in the CMS amount columns
+CURRENCY_CHARS = re.compile(r'[$,]')
+
 def convert_numberobj_to_float(df, column): 
     """
     Converts a currency column in a pandas df to float from object type
@@ -23,3 +28,93 @@ def convert_numberobj_to_float(df, column):
 
     return df
 
+
+def downcast_numeric(series):
+    """
+    Downcasts a float column to the narrowest dtype that still holds its values exactly
+
+    Whole numbers become the smallest integer type that fits. Columns with fractional
+    values (amounts) stay float64, since float32 would round them (12.34 is stored as
+    12.34000015258789).
+    """
+    values = series.to_numpy(dtype='float64')
+    if len(values) == 0:
+        return series
+    if np.all(values == np.floor(values)):
+        return pd.to_numeric(series, downcast='integer')
+    return series.astype('float64')
+
+
+def convert_numberobjs_to_numeric(df, columns):
+    """
+    Converts several number/currency columns of a pandas df to numeric in one pass
+
+    The text columns are stacked into one series and parsed together. Values that are
+    already plain numbers are parsed directly by pd.to_numeric, and only the ones that
+    fail (e.g. '$1,234.50') go through the currency-stripping regex. Invalid and missing
+    values become 0, and each column is downcast with downcast_numeric.
+
+    args:
+    df (pd.dataframe): the dataframe containing the columns
+    columns (list) : names of the columns to convert
+
+    returns:
+    df with converted columns, and a dict with the number of values coerced to 0 per column
+
+    """
+    text_columns = [column for column in columns if not pd.api.types.is_numeric_dtype(df[column])]
+    parsed = {column: df[column].astype('float64') for column in columns if column not in text_columns}
+
+    if text_columns:
+        stacked = pd.concat([df[column] for column in text_columns], ignore_index=True)
+
+        # Fast path: plain numbers parse without any string copies
+        numeric = pd.to_numeric(stacked, errors='coerce')
+
+        # Slow path: strip currency symbols and commas from the values that failed
+        failed = numeric.isna() & stacked.notna()
+        if failed.any():
+            stripped = stacked[failed].astype(str).str.replace(CURRENCY_CHARS, '', regex=True)
+            numeric[failed] = pd.to_numeric(stripped, errors='coerce')
+
+        values = numeric.to_numpy(dtype='float64')
+        for i, column in enumerate(text_columns):
+            parsed[column] = pd.Series(values[i * len(df):(i + 1) * len(df)], index=df.index)
+
+    coerced = {}
+    for column in columns:
+        missing = parsed[column].isna()
+        coerced[column] = int(missing.sum())
+        df[column] = downcast_numeric(parsed[column].fillna(0))
+
+    return df, coerced
+
+
+def combine_small_shares(df, group_column, label_column, value_column, threshold=0.029, other_label='Other'):
+    """
+    Combines the rows that are less than threshold of their group's total into one
+    other_label row per group, for every group at once
+
+    args:
+    df (pd.dataframe): one row per (group, label), e.g. specialty and state
+    group_column (str): column with the group of every row (one chart per group)
+    label_column (str): column with the label of every row (one slice per label)
+    value_column (str): column with the value to share out
+    threshold (float): fraction of the group's total below which a row is combined
+    other_label (str): label of the combined row
+
+    returns:
+    df with the rows at or above the threshold in their original order, followed by each
+    group's combined row (groups with no small rows get none)
+    """
+    totals = df.groupby(group_column, sort=False)[value_column].transform('sum')
+    small = (df[value_column] < threshold * totals).to_numpy()
+    other = df[small].groupby(group_column, sort=False, as_index=False)[value_column].sum()
+    other[label_column] = other_label
+    combined = pd.concat([df[~small], other[[group_column, label_column, value_column]]], ignore_index=True)
+
+    # Stable sort by the order the groups first appear in, so each group's combined row comes last
+    group_order = {group: i for i, group in enumerate(pd.unique(df[group_column]))}
+    order = combined[group_column].map(group_order).to_numpy().argsort(kind='stable')
+    return combined.iloc[order].reset_index(drop=True)
+
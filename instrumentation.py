@@ -0,0 +1,332 @@
+import atexit
+import collections
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+
+## Where the time goes: stage timers, a trace of every SQL statement, and opt-in
+## cProfile and tracemalloc, all collected here and exportable as json
+##
+## Timers always record their time, keeping the last MAX_STAGES stages so a long-running
+## process (like the dashboard backend) doesn't grow. The rest, the resident memory of
+## each stage included, is off until switched on with configure, or with the INSTRUMENT
+## environment variable read by configure_from_env:
+##     INSTRUMENT=sql,profile,memory INSTRUMENT_JSON=run.json python data-etl.py
+
+# Number of stages and of traced SQL statements kept; older ones are dropped. The SQL
+# summary adds up every statement, with one entry per distinct SQL text
+MAX_STAGES = 10000
+MAX_STATEMENTS = 10000
+
+_lock = threading.Lock()
+_local = threading.local()
+_stages = collections.deque(maxlen=MAX_STAGES)
+_statements = collections.deque(maxlen=MAX_STATEMENTS)
+_statement_totals = {}
+_settings = {'sql': False, 'profile': False, 'memory': False}
+_profiler = None
+
+
+def configure(sql=False, profile=False, memory=False):
+    """
+    Switches the optional instrumentation on or off
+
+    args:
+        sql (bool): trace every statement run on connections opened with connection_factory()
+        profile (bool): run cProfile from now until report
+        memory (bool): trace allocations with tracemalloc from now until report
+    """
+    global _profiler
+    _settings.update(sql=sql, profile=profile, memory=memory)
+    if profile and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start(10)
+
+
+def configure_from_env():
+    """
+    Configures the instrumentation from INSTRUMENT (comma separated: sql, profile,
+    memory) and, when INSTRUMENT_JSON names a file, exports the report to it and
+    prints a summary when the program exits
+    """
+    options = {option.strip() for option in os.environ.get('INSTRUMENT', '').split(',') if option.strip()}
+    unknown = options - set(_settings)
+    if unknown:
+        raise ValueError(f"Unknown INSTRUMENT options {sorted(unknown)}, expected some of {list(_settings)}")
+    configure(**{option: True for option in options})
+    output = os.environ.get('INSTRUMENT_JSON')
+    if output:
+        atexit.register(lambda: (print_summary(), export_json(output)))
+
+## Timers
+
+def current_rss_bytes():
+    """
+    Returns the resident memory of this process in bytes
+
+    Reads /proc on Linux; elsewhere falls back to the peak RSS reported by getrusage.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class timed:
+    """
+    Records the time of a stage, as a context manager or a decorator (and its resident
+    memory when profile or memory is switched on)
+
+        with timed('etl.build_rollup'):
+            ...
+
+        @timed()
+        def reservoir_sampling(file_name, sample_size): ...
+
+    args:
+        name (str): name of the stage, by default the decorated function's module and name
+    """
+    def __init__(self, name=None):
+        self.name = name
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        stack.append(self.name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        _local.stack.pop()
+        record(self.name, seconds, self._start, failed=exc_info[0] is not None)
+
+    def __call__(self, func):
+        name = self.name or f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def record(name, seconds, start=None, failed=False):
+    """
+    Records a stage timed elsewhere, e.g. the streaming ETL stages timed by measure_stage
+    """
+    stack = getattr(_local, 'stack', None)
+    rss_bytes = current_rss_bytes() if _settings['profile'] or _settings['memory'] else None
+    stage = {'name': name, 'parent': stack[-1] if stack else None, 'start': start, 'seconds': seconds,
+             'rss_bytes': rss_bytes, 'failed': failed}
+    with _lock:
+        _stages.append(stage)
+
+## SQL tracing
+
+def _record_statement(sql, seconds, rows):
+    sql = ' '.join(sql.split())
+    with _lock:
+        _statements.append({'sql': sql, 'seconds': seconds, 'rows': rows,
+                            'stage': (getattr(_local, 'stack', None) or [None])[-1]})
+        total = _statement_totals.setdefault(sql, {'sql': sql, 'count': 0, 'seconds': 0.0, 'rows': 0})
+        total['count'] += 1
+        total['seconds'] += seconds
+        total['rows'] += rows
+
+
+class _TracedCursor(sqlite3.Cursor):
+    # A statement that returns rows is recorded once they have been read: when the
+    # cursor is exhausted, at the next execute, or when it's closed or dropped. Its
+    # time includes fetching the rows, since SQLite computes them as they are stepped
+    # through. Other statements are recorded as soon as they have run
+    _pending = None
+
+    def _finish(self):
+        if self._pending is not None:
+            _record_statement(*self._pending)
+            self._pending = None
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        if self._pending is not None:
+            self._pending[1] += time.perf_counter() - start
+        return result
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        self._pending = [sql, 0.0, 0]
+        self._timed(super().execute, sql, parameters)
+        if self.description is None:
+            self._pending[2] = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        self._pending = [sql, 0.0, 0]
+        self._timed(super().executemany, sql, seq_of_parameters)
+        self._pending[2] = max(self.rowcount, 0)
+        self._finish()
+        return self
+
+    def executescript(self, sql_script):
+        self._finish()
+        self._pending = [sql_script, 0.0, 0]
+        self._timed(super().executescript, sql_script)
+        self._finish()
+        return self
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._finish()
+        elif self._pending is not None:
+            self._pending[2] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, self.arraysize if size is None else size)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        if self._pending is not None:
+            self._pending[2] += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    SQLite connection whose statements are all recorded with their duration and rows
+    """
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    # The Connection shortcuts create a plain cursor, so they go through cursor() here
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connection_factory():
+    """
+    Returns the connection class for sqlite3.connect(..., factory=...): TracedConnection
+    while SQL tracing is on, the plain sqlite3.Connection otherwise
+    """
+    return TracedConnection if _settings['sql'] else sqlite3.Connection
+
+## Report
+
+def _profile_hotspots(limit):
+    stats = pstats.Stats(_profiler)
+    rows = [{'function': f'{file}:{line}({name})', 'calls': calls, 'total_seconds': total, 'cumulative_seconds': cumulative}
+            for (file, line, name), (_, calls, total, cumulative, _) in stats.stats.items()]
+    return sorted(rows, key=lambda row: row['total_seconds'], reverse=True)[:limit]
+
+
+def _allocation_sites(limit):
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+    return {'current_bytes': current, 'peak_bytes': peak,
+            'top': [{'location': str(stat.traceback[0]), 'bytes': stat.size, 'blocks': stat.count} for stat in top]}
+
+
+def report(limit=25):
+    """
+    Returns everything recorded so far as a json-ready dict
+
+    args:
+        limit (int): number of profile hotspots and allocation sites to include
+
+    returns:
+        dict with the last MAX_STAGES stages, the last MAX_STATEMENTS SQL statements, every
+        statement summed up by SQL text (slowest first), and, when switched on, the cProfile
+        hotspots by own time and the tracemalloc peak and largest allocation sites
+    """
+    with _lock:
+        stages = list(_stages)
+        statements = list(_statements)
+        summary = [dict(total) for total in _statement_totals.values()]
+    result = {'stages': stages, 'sql': statements,
+              'sql_summary': sorted(summary, key=lambda total: total['seconds'], reverse=True)}
+    if _profiler is not None:
+        _profiler.disable()
+        result['profile'] = _profile_hotspots(limit)
+        _profiler.enable()
+    if tracemalloc.is_tracing():
+        result['memory'] = _allocation_sites(limit)
+    return result
+
+
+def export_json(file_name, limit=25):
+    """
+    Writes report(limit) to a json file
+    """
+    with open(file_name, 'w') as file:
+        json.dump(report(limit), file, indent=1, default=str)
+
+
+def print_summary(limit=10):
+    """
+    Prints the stages, the slowest statements and, when switched on, the profile and memory hotspots
+    """
+    result = report(limit)
+    for stage in result['stages']:
+        rss = f"  RSS {stage['rss_bytes'] / 2**20:,.0f} MB" if stage['rss_bytes'] is not None else ''
+        print(f"[Time] {stage['name']:<50} {stage['seconds']:9.3f}s{rss}")
+    for total in result['sql_summary'][:limit]:
+        print(f"[SQL] {total['seconds']:9.3f}s {total['count']:>7,}x {total['rows']:>11,} rows  {total['sql'][:80]}")
+    for row in result.get('profile', []):
+        print(f"[Profile] {row['total_seconds']:9.3f}s own {row['cumulative_seconds']:9.3f}s cumulative "
+              f"{row['calls']:>9,} calls  {row['function']}")
+    if 'memory' in result:
+        print(f"[Memory] peak traced {result['memory']['peak_bytes'] / 2**20:,.1f} MB")
+        for row in result['memory']['top']:
+            print(f"[Memory] {row['bytes'] / 2**20:9.1f} MB {row['blocks']:>9,} blocks  {row['location']}")
+
+
+def reset():
+    """
+    Forgets everything recorded so far
+    """
+    with _lock:
+        _stages.clear()
+        _statements.clear()
+        _statement_totals.clear()
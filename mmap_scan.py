@@ -0,0 +1,356 @@
+import csv
+import io
+import mmap
+import numpy as np
+
+## Memory-mapped csv scanner: finds the rows and fields of the raw file with numpy
+## operations on the mapped bytes and parses only the requested columns, numbers
+## straight into float arrays and text into fixed-width byte arrays, so no Python
+## object is created per row or per field. pandas is only imported to build dataframes
+
+QUOTE = ord('"')
+COMMA = ord(',')
+NEWLINE = ord('\n')
+RETURN = ord('\r')
+
+# Bytes per row of the CMS export, roughly, to turn a number of rows into a block size
+ROW_BYTES = 300
+
+# Bytes located at a time: the temporary arrays of a piece this size stay in the CPU cache
+SCAN_BYTES = 1 << 20
+
+# Longest number field parsed by the vectorized path (longer ones are parsed one by one)
+NUMBER_WIDTH = 24
+
+# Powers of ten that are exact as int64
+_POWERS = 10 ** np.arange(19, dtype=np.int64)
+
+# What each byte is to parse_numbers: quotes, '$', thousands separators, spaces, '+'
+# (and the padding past the end of a field) are skipped
+OTHER, IGNORED, DIGIT, DOT, MINUS = range(5)
+_CHAR_KINDS = np.full(256, OTHER, dtype=np.uint8)
+_CHAR_KINDS[list(b'"$, +')] = IGNORED
+_CHAR_KINDS[ord('0'):ord('9') + 1] = DIGIT
+_CHAR_KINDS[ord('.')] = DOT
+_CHAR_KINDS[ord('-')] = MINUS
+
+
+def _outside_quotes(block):
+    # A byte is outside any quoted field when an even number of quotes come before it
+    # (a doubled quote flips twice). Blocks start at a row boundary, so the count starts
+    # at 0 in every block
+    return ~np.logical_xor.accumulate(block == QUOTE)
+
+
+def _gather(buf, starts, ends, width):
+    # (rows, width) array of the bytes of each field, padded with zeros: every row is
+    # one window of width bytes of buf, copied in one fancy index, with the bytes past
+    # the end of the field zeroed
+    width = min(width, len(buf))
+    windows = np.lib.stride_tricks.sliding_window_view(buf, width)
+    chars = windows[np.minimum(starts, len(buf) - width)]
+    chars *= np.arange(width) < (ends - starts)[:, None]
+    # Fields in the last width bytes of the file don't start a full window
+    for row in (starts > len(buf) - width).nonzero()[0]:
+        field = buf[starts[row]:min(ends[row], starts[row] + width)]
+        chars[row] = 0
+        chars[row, :len(field)] = field
+    return chars
+
+
+def _parse_slow(buf, start, end):
+    text = bytes(buf[start:end]).replace(b'"', b'').replace(b'$', b'').replace(b',', b'').strip()
+    try:
+        return float(text) if text else np.nan
+    except ValueError:
+        return np.nan
+
+
+def parse_numbers(buf, starts, ends):
+    """
+    Parses the number in each field buf[starts[i]:ends[i]] into a float64 array
+
+    Quotes, '$', thousands separators and spaces are skipped, so '"$1,234.50"' is
+    1234.5. Empty and invalid fields are NaN. The fields are read a character position
+    at a time for all of them at once, summing the digits into an integer mantissa that
+    is divided once by a power of ten. With at most 15 digits the mantissa and the power
+    of ten are exact doubles, so the one division rounds exactly like float(). Fields the
+    vectorized path can't read (more digits, exponents, a '-' after the first digit or
+    '.', very long fields) go through float().
+    """
+    if not len(starts):
+        return np.empty(0)
+    lengths = ends - starts
+    width = max(min(int(lengths.max()), NUMBER_WIDTH), 1)
+    mantissa = np.zeros(len(starts), dtype=np.int64)
+    digits = np.zeros(len(starts), dtype=np.int64)
+    after_dot = np.zeros(len(starts), dtype=np.int64)
+    dots = np.zeros(len(starts), dtype=np.int64)
+    minus = np.zeros(len(starts), dtype=np.int64)
+    leading_minus = np.zeros(len(starts), dtype=bool)
+    other = np.zeros(len(starts), dtype=bool)
+    for position in range(width):
+        chars = buf[np.minimum(starts + position, len(buf) - 1)]
+        kind = np.where(position < lengths, _CHAR_KINDS[chars], IGNORED)
+        digit = kind == DIGIT
+        mantissa = np.where(digit, mantissa * 10 + (chars.astype(np.int64) - ord('0')), mantissa)
+        digits += digit
+        after_dot += digit & (dots > 0)
+        dots += kind == DOT
+        minus += kind == MINUS
+        leading_minus |= (kind == MINUS) & (digits == 0) & (dots == 0)
+        other |= kind == OTHER
+
+    values = mantissa / _POWERS[np.minimum(after_dot, 18)].astype(np.float64)
+    values = np.where(minus > 0, -values, values)
+    values[digits == 0] = np.nan
+
+    simple = (~other & (dots <= 1) & ((minus == 0) | ((minus == 1) & leading_minus))
+              & (digits <= 15) & (lengths <= NUMBER_WIDTH))
+    for row in (~simple).nonzero()[0]:
+        values[row] = _parse_slow(buf, starts[row], ends[row])
+    return values
+
+
+def parse_text(buf, starts, ends):
+    """
+    Returns the text of each field as a fixed-width bytes array, without the quotes
+    around quoted fields and with doubled quotes inside them undone
+    """
+    if not len(starts):
+        return np.empty(0, dtype='S1')
+    quoted = (buf[starts] == QUOTE) & (ends - starts >= 2)
+    starts = starts + quoted
+    ends = ends - quoted
+    width = max(int((ends - starts).max()), 1)
+    chars = _gather(buf, starts, ends, width)
+    values = chars.view(f'S{width}').ravel()
+    # Only a quoted field can hold a doubled quote
+    doubled = quoted & ((chars[:, :-1] == QUOTE) & (chars[:, 1:] == QUOTE)).any(axis=1)
+    for row in doubled.nonzero()[0]:
+        values[row] = values[row].replace(b'""', b'"')
+    return values
+
+
+def _hash_rows(values):
+    # One uint64 per value, mixing the value's bytes 8 at a time (exact for values of up
+    # to 8 bytes)
+    width = values.dtype.itemsize
+    chars = values.view(np.uint8).reshape(len(values), width)
+    if width % 8:
+        chars = np.pad(chars, ((0, 0), (0, 8 - width % 8)))
+    words = np.ascontiguousarray(chars).view('<u8')
+    hashes = words[:, 0].copy()
+    for column in range(1, words.shape[1]):
+        hashes = (hashes * np.uint64(0x100000001b3)) ^ words[:, column]
+    return hashes
+
+
+def factorize(values):
+    """
+    Returns (codes, uniques) for a bytes array, so that values == uniques[codes]
+
+    The values are grouped by a 64-bit hash of their bytes, sorting integers instead of
+    strings; every value is then compared with the first one of its group, and on a
+    hash collision the bytes themselves are sorted.
+    """
+    _, first, codes = np.unique(_hash_rows(values), return_index=True, return_inverse=True)
+    uniques = values[first]
+    if not (uniques[codes] == values).all():
+        uniques, codes = np.unique(values, return_inverse=True)
+    return codes.astype(np.int64).ravel(), uniques
+
+
+def to_categorical(values, encoding='utf-8'):
+    """
+    Converts a bytes array from parse_text to a pandas Categorical, empty fields as
+    missing. Only the distinct values are decoded
+    """
+    import pandas as pd
+    if not len(values):
+        return pd.Categorical([])
+    codes, uniques = factorize(values)
+    empty = (uniques == b'').nonzero()[0]
+    if len(empty):
+        codes = np.where(codes == empty[0], -1, codes - (codes > empty[0]))
+        uniques = np.delete(uniques, empty[0])
+    return pd.Categorical.from_codes(codes, [value.decode(encoding) for value in uniques])
+
+
+def field_bounds(row_starts, row_ends, separators, index):
+    """
+    Returns the start and end offsets of field index in every row of a block from blocks()
+    """
+    starts = row_starts if index == 0 else separators[:, index - 1] + 1
+    ends = row_ends if index == separators.shape[1] else separators[:, index]
+    return starts, ends
+
+
+class CSVScanner:
+    """
+    Scans a csv file through a memory map, a block of rows at a time
+
+    The rows of a block are found by the newlines outside quoted fields, and a row's
+    fields by the commas outside quoted fields (quoted fields may hold commas, quotes
+    and newlines). Every row must have as many fields as the header.
+
+    args:
+        file_name (str): csv file with a header row
+        block_size (int): bytes of rows parsed into each block yielded by scan and frames
+        encoding (str): encoding of the text fields
+
+        with CSVScanner('medicare_data.csv') as scanner:
+            for block in scanner.scan(['Tot_Srvcs', 'Rndrng_Prvdr_State_Abrvtn'], numeric=['Tot_Srvcs']):
+                ...
+    """
+    def __init__(self, file_name, block_size=1 << 24, encoding='utf-8'):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.encoding = encoding
+        self._file = open(file_name, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = np.frombuffer(self._map, dtype=np.uint8)
+        self.size = len(self.buf)
+
+        header_starts, header_ends, _ = next(self._rows(0, self.size, first_only=True), ([], [], None))
+        if not len(header_starts):
+            raise ValueError(f"{file_name} has no header row")
+        self.header = self.row_text(header_starts[0], header_ends[0])
+        self.columns = {name: index for index, name in enumerate(self.header)}
+        self.data_start = self._next_row
+
+    def blocks(self, start=None, end=None, fields=True):
+        """
+        Yields (row starts, row ends, separators) for the rows of every SCAN_BYTES or so,
+        as absolute offsets into buf. Row ends exclude the line ending, and separators
+        is a (rows, fields - 1) array of the commas between the fields of each row (see
+        field_bounds)
+
+        args:
+            start, end: optional byte range to scan (both must fall on row boundaries)
+            fields (bool): find the fields of each row; when False separators is None
+        """
+        position = self.data_start if start is None else start
+        end = self.size if end is None else end
+        return self._rows(position, end, len(self.header) if fields else None)
+
+    def _rows(self, position, end, num_fields=None, first_only=False):
+        scan_bytes = SCAN_BYTES
+        while position < end:
+            stop = min(position + scan_bytes, end)
+            block = self.buf[position:stop]
+            outside = _outside_quotes(block)
+            newlines = np.flatnonzero((block == NEWLINE) & outside)
+            if stop == end and (not len(newlines) or newlines[-1] != len(block) - 1):
+                # Last row without a line ending
+                newlines = np.append(newlines, len(block))
+            elif not len(newlines):
+                # No full row in the block
+                scan_bytes *= 2
+                continue
+            if first_only:
+                newlines = newlines[:1]
+            last = int(newlines[-1]) + 1
+            row_starts = np.concatenate([[0], newlines[:-1] + 1])
+            row_ends = newlines.copy()
+            has_return = (row_ends > row_starts) & (block[np.maximum(row_ends - 1, 0)] == RETURN)
+            row_ends -= has_return
+            # Blank lines are skipped
+            keep = row_ends > row_starts
+            row_starts, row_ends = row_starts[keep], row_ends[keep]
+            self._next_row = position + last
+
+            separators = None
+            if num_fields is not None:
+                commas = np.flatnonzero((block[:last] == COMMA) & outside[:last])
+                per_row = np.diff(np.searchsorted(commas, np.concatenate([[0], newlines])))[keep]
+                bad = per_row != num_fields - 1
+                if bad.any():
+                    raise ValueError(f"Row at byte {position + int(row_starts[bad.argmax()])} of {self.file_name} "
+                                     f"doesn't have {num_fields} fields")
+                separators = commas.reshape(len(row_starts), num_fields - 1) + position
+            yield row_starts + position, row_ends + position, separators
+            if first_only:
+                return
+            position += last
+
+    def scan(self, columns, numeric=(), start=None, end=None):
+        """
+        Yields a dict of column -> array for every block_size bytes or so: float64 for the
+        numeric columns, fixed-width bytes (see parse_text) for the others
+
+        args:
+            columns (list): header names of the columns to parse
+            numeric (list): the columns parsed as numbers
+            start, end: optional byte range to scan
+        """
+        indexes = {column: self.columns[column] for column in columns}
+        pieces = {column: [] for column in indexes}
+        scanned = 0
+        # Parsed a SCAN_BYTES piece at a time, which stays in the CPU cache, and joined
+        for row_starts, row_ends, separators in self.blocks(start, end):
+            for column, index in indexes.items():
+                parse = parse_numbers if column in numeric else parse_text
+                pieces[column].append(parse(self.buf, *field_bounds(row_starts, row_ends, separators, index)))
+            scanned += int(row_ends[-1] - row_starts[0]) if len(row_starts) else 0
+            if scanned >= self.block_size:
+                yield {column: np.concatenate(values) for column, values in pieces.items()}
+                pieces = {column: [] for column in indexes}
+                scanned = 0
+        if scanned:
+            yield {column: np.concatenate(values) for column, values in pieces.items()}
+
+    def frames(self, numeric=(), columns=None, start=None, end=None, categorical=None):
+        """
+        Yields a dataframe for every block, with the numeric columns as float64 and the
+        others as categoricals (empty fields missing), decoding only distinct values
+
+        args:
+            numeric (list): the columns parsed as numbers
+            columns (list): the columns to read, by default all of them
+            start, end: optional byte range to scan
+            categorical (list): when given, only these text columns are categoricals and
+                the other text columns are object columns of str
+        """
+        import pandas as pd
+        for block in self.scan(columns or self.header, numeric, start, end):
+            frame = {}
+            for column, values in block.items():
+                if column in numeric:
+                    frame[column] = values
+                elif categorical is None or column in categorical:
+                    frame[column] = to_categorical(values, self.encoding)
+                else:
+                    frame[column] = np.asarray(to_categorical(values, self.encoding), dtype=object)
+            yield pd.DataFrame(frame)
+
+    def row_text(self, start, end):
+        """
+        Returns the fields of the row in buf[start:end] as a list of str (csv quoting undone)
+        """
+        return self.rows_text([start], [end])[0]
+
+    def rows_text(self, starts, ends):
+        """
+        Returns the fields of the rows in buf[starts[i]:ends[i]] as lists of str, parsed
+        by a single csv reader
+        """
+        text = b'\n'.join(bytes(self.buf[start:end]) for start, end in zip(starts, ends)).decode(self.encoding)
+        return list(csv.reader(io.StringIO(text, newline='')))
+
+    def close(self):
+        # The numpy view must be dropped before the map can be closed. If a slice of it is
+        # still alive (e.g. in an unfinished blocks() generator) the map is closed when
+        # the last one is garbage collected
+        self.buf = None
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
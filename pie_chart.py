@@ -1,16 +1,18 @@
-import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
+from handler_funcs import combine_small_shares
+from instrumentation import configure_from_env, timed
+from query_engine import QueryEngine
+from sql_queries import like_pattern
 
+# matplotlib and charts.py are imported by the function that draws, so importing this
+# module doesn't pay for loading the plotting libraries
 
-# Connect to sql database
+# SQLite database written by data-etl.py (or its columnar cache)
 sql_filename = 'medicare_database.db'
-sql_connect = sqlite3.connect(sql_filename)
-cursor = sql_connect.cursor()
 
-print('[SQL] Connected to the database successfully!')
-
-def generate_pie_chart_for_proc_by_state(sql_connect):
+@timed('analysis.generate_pie_chart_for_proc_by_state')
+def generate_pie_chart_for_proc_by_state(engine):
+    import matplotlib.pyplot as plt
+    from charts import draw_state_pie
 
     #procedure to analyze
     procedures = {
@@ -19,55 +21,40 @@ def generate_pie_chart_for_proc_by_state(sql_connect):
         "AMD Injection 2": "Injection, faricimab-svoa"
     }
 
+    # Execute one query for every procedure and load the results into a df
+    df = engine.run('state_services_for_procedures',
+                    procedures={name: like_pattern(procedure) for name, procedure in procedures.items()})
+
+    # Remove rows with NaN values in 'total_services'
+    df = df.dropna(subset=['total_services'])
+
+    #Data Filter: states under 2.9% of a procedure's total become one "Other" entry
+    df = combine_small_shares(df, 'procedure', 'state', 'total_services', threshold=0.029, other_label="Other")
+    charts = dict(tuple(df.groupby('procedure', sort=False)))
+
     # Loop and create a graph for every procedure entry
-    for name, procedure in procedures.items():
-
-        query = f""" 
-        SELECT
-            provider_state_abbreviation AS state, 
-            SUM(number_of_services) AS total_services
-        FROM
-            medicare_database
-        WHERE
-            hcpcs_description LIKE "%{procedure}%"
-        GROUP BY
-            state
-        ORDER BY
-            total_services DESC;
-        """
-
-        # Execute the query and load the results into a df
-        df = pd.read_sql_query(query, sql_connect)
-
-        # Remove rows with NaN values in 'total_services'
-        df = df.dropna(subset=['total_services'])
-
-        #Data Filter
-        total = df['total_services'].sum()
-        percentage = 0.029
-
-        small_df = df[df['total_services'] < percentage*total] #Small points
-        main_df = df[df['total_services'] >= percentage*total] #Main points
-
-        #Add new "Other state" entry
-        small_total = small_df["total_services"].sum()
-        other_state = pd.DataFrame([{"state": "Other", "total_services": small_total}])
-        df = pd.concat([main_df, other_state], ignore_index = True)
+    for name in procedures:
+        chart = charts.get(name)
 
         # Data is None
-        if (len(df) == 0):
+        if chart is None:
             print(f"There are not entries for procedure {name}")
             continue
 
         # Create a pie chart
-        plt.figure(figsize=(8, 8))
-
-        plt.pie(df['total_services'], labels=df['state'], autopct='%1.1f%%', startangle=140)
-        plt.title(f'Geographic Distribution of {name}')
+        draw_state_pie(plt.figure(), chart, f'Geographic Distribution of {name}')
         plt.show()
 
 
+def main():
+    configure_from_env()
+
+    # Connect to sql database (or its columnar cache)
+    with QueryEngine(sql_filename) as engine:
+        print('[SQL] Connected to the database successfully!')
+
+        generate_pie_chart_for_proc_by_state(engine)
 
-generate_pie_chart_for_proc_by_state(sql_connect)
 
-sql_connect.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
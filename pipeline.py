@@ -0,0 +1,443 @@
+import argparse
+import csv
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import instrumentation
+
+## One command for the whole workflow, run as a graph of stages:
+##
+##     sample -> load -> rollup -> index -> analyze:<query> (one per shipped query)
+##                                       -> render
+##
+## load reads, cleans and loads the sample in one streaming pass (run_etl). A stage is
+## skipped when its fingerprint, made of its parameters, the hashes of the files it
+## reads and the fingerprints of the stages before it, matches the last run and its
+## outputs haven't changed since; otherwise it runs, and so does everything after it.
+## Stages whose dependencies are done run at the same time on a pool of worker threads
+##
+##     python pipeline.py --raw medicare_data.csv --profile
+
+# Fingerprints, output signatures and input hashes of the last run
+STATE_FILE = '.pipeline_state.json'
+
+
+class Stage:
+    """
+    One step of the pipeline
+
+    args:
+        name (str): stage name, 'group:item' for one of several stages of a kind
+        run (callable): does the work, called without arguments. It may return a short
+            description of what it did for the summary
+        deps (list): names of the stages that must finish first
+        inputs (list): files the stage reads that no other stage writes, hashed into its fingerprint
+        outputs (list): files and directories the stage writes
+        params (dict): settings that change the outputs (json-serializable)
+    """
+    def __init__(self, name, run, deps=(), inputs=(), outputs=(), params=None):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+
+def _signature(path):
+    # Size and modification time of a file, of a database and its write-ahead log, or of
+    # every file under a directory. None when it doesn't exist
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    elif os.path.exists(path):
+        files = [file for file in (path, f'{path}-wal') if os.path.exists(file)]
+    else:
+        return None
+    signature = []
+    for file in files:
+        stat = os.stat(file)
+        name = os.path.relpath(file, path) if os.path.isdir(path) else os.path.basename(file)
+        signature.append([name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def file_hash(path, memo=None, block_size=1 << 24):
+    """
+    Returns the sha256 of a file's contents
+
+    args:
+        memo (dict): optional path -> {'stat', 'sha256'}. A file whose size and
+            modification time are the ones in memo isn't read again, so a large raw
+            file is only hashed when it changes
+    """
+    stat = os.stat(path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    if memo is not None and memo.get(path, {}).get('stat') == key:
+        return memo[path]['sha256']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    if memo is not None:
+        memo[path] = {'stat': key, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, skipping the ones that are up to date
+
+    args:
+        stages (list): Stage objects; every dependency must be one of them and there
+            must be no cycle
+        state_file (str): json file keeping the fingerprints between runs
+        workers (int): stages run at the same time (default: one per CPU)
+    """
+    def __init__(self, stages, state_file=STATE_FILE, workers=None):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown = [dep for dep in stage.deps if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {unknown}")
+        self.order = self._topological_order()
+        self.state_file = state_file
+        self.workers = workers or os.cpu_count() or 1
+        self.state = {'stages': {}, 'outputs': {}, 'hashes': {}}
+        if os.path.exists(state_file):
+            with open(state_file) as file:
+                self.state.update(json.load(file))
+
+    def _topological_order(self):
+        order = []
+        visiting = set()
+
+        def visit(name, path):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"Stages depend on each other in a cycle: {' -> '.join(path + [name])}")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    def matching(self, names):
+        """
+        Returns the stages named in names, by name or by the group before ':' (e.g. 'analyze')
+        """
+        unknown = [name for name in names if not any(stage == name or stage.split(':')[0] == name
+                                                     for stage in self.stages)]
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}, expected some of {self.order}")
+        return [name for name in self.order if name in names or name.split(':')[0] in names]
+
+    def select(self, names):
+        """
+        Returns the stages matching names with every stage they depend on, in dependency order
+        """
+        wanted = self.matching(names)
+        selected = set()
+
+        def add(name):
+            if name not in selected:
+                selected.add(name)
+                for dep in self.stages[name].deps:
+                    add(dep)
+
+        for name in wanted:
+            add(name)
+        return [name for name in self.order if name in selected]
+
+    def fingerprint(self, stage, fingerprints):
+        """
+        Returns the fingerprint of a stage from its parameters, the hashes of its inputs
+        and the fingerprints of its dependencies
+        """
+        description = {'name': stage.name, 'params': stage.params,
+                       'inputs': {path: file_hash(path, self.state['hashes']) for path in stage.inputs},
+                       'deps': {dep: fingerprints[dep] for dep in stage.deps}}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_fresh(self, stage, fingerprint):
+        """
+        True if the stage last ran with this fingerprint and its outputs are as it left them
+        """
+        last = self.state['stages'].get(stage.name)
+        if last is None or last['fingerprint'] != fingerprint:
+            return False
+        return all(_signature(path) is not None and _signature(path) == self.state['outputs'].get(path)
+                   for path in stage.outputs)
+
+    def _save_state(self):
+        with open(self.state_file, 'w') as file:
+            json.dump(self.state, file, indent=1)
+
+    def _execute(self, stage):
+        # Runs in a worker thread; returns (description, seconds)
+        start = time.perf_counter()
+        failed = True
+        try:
+            detail = stage.run()
+            failed = False
+            return detail, time.perf_counter() - start
+        finally:
+            instrumentation.record(f'pipeline.{stage.name}', time.perf_counter() - start, start, failed)
+
+    def run(self, targets=None, force=(), dry_run=False):
+        """
+        Runs the stale stages among targets (default: all) and the stages they depend on
+
+        args:
+            targets (list): stage names or groups to bring up to date
+            force (list): stage names or groups to run even when up to date ('all' for every one)
+            dry_run (bool): only report which stages would run
+
+        returns:
+            dict of stage name -> {'status', 'seconds', 'detail'}, status being 'cached',
+            'ran', 'stale' (dry run), 'failed' or 'blocked' (a dependency failed)
+        """
+        names = self.select(targets) if targets else list(self.order)
+        forced = set(self.order) if 'all' in force else set(self.matching(force))
+        results = {}
+        fingerprints = {}
+        pending = list(names)
+        running = {}
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            while pending or running:
+                waiting = len(pending)
+                for name in list(pending):
+                    stage = self.stages[name]
+                    statuses = [results.get(dep, {}).get('status') for dep in stage.deps]
+                    if any(status in ('failed', 'blocked') for status in statuses):
+                        results[name] = {'status': 'blocked', 'seconds': 0.0, 'detail': None}
+                        pending.remove(name)
+                        print(f"[Pipeline] {name} not run, a stage it depends on failed")
+                        continue
+                    if not all(status in ('cached', 'ran', 'stale') for status in statuses):
+                        continue
+                    pending.remove(name)
+                    fingerprints[name] = self.fingerprint(stage, fingerprints)
+                    upstream_ran = any(status != 'cached' for status in statuses)
+                    if name not in forced and not upstream_ran and self.is_fresh(stage, fingerprints[name]):
+                        results[name] = {'status': 'cached', 'seconds': 0.0, 'detail': None}
+                        print(f"[Pipeline] {name} is up to date")
+                    elif dry_run:
+                        results[name] = {'status': 'stale', 'seconds': 0.0, 'detail': None}
+                        print(f"[Pipeline] {name} would run")
+                    else:
+                        # Forget the last run first, so a stage that fails or is
+                        # interrupted runs again next time
+                        self.state['stages'].pop(name, None)
+                        self._save_state()
+                        print(f"[Pipeline] {name} started")
+                        running[pool.submit(self._execute, stage)] = name
+                if not running:
+                    if pending and len(pending) == waiting:
+                        raise RuntimeError(f"Stages {pending} can't run, their dependencies weren't selected")
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    stage = self.stages[name]
+                    try:
+                        detail, seconds = future.result()
+                    except Exception as error:
+                        results[name] = {'status': 'failed', 'seconds': 0.0, 'detail': f'{type(error).__name__}: {error}'}
+                        print(f"[Pipeline] {name} failed: {type(error).__name__}: {error}")
+                        continue
+                    results[name] = {'status': 'ran', 'seconds': seconds, 'detail': detail}
+                    self.state['stages'][name] = {'fingerprint': fingerprints[name], 'seconds': seconds,
+                                                  'finished': datetime.now().isoformat(timespec='seconds')}
+                    for path in stage.outputs:
+                        self.state['outputs'][path] = _signature(path)
+                    self._save_state()
+                    print(f"[Pipeline] {name} finished in {seconds:.2f}s" + (f": {detail}" if detail else ''))
+        return {name: results[name] for name in names}
+
+
+def print_profile(results, seconds):
+    """
+    Prints the wall time, status and details of every stage, and how many were cached
+    """
+    print(f"[Pipeline] {'stage':<48} {'status':<8} {'seconds':>9}  detail")
+    for name, result in results.items():
+        print(f"[Pipeline] {name:<48} {result['status']:<8} {result['seconds']:9.2f}  {result['detail'] or ''}")
+    cached = sum(result['status'] == 'cached' for result in results.values())
+    ran = sum(result['status'] == 'ran' for result in results.values())
+    stale = sum(result['status'] == 'stale' for result in results.values())
+    stage_seconds = sum(result['seconds'] for result in results.values())
+    print(f"[Pipeline] {len(results)} stages: {ran} ran, {cached} cache hits "
+          f"({cached / max(len(results), 1):.0%}), {stale} would run, "
+          f"{sum(result['status'] in ('failed', 'blocked') for result in results.values())} failed or blocked")
+    print(f"[Pipeline] {seconds:.2f}s wall time for {stage_seconds:.2f}s of stage time")
+
+## The medicare stages
+
+def _sample(raw_file, sample_file, sample_size, seed, sampler):
+    reservoir = importlib.import_module('reservoir-sampling')
+    samplers = {'skip': reservoir.reservoir_sampling_skip,
+                'mmap': reservoir.reservoir_sampling_mmap,
+                'parallel': reservoir.reservoir_sampling_parallel}
+    header, sample = samplers[sampler](raw_file, sample_size, seed=seed)
+    with open(sample_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(sample)
+    return f'{len(sample):,} rows sampled'
+
+
+def _load(sample_file, database_file, chunksize, batch_size, reader, cache):
+    import columnar_cache
+    etl = importlib.import_module('data-etl')
+    # The stage builds the database from scratch, so the old one goes first
+    for path in (database_file, f'{database_file}-wal', f'{database_file}-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    columnar_cache.clear_cache(columnar_cache.cache_path(database_file))
+    report = etl.run_etl(sample_file, database_file, chunksize, batch_size, cache=cache, reader=reader,
+                         finalize=False)
+    return f"{report['read']['rows']:,} rows loaded" if 'read' in report else None
+
+
+def _database_step(database_file, step):
+    import sqlite3
+    etl = importlib.import_module('data-etl')
+    sql_connect = sqlite3.connect(database_file, factory=instrumentation.connection_factory())
+    try:
+        if step == 'build_rollup':
+            # build_rollup adds to the totals already in the cube, so a rerun starts from an empty one
+            sql_connect.execute("DROP TABLE IF EXISTS medicare_rollup;")
+        getattr(etl, step)(sql_connect)
+        if step == 'build_indexes':
+            from sql_queries import check_query_plans
+            for name, steps in check_query_plans(sql_connect).items():
+                print(f"[SQL] Warning: {name} scans the whole table: {'; '.join(steps)}")
+    finally:
+        sql_connect.close()
+
+
+def _analyze(database_file, query, params, path):
+    from query_engine import QueryEngine
+    with QueryEngine(database_file, result_cache=False) as engine:
+        df = engine.run(query, **params)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df.to_csv(path, index=False)
+    return f'{len(df):,} rows'
+
+
+def _render(database_file, out_dir, formats, processes):
+    import render_charts
+    from chart_cache import ChartCache
+    from query_engine import QueryEngine
+    with QueryEngine(database_file, result_cache=False) as engine:
+        jobs = render_charts.chart_jobs(engine)
+    cache = ChartCache(os.path.join(out_dir, '.chart_cache'))
+    # Fresh worker processes rather than forks of this one, which has other threads running
+    render_charts.render_charts(jobs, out_dir, formats, processes, cache, mp_context=multiprocessing.get_context('spawn'))
+    stats = cache.stats()
+    return f"{len(jobs)} charts, {stats['rendered']} files drawn, {stats['skipped']} from the chart cache"
+
+
+def medicare_stages(raw_file='medicare_data.csv', sample_file='sampled_medicare_data.csv',
+                    database_file='medicare_database.db', analysis_dir='analysis', chart_dir='charts',
+                    sample_size=50000, seed=0, sampler='skip', reader='pandas', chunksize=100000,
+                    batch_size=10000, cache=True, formats=('png',), processes=None):
+    """
+    Returns the stages of the medicare workflow, from sampling the raw CMS file to saving
+    every query result and chart
+
+    args:
+        raw_file (str): full CMS csv file
+        sample_file (str): where the sample is written
+        database_file (str): SQLite database built from the sample (Parquet cache next to it)
+        analysis_dir (str): directory for the result of every shipped query, as csv
+        chart_dir (str): directory for the chart images (and their render cache)
+        sample_size, seed, sampler: rows kept, random seed and sampler ('skip', 'mmap' or 'parallel')
+        reader, chunksize, batch_size, cache: run_etl settings
+        formats (tuple): chart file formats
+        processes (int): render worker processes (default: one per CPU)
+    """
+    from sql_queries import SHIPPED_QUERIES
+
+    database_outputs = [database_file]
+    if cache:
+        import columnar_cache
+        database_outputs.append(columnar_cache.cache_path(database_file))
+
+    stages = [Stage('sample', lambda: _sample(raw_file, sample_file, sample_size, seed, sampler),
+                    inputs=[raw_file], outputs=[sample_file],
+                    params={'sample_size': sample_size, 'seed': seed, 'sampler': sampler}),
+              Stage('load', lambda: _load(sample_file, database_file, chunksize, batch_size, reader, cache),
+                    deps=['sample'], outputs=database_outputs,
+                    params={'reader': reader, 'chunksize': chunksize, 'batch_size': batch_size, 'cache': cache}),
+              Stage('rollup', lambda: _database_step(database_file, 'build_rollup'),
+                    deps=['load'], outputs=[database_file]),
+              Stage('index', lambda: _database_step(database_file, 'build_indexes'),
+                    deps=['rollup'], outputs=[database_file])]
+
+    # The SQL text is part of every analysis stage's parameters, so editing a query runs it again
+    for query, (sql, params) in SHIPPED_QUERIES.items():
+        path = os.path.join(analysis_dir, f'{query}.csv')
+        stages.append(Stage(f'analyze:{query}',
+                            lambda query=query, params=params, path=path: _analyze(database_file, query, params, path),
+                            deps=['index'], outputs=[path], params={'query': query, 'sql': sql, 'params': params}))
+
+    # The drawing code (with charts.STYLE_VERSION) and the chart jobs are inputs of the
+    # render, hashed like the raw file rather than imported, since charts.py loads matplotlib
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    stages.append(Stage('render', lambda: _render(database_file, chart_dir, tuple(formats), processes),
+                        deps=['index'], inputs=[os.path.join(code_dir, 'charts.py'), os.path.join(code_dir, 'render_charts.py')],
+                        outputs=[chart_dir],
+                        params={'formats': list(formats), 'sql': {query: sql for query, (sql, _) in SHIPPED_QUERIES.items()}}))
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the medicare pipeline, re-running only the stages that are out of date')
+    parser.add_argument('stages', nargs='*', help='stages to bring up to date, with what they depend on '
+                                                  '(default: all), e.g. load, analyze, render')
+    parser.add_argument('--raw', default='medicare_data.csv', help='full CMS csv file')
+    parser.add_argument('--sample', default='sampled_medicare_data.csv', help='sampled csv file')
+    parser.add_argument('--database', default='medicare_database.db')
+    parser.add_argument('--analysis-dir', default='analysis', help='directory for the query results')
+    parser.add_argument('--out', default='charts', help='directory for the chart images')
+    parser.add_argument('--sample-size', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0, help='sampling seed, so an unchanged raw file gives the same sample')
+    parser.add_argument('--sampler', choices=['skip', 'mmap', 'parallel'], default='skip')
+    parser.add_argument('--reader', choices=['pandas', 'mmap'], default='pandas', help='how the ETL reads the sample')
+    parser.add_argument('--no-cache', action='store_true', help="don't write the Parquet cache")
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'svg', 'pdf'])
+    parser.add_argument('--workers', type=int, default=None, help='stages run at the same time (default: one per CPU)')
+    parser.add_argument('--processes', type=int, default=None, help='chart render processes (default: one per CPU)')
+    parser.add_argument('--force', nargs='+', default=[], help="stages to run even if up to date, or 'all'")
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    parser.add_argument('--state', default=STATE_FILE, help='file keeping the stage fingerprints')
+    parser.add_argument('--profile', action='store_true', help='print the wall time and cache hits of every stage')
+    args = parser.parse_args()
+    instrumentation.configure_from_env()
+
+    stages = medicare_stages(args.raw, args.sample, args.database, args.analysis_dir, args.out,
+                             args.sample_size, args.seed, args.sampler, args.reader, cache=not args.no_cache,
+                             formats=tuple(args.formats), processes=args.processes)
+    pipeline = Pipeline(stages, args.state, args.workers)
+    start = time.perf_counter()
+    results = pipeline.run(args.stages, args.force, args.dry_run)
+    if args.profile:
+        print_profile(results, time.perf_counter() - start)
+    return 1 if any(result['status'] in ('failed', 'blocked') for result in results.values()) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,254 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+import pandas as pd
+import columnar_cache
+import instrumentation
+from result_cache import ResultCache
+from sql_queries import SHIPPED_QUERIES, bind_params
+
+## One interface for running the shipped queries (see sql_queries.SHIPPED_QUERIES) on
+## different backends, so the charts don't depend on where the data is stored
+
+class ReaderPool:
+    """
+    Pool of read-only SQLite connections that can be shared by threads
+
+    Connections are opened on demand, up to size, and a thread waits for a free one
+    after that. Each connection keeps its own cache of prepared statements keyed by the
+    SQL text, and every query is a fixed string with bound parameters, so a statement is
+    compiled once per connection and reused for every call.
+
+    args:
+        database_file (str): SQLite database to read
+        size (int): largest number of open connections
+        immutable (bool): open with immutable=1, which skips all file locking. Only safe
+            while nothing writes to the database (e.g. not while the ETL is running)
+    """
+    def __init__(self, database_file, size=4, immutable=True):
+        self.uri = f"file:{pathname2url(os.path.abspath(database_file))}?mode=ro"
+        if immutable:
+            self.uri += "&immutable=1"
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # check_same_thread=False so a connection can go back to the pool from any thread;
+        # the pool makes sure only one thread uses it at a time
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+                               cached_statements=4 * len(SHIPPED_QUERIES),
+                               factory=instrumentation.connection_factory())
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of a with block
+        """
+        generation = self._generation
+        try:
+            sql_connect = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                opened = self._opened < self.size
+                if opened:
+                    self._opened += 1
+            if opened:
+                try:
+                    sql_connect = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                sql_connect = self._idle.get()
+        try:
+            yield sql_connect
+        finally:
+            if generation == self._generation:
+                self._idle.put(sql_connect)
+            else:
+                sql_connect.close()
+                with self._lock:
+                    self._opened -= 1
+
+    def close(self):
+        """
+        Closes the connections that aren't in use, and the ones in use once they're given back
+        """
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                sql_connect = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            sql_connect.close()
+            with self._lock:
+                self._opened -= 1
+
+
+class SQLiteBackend:
+    """
+    Runs the shipped queries on the SQLite database, where they read the medicare_rollup cube
+    """
+    name = 'sqlite'
+
+    def __init__(self, database_file, pool_size=4):
+        self.database_file = database_file
+        self.pool = ReaderPool(database_file, pool_size)
+
+    def available(self):
+        if not os.path.exists(self.database_file):
+            return False
+        with self.pool.connection() as sql_connect:
+            found = sql_connect.execute("SELECT 1 FROM sqlite_master WHERE name = 'medicare_rollup';").fetchone()
+        return found is not None
+
+    def read_sql(self, query, params):
+        with self.pool.connection() as sql_connect:
+            return pd.read_sql_query(query, sql_connect, params=bind_params(params))
+
+    def run(self, name, params):
+        return self.read_sql(SHIPPED_QUERIES[name][0], params)
+
+    def close(self):
+        self.pool.close()
+
+
+class ParquetBackend:
+    """
+    Runs the shipped queries as vectorized pandas group-bys over the columnar cache
+    """
+    name = 'parquet'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def available(self):
+        return columnar_cache.available() and os.path.isdir(self.cache_dir)
+
+    def run(self, name, params):
+        return columnar_cache.CACHE_QUERIES[name](self.cache_dir, **params)
+
+    def close(self):
+        pass
+
+
+def data_version(database_file):
+    """
+    Returns a value that changes whenever the ETL writes to the database or its cache
+
+    Taken from the size and modification time of the database (and its write-ahead
+    log), which every ETL run writes to, or of the cache files when there is no database.
+    """
+    paths = [path for path in (database_file, f'{database_file}-wal') if os.path.exists(path)]
+    if not paths:
+        cache_dir = columnar_cache.cache_path(database_file)
+        paths = [os.path.join(root, name) for root, _, files in os.walk(cache_dir) for name in files]
+    version = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        version.append([path, stat.st_size, stat.st_mtime_ns])
+    return version
+
+
+class QueryEngine:
+    """
+    Runs the shipped queries by name on the SQLite database or its columnar cache
+
+    args:
+        database_file (str): SQLite database written by the ETL (the cache is found next to it)
+        backend (str): 'sqlite', 'parquet', or 'auto' to pick a backend for every query
+        routes (dict): optional query name -> backend, for queries that should always run on one backend
+        pool_size (int): largest number of read-only SQLite connections, for running queries from several threads
+        result_cache (ResultCache): cache for query results, a new in-memory one by default, or False to run every query
+
+    With 'auto', a query runs on the first available backend in PREFERENCE: SQLite
+    answers the shipped queries from its small pre-aggregated cube, and the cache
+    is used when there is no database (e.g. only the Parquet files were copied).
+
+    Results are cached by query, parameters and data_version, so after the ETL runs
+    again the old results are no longer used and the connections are reopened.
+    """
+    PREFERENCE = ['sqlite', 'parquet']
+
+    def __init__(self, database_file, backend='auto', routes=None, pool_size=4, result_cache=None):
+        self.database_file = database_file
+        self.backends = {'sqlite': SQLiteBackend(database_file, pool_size),
+                         'parquet': ParquetBackend(columnar_cache.cache_path(database_file))}
+        if backend != 'auto' and backend not in self.backends:
+            raise ValueError(f"Unknown backend {backend!r}, expected 'auto' or one of {list(self.backends)}")
+        self.backend = backend
+        self.routes = dict(routes or {})
+        self.result_cache = ResultCache() if result_cache is None else result_cache
+        self._available = {}
+        self._version = None
+
+    def _is_available(self, name):
+        if name not in self._available:
+            self._available[name] = self.backends[name].available()
+        return self._available[name]
+
+    def backend_for(self, query):
+        """
+        Returns the name of the backend that runs query
+        """
+        if query not in SHIPPED_QUERIES:
+            raise KeyError(f"Unknown query {query!r}")
+        if query in self.routes:
+            return self.routes[query]
+        if self.backend != 'auto':
+            return self.backend
+        for name in self.PREFERENCE:
+            if self._is_available(name):
+                return name
+        raise FileNotFoundError("Neither the SQLite database nor its columnar cache could be found, run data-etl.py first")
+
+    def _check_version(self):
+        # New data: which backends are available may have changed, and the immutable
+        # connections wouldn't see the new pages
+        version = data_version(self.database_file)
+        if version != self._version:
+            self._version = version
+            self._available = {}
+            self.backends['sqlite'].close()
+        return version
+
+    def run(self, query, **params):
+        """
+        Runs one of the shipped queries with its parameters and returns the result as a dataframe
+        """
+        with instrumentation.timed(f'query.{query}'):
+            version = self._check_version()
+            if not self.result_cache:
+                return self.backends[self.backend_for(query)].run(query, params)
+
+            key = self.result_cache.key(query, params, version)
+            result = self.result_cache.get(key)
+            if result is None:
+                result = self.backends[self.backend_for(query)].run(query, params)
+                self.result_cache.put(key, result)
+            return result
+
+    def read_sql(self, query, **params):
+        """
+        Runs any read-only SQL with bound parameters on the SQLite database, for exploring the data
+        """
+        self._check_version()
+        return self.backends['sqlite'].read_sql(query, params)
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
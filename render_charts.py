@@ -0,0 +1,183 @@
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+from matplotlib.figure import Figure
+from chart_cache import ChartCache
+from charts import (draw_cost_by_speciality_and_state, draw_state_pie, draw_top_procedures_by_medicare_cost,
+                    draw_top_procedures_by_provider, draw_top_procedures_by_total_cost,
+                    draw_top_procedures_by_total_cost_bubble)
+from handler_funcs import combine_small_shares
+from query_engine import QueryEngine
+from sql_queries import ESTABLISHED_VISIT, SPECIALTIES, like_pattern
+
+## Headless batch rendering of every chart to image files. All the queries run first in
+## this process, then the drawing is spread over a pool of worker processes using the
+## Agg backend, so nothing opens a window and no one has to click through the charts
+
+# File each specialty's established patient visit pie chart is saved to, for the ones
+# whose file doesn't follow the specialty name
+PROVIDER_PIES = {'Internal Medicine': 'internal_meds_pie',
+                 'Family Practice': 'family_practice_pie',
+                 'Nurse Practitioner': 'nurse_pie',
+                 'Cardiology': 'cardio_pie',
+                 'Physician Assistant': 'physician_assistant_pie',
+                 'Dermatology': 'derm_pie'}
+
+# Procedures with a pie chart by state: name -> (description to match, file)
+PROCEDURE_PIES = {'Cataract Extraction': ('Removal of cataract with insertion of prosthetic lens', 'cataract_pie'),
+                  'AMD Injection 1': ('Injection, aflibercept', 'injection1'),
+                  'AMD Injection 2': ('Injection, faricimab-svoa', 'injection2')}
+
+def _file_stem(text):
+    return re.sub(r'[^a-z0-9]+', '_', text.lower()).strip('_')
+
+
+def chart_jobs(engine):
+    """
+    Runs the query of every chart and returns the drawing jobs for render_charts
+
+    returns:
+        list of (file stem, draw function from charts.py, query result, extra draw arguments)
+    """
+    jobs = [('most_expensive', draw_top_procedures_by_medicare_cost,
+             engine.run('top_procedures_by_medicare_cost', limit=10), {'limit': 10}),
+            ('bubble-first-try', draw_top_procedures_by_total_cost,
+             engine.run('top_procedures_by_total_cost', limit=20), {}),
+            ('bubble_2', draw_top_procedures_by_total_cost_bubble,
+             engine.run('top_procedures_by_total_cost', limit=10), {}),
+            ('provider_spec', draw_top_procedures_by_provider,
+             engine.run('top_procedures_by_provider', pattern=like_pattern(ESTABLISHED_VISIT), limit=10), {})]
+
+    for specialty, limit_show in SPECIALTIES.items():
+        df = engine.run('analyze_cost_by_speciality_and_state', specialty=specialty)
+        if len(df):
+            jobs.append((f'{_file_stem(specialty)}_cost_by_state', draw_cost_by_speciality_and_state,
+                         df[:limit_show], {}))
+
+    df = engine.run('state_services_for_providers', pattern=like_pattern(ESTABLISHED_VISIT),
+                    providers=list(SPECIALTIES))
+    df = combine_small_shares(df, 'provider_type', 'state', 'total_services',
+                              threshold=0.029, other_label="Other (combined states < 2.9%)")
+    for provider, chart in df.groupby('provider_type', sort=False):
+        if chart['total_services'].sum() > 0:
+            jobs.append((PROVIDER_PIES.get(provider, f'{_file_stem(provider)}_pie'), draw_state_pie, chart,
+                         {'title': f"Geographic Distribution of {provider} (Established Pt Visits)"}))
+
+    df = engine.run('state_services_for_procedures',
+                    procedures={name: like_pattern(procedure) for name, (procedure, _) in PROCEDURE_PIES.items()})
+    df = combine_small_shares(df.dropna(subset=['total_services']), 'procedure', 'state', 'total_services',
+                              threshold=0.029, other_label="Other")
+    for name, chart in df.groupby('procedure', sort=False):
+        jobs.append((PROCEDURE_PIES[name][1], draw_state_pie, chart, {'title': f'Geographic Distribution of {name}'}))
+    return jobs
+
+
+# Each worker draws every chart on the same off-screen figure, clearing it in between,
+# so memory stays flat however many charts are rendered
+_figure = None
+
+
+def _init_worker():
+    matplotlib.use('Agg')
+
+
+def _draw(job, out_dir, formats):
+    # Returns (path, seconds) for every format, the seconds of drawing the chart
+    # counted in full for each of them
+    global _figure
+    stem, draw, df, kwargs = job
+    if _figure is None:
+        _figure = Figure()
+    try:
+        start = time.perf_counter()
+        draw(_figure, df, **kwargs)
+        drawn = time.perf_counter() - start
+        saved = []
+        for file_format in formats:
+            start = time.perf_counter()
+            path = os.path.join(out_dir, f'{stem}.{file_format}')
+            # bbox_inches='tight' keeps the legends drawn outside the axes in the image
+            _figure.savefig(path, format=file_format, bbox_inches='tight')
+            saved.append((path, drawn + time.perf_counter() - start))
+        return saved
+    finally:
+        _figure.clear()
+
+
+def render_charts(jobs, out_dir, formats=('png',), processes=None, cache=None, mp_context=None):
+    """
+    Draws every job from chart_jobs and saves it to out_dir in each of formats
+
+    args:
+        jobs (list): drawing jobs from chart_jobs
+        out_dir (str): directory for the image files, created if needed
+        formats (tuple): file formats, e.g. ('png', 'svg')
+        processes (int): number of worker processes (default: one per CPU). With 1
+            the charts are drawn in this process
+        cache (ChartCache): optional cache of rendered charts. Charts whose query
+            result, arguments and style haven't changed are copied from it instead of
+            drawn, and the charts that are drawn are added to it
+        mp_context: optional multiprocessing context for the workers, e.g. 'spawn' ones
+            when rendering from a thread of a program that runs others
+
+    returns:
+        list of the written file paths
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    todo = []
+    keys = {}
+    for job in jobs:
+        stem, draw, df, kwargs = job
+        missing = []
+        for file_format in formats:
+            path = os.path.join(out_dir, f'{stem}.{file_format}')
+            if cache is not None:
+                keys[path] = cache.key(df, draw, kwargs, file_format)
+                if cache.fetch(keys[path], file_format, path):
+                    paths.append(path)
+                    continue
+            missing.append(file_format)
+        if missing:
+            todo.append((job, tuple(missing)))
+
+    if processes == 1 or len(todo) <= 1:
+        # The figure is drawn off-screen whatever the backend, so the caller's is left alone
+        results = [_draw(job, out_dir, missing) for job, missing in todo]
+    else:
+        with ProcessPoolExecutor(processes, mp_context=mp_context, initializer=_init_worker) as pool:
+            results = list(pool.map(_draw, [job for job, _ in todo], [out_dir] * len(todo),
+                                    [missing for _, missing in todo]))
+    for saved in results:
+        for path, seconds in saved:
+            if cache is not None:
+                cache.store(keys[path], os.path.splitext(path)[1][1:], path, seconds)
+            paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render every chart to image files without opening windows')
+    parser.add_argument('--database', default='medicare_database.db')
+    parser.add_argument('--out', default='charts', help='directory for the image files')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'svg', 'pdf'])
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache-dir', default=None, help='cache of rendered charts (default: .chart_cache in --out)')
+    parser.add_argument('--no-cache', action='store_true', help='draw every chart, even the unchanged ones')
+    args = parser.parse_args()
+    cache = None if args.no_cache else ChartCache(args.cache_dir or os.path.join(args.out, '.chart_cache'))
+
+    start = time.perf_counter()
+    with QueryEngine(args.database) as engine:
+        jobs = chart_jobs(engine)
+    queried = time.perf_counter()
+    paths = render_charts(jobs, args.out, tuple(args.formats), args.processes, cache)
+    print(f"[Render] {len(jobs)} charts queried in {queried - start:.2f}s, "
+          f"{len(paths)} files written to {args.out} in {time.perf_counter() - queried:.2f}s")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"[Render] {stats['rendered']} files rendered, {stats['skipped']} unchanged files "
+              f"copied from the cache, saving {stats['seconds_saved']:.2f}s of rendering")
@@ -1,6 +1,14 @@
 import csv
+import heapq
+import io
+import math
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+from instrumentation import timed
 
+@timed('sampling.reservoir_sampling')
 def reservoir_sampling(file_name, sample_size):
     reservoir = []
     with open(file_name, 'r') as file:
@@ -16,16 +24,532 @@ def reservoir_sampling(file_name, sample_size):
                     reservoir[j] = row
     return header, reservoir
     
-file_name = 'medicare_data.csv'
-sample_size = 50000
-header, sample = reservoir_sampling(file_name, sample_size)
 
-# Write sampled data to a new csv file
+class _RawLineReader:
+    """
+    Reads newline-terminated records from a binary file, with a fast path to skip
+    over lines by counting newlines in raw byte blocks instead of decoding them.
 
-new_file = open('sampled_medicare_data.csv', 'w+', newline='')
+    args:
+        file: file object opened in binary mode, positioned at the first record
+        block_size: number of bytes read from disk at a time
+        end: optional byte offset to stop reading at, for reading one shard of a file
+    """
 
-with new_file:
-    write = csv.writer(new_file)
-    write.writerow(header)
-    write.writerows(sample)
+    def __init__(self, file, block_size=1 << 24, end=None):
+        self.file = file
+        self.block_size = block_size
+        self.remaining = None if end is None else end - file.tell()
+        self.buf = b''
+        self.pos = 0
+        self.bytes_seen = 0
+        self.lines_seen = 0
 
+    def _fill(self):
+        # Keep whatever is left of the current line and append the next block
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size <= 0:
+                return False
+        block = self.file.read(size)
+        if not block:
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(block)
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def _avg_line_length(self):
+        if self.lines_seen == 0:
+            return 256
+        return max(1, self.bytes_seen // self.lines_seen)
+
+    def skip(self, n):
+        """
+        Skips the next n lines without decoding them. Returns False if the file ends first.
+        """
+        while n > 0:
+            if self.pos >= len(self.buf):
+                self.buf, self.pos = b'', 0
+                if not self._fill():
+                    return False
+
+            start = self.pos
+            if n <= 32:
+                # Short hops: find the newlines one at a time
+                i = self.buf.find(b'\n', start)
+                if i < 0:
+                    self.pos = len(self.buf)
+                    self.bytes_seen += self.pos - start
+                    continue
+                self.pos = i + 1
+                self.lines_seen += 1
+                n -= 1
+            else:
+                # Long hops: jump a guessed window ahead and count the newlines inside it,
+                # shrinking the window if it would go past the line we want to land on
+                end = min(len(self.buf), start + int(n * self._avg_line_length() * 0.9) + 1)
+                count = self.buf.count(b'\n', start, end)
+                while count > n:
+                    end = start + (end - start) // 2
+                    count = self.buf.count(b'\n', start, end)
+                if count == n:
+                    # The window can end partway through the next line: land right after
+                    # the n-th newline instead, so readline() starts at a record
+                    end = self.buf.rindex(b'\n', start, end) + 1
+                self.pos = end
+                n -= count
+                self.lines_seen += count
+
+            self.bytes_seen += self.pos - start
+        return True
+
+    def readline(self):
+        """
+        Returns the next full record as bytes, or b'' at the end of the file.
+        A record whose quotes are unbalanced continues onto the following line.
+        """
+        record = b''
+        while True:
+            i = self.buf.find(b'\n', self.pos)
+            while i < 0:
+                if not self._fill():
+                    line = self.buf[self.pos:]
+                    self.pos = len(self.buf)
+                    return record + line
+                i = self.buf.find(b'\n', self.pos)
+
+            line = self.buf[self.pos:i + 1]
+            self.pos = i + 1
+            self.bytes_seen += len(line)
+            self.lines_seen += 1
+            record += line
+
+            if record.count(b'"') % 2 == 0:
+                return record
+
+
+def _parse_record(line, encoding):
+    # A record can span several physical lines when a quoted field holds a line break
+    return next(csv.reader(io.StringIO(line.decode(encoding), newline='')))
+
+
+@timed('sampling.reservoir_sampling_skip')
+def reservoir_sampling_skip(file_name, sample_size, seed=None, encoding='utf-8'):
+    """
+    Reservoir sampling that skips ahead over rejected rows (Algorithm L).
+
+    Instead of drawing a random number for every row, the gap to the next accepted row
+    is drawn from a geometric distribution and the rows in between are skipped by
+    counting newlines in raw bytes. Only the rows still in the reservoir at the end are
+    decoded and parsed with csv. Rows are assumed not to contain line breaks inside
+    quoted fields, which holds for the CMS Physician & Other Practitioners export.
+
+    args:
+        file_name (str): path to the csv file to sample
+        sample_size (int): number of rows to keep
+        seed: optional seed so the same sample can be reproduced
+        encoding (str): text encoding of the csv file
+
+    returns:
+        header (list) and reservoir (list of rows), as in reservoir_sampling
+    """
+    rng = random.Random(seed)
+    reservoir = []
+
+    with open(file_name, 'rb') as file:
+        reader = _RawLineReader(file)
+        header = _parse_record(reader.readline(), encoding)
+
+        # Fill the reservoir with the first sample_size rows
+        while len(reservoir) < sample_size:
+            line = reader.readline()
+            if not line:
+                break
+            reservoir.append(line)
+
+        if len(reservoir) == sample_size and sample_size > 0:
+            w = math.exp(math.log(1.0 - rng.random()) / sample_size)
+            while True:
+                # Number of rows rejected before the next one that enters the reservoir
+                gap = math.floor(math.log(1.0 - rng.random()) / math.log1p(-w))
+                if not reader.skip(gap):
+                    break
+                line = reader.readline()
+                if not line:
+                    break
+                reservoir[rng.randrange(sample_size)] = line
+                w *= math.exp(math.log(1.0 - rng.random()) / sample_size)
+
+    reservoir = [_parse_record(line, encoding) for line in reservoir]
+    return header, reservoir
+
+
+def _count_quotes(file_name, start, end, block_size=1 << 24):
+    # Number of quote characters in the byte range [start, end)
+    count = 0
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = file.read(min(block_size, remaining))
+            if not block:
+                break
+            count += block.count(b'"')
+            remaining -= len(block)
+    return count
+
+
+def _align_to_record(file, offset, in_quotes):
+    """
+    Returns the offset of the first record that starts after the given byte offset.
+    in_quotes tells whether the offset falls inside a quoted field, so that newlines
+    inside quotes are not mistaken for the end of a record.
+    """
+    file.seek(offset)
+    position = offset
+    while True:
+        block = file.read(1 << 16)
+        if not block:
+            return position
+        start = 0
+        while True:
+            i = block.find(b'\n', start)
+            if i < 0:
+                in_quotes ^= block.count(b'"', start) % 2 == 1
+                break
+            in_quotes ^= block.count(b'"', start, i) % 2 == 1
+            if not in_quotes:
+                return position + i + 1
+            start = i + 1
+        position += len(block)
+
+
+def _shard_boundaries(file_name, data_start, num_shards, pool, quote_safe=True):
+    """
+    Splits the data part of a csv file into byte ranges that each start at a record.
+
+    With quote_safe, the quote characters in every raw range are counted in parallel
+    first, so each split point knows whether it falls inside a quoted field.
+    """
+    size = os.path.getsize(file_name)
+    raw = [data_start + (size - data_start) * i // num_shards for i in range(num_shards)] + [size]
+
+    if quote_safe:
+        counts = list(pool.map(_count_quotes, [file_name] * num_shards, raw[:-1], raw[1:]))
+    else:
+        counts = [0] * num_shards
+
+    boundaries = [data_start]
+    quotes_before = 0
+    with open(file_name, 'rb') as file:
+        for i in range(1, num_shards):
+            quotes_before += counts[i - 1]
+            boundary = _align_to_record(file, raw[i], quotes_before % 2 == 1)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return boundaries
+
+
+def _sample_shard(file_name, start, end, sample_size, seed):
+    """
+    Keeps the sample_size rows with the largest random keys in the byte range [start, end).
+
+    Every row gets a uniform random key, so the rows with the largest keys form a uniform
+    sample, and the top keys of several shards can be merged into one sample. Rows that
+    can't beat the smallest key in the reservoir are skipped in one jump (exponential
+    jumps), so keys are only drawn for rows that enter the reservoir.
+
+    returns:
+        list of (key, raw line) pairs
+    """
+    rng = random.Random(seed)
+    heap = []
+
+    with open(file_name, 'rb') as file:
+        file.seek(start)
+        reader = _RawLineReader(file, end=end)
+
+        while len(heap) < sample_size:
+            line = reader.readline()
+            if not line:
+                return heap
+            heapq.heappush(heap, (1.0 - rng.random(), line))
+
+        while True:
+            threshold = heap[0][0]
+            if threshold >= 1.0:
+                break
+            # Rows before the next one whose key beats the threshold
+            gap = math.floor(math.log(1.0 - rng.random()) / math.log(threshold))
+            if not reader.skip(gap):
+                break
+            line = reader.readline()
+            if not line:
+                break
+            key = threshold + (1.0 - threshold) * (1.0 - rng.random())
+            heapq.heapreplace(heap, (key, line))
+
+    return heap
+
+
+@timed('sampling.reservoir_sampling_parallel')
+def reservoir_sampling_parallel(file_name, sample_size, processes=None, seed=None,
+                                encoding='utf-8', quote_safe=True):
+    """
+    Reservoir sampling spread over several processes.
+
+    The file is split into byte ranges aligned to record starts, each worker keeps the
+    rows with the largest random keys in its range, and the partial reservoirs are merged
+    by keeping the sample_size largest keys overall. Since every row of the file gets an
+    independent uniform key, the result is a uniform sample of the whole file. Within a
+    range rows are skipped by counting newlines, as in reservoir_sampling_skip.
+
+    args:
+        file_name (str): path to the csv file to sample
+        sample_size (int): number of rows to keep
+        processes (int): number of worker processes, defaults to the number of cores
+        seed: optional seed so the same sample can be reproduced with the same processes
+        encoding (str): text encoding of the csv file
+        quote_safe (bool): count quotes before splitting so a split never lands inside a
+            quoted field; can be turned off for files with no line breaks inside quotes
+
+    returns:
+        header (list) and reservoir (list of rows), as in reservoir_sampling
+    """
+    processes = processes or os.cpu_count() or 1
+
+    with open(file_name, 'rb') as file:
+        reader = _RawLineReader(file)
+        header = _parse_record(reader.readline(), encoding)
+        data_start = reader.bytes_seen
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        boundaries = _shard_boundaries(file_name, data_start, processes, pool, quote_safe)
+        shards = len(boundaries) - 1
+        seeds = [None if seed is None else f'{seed}-{i}' for i in range(shards)]
+        partial = pool.map(_sample_shard, [file_name] * shards, boundaries[:-1], boundaries[1:],
+                           [sample_size] * shards, seeds)
+        merged = heapq.nlargest(sample_size, (item for heap in partial for item in heap))
+
+    reservoir = [_parse_record(line, encoding) for key, line in merged]
+    return header, reservoir
+
+
+@timed('sampling.reservoir_sampling_mmap')
+def reservoir_sampling_mmap(file_name, sample_size, seed=None, encoding='utf-8'):
+    """
+    Reservoir sampling (Algorithm R) over a memory map of the file, a block of rows at a time.
+
+    The rows of each block are located with numpy by mmap_scan.CSVScanner, and the
+    replacement slot of every row is drawn for the whole block at once, so nothing is
+    done per row in Python. The reservoir holds byte offsets: only the rows in it at the
+    end are decoded and parsed with csv. Quoted fields may hold line breaks.
+
+    args:
+        file_name (str): path to the csv file to sample
+        sample_size (int): number of rows to keep
+        seed: optional seed so the same sample can be reproduced
+        encoding (str): text encoding of the csv file
+
+    returns:
+        header (list) and reservoir (list of rows), as in reservoir_sampling
+    """
+    import numpy as np
+    from mmap_scan import CSVScanner
+
+    rng = np.random.default_rng(seed)
+    starts = np.zeros(sample_size, dtype=np.int64)
+    ends = np.zeros(sample_size, dtype=np.int64)
+    seen = 0
+
+    with CSVScanner(file_name, encoding=encoding) as scanner:
+        for row_starts, row_ends, _ in scanner.blocks(fields=False):
+            index = seen + np.arange(len(row_starts))
+            seen += len(row_starts)
+
+            # The first sample_size rows fill the reservoir, row i after that replaces
+            # slot j for a uniform j in [0, i] when j < sample_size
+            slots = np.where(index < sample_size, index, rng.integers(0, index + 1))
+            accepted = (slots < sample_size).nonzero()[0]
+            # When a slot is drawn more than once in a block the last row wins
+            slots, last = np.unique(slots[accepted][::-1], return_index=True)
+            accepted = accepted[::-1][last]
+            starts[slots] = row_starts[accepted]
+            ends[slots] = row_ends[accepted]
+
+        header = scanner.header
+        reservoir = scanner.rows_text(starts[:seen], ends[:seen])
+    return header, reservoir
+
+
+# Name of the column holding each sampled row's inclusion weight (1 / inclusion probability)
+WEIGHT_COLUMN = 'Smpl_Wt'
+
+
+def _parse_number(value):
+    # Weights come from count and currency columns, which may hold '$' and ','
+    try:
+        return float(value.replace('$', '').replace(',', ''))
+    except ValueError:
+        return 0.0
+
+
+@timed('sampling.stratified_reservoir_sampling')
+def stratified_reservoir_sampling(file_name, stratum_size, stratum_column, seed=None, encoding='utf-8'):
+    """
+    Keeps a separate reservoir of up to stratum_size rows for every value of stratum_column,
+    so rare providers, states or procedures are not lost in a uniform sample.
+
+    Each stratum is sampled with Algorithm L in a single pass, so random numbers are only
+    drawn for rows that enter a reservoir. Memory is bounded by stratum_size times the
+    number of distinct values in the column. Every row gets an inclusion weight (rows seen
+    in its stratum / rows kept from it) in the Smpl_Wt column, to scale SUM and AVG
+    aggregates back to the full file.
+
+    args:
+        file_name (str): path to the csv file to sample
+        stratum_size (int): number of rows to keep per stratum
+        stratum_column (str): raw column to stratify on, e.g. 'Rndrng_Prvdr_Type',
+            'Rndrng_Prvdr_State_Abrvtn' or 'HCPCS_Cd'
+        seed: optional seed so the same sample can be reproduced
+        encoding (str): text encoding of the csv file
+
+    returns:
+        header (list) and reservoir (list of rows), both ending with the Smpl_Wt column
+    """
+    rng = random.Random(seed)
+    # stratum value -> [rows seen, reservoir, w, index of the next row to accept]
+    strata = {}
+
+    with open(file_name, 'r', encoding=encoding, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        key_index = header.index(stratum_column)
+
+        for row in reader:
+            state = strata.get(row[key_index])
+            if state is None:
+                state = strata[row[key_index]] = [0, [], 0.0, 0]
+            i = state[0]
+            state[0] += 1
+
+            if i < stratum_size:
+                state[1].append(row)
+                if i + 1 == stratum_size:
+                    state[2] = math.exp(math.log(1.0 - rng.random()) / stratum_size)
+                    state[3] = i + 1 + math.floor(math.log(1.0 - rng.random()) / math.log1p(-state[2]))
+            elif i == state[3]:
+                state[1][rng.randrange(stratum_size)] = row
+                state[2] *= math.exp(math.log(1.0 - rng.random()) / stratum_size)
+                state[3] = i + 1 + math.floor(math.log(1.0 - rng.random()) / math.log1p(-state[2]))
+
+    reservoir = []
+    for seen, rows, w, next_index in strata.values():
+        weight = seen / len(rows)
+        reservoir.extend(row + [repr(weight)] for row in rows)
+    return header + [WEIGHT_COLUMN], reservoir
+
+
+@timed('sampling.weighted_reservoir_sampling')
+def weighted_reservoir_sampling(file_name, sample_size, weight_column, seed=None, encoding='utf-8'):
+    """
+    Samples rows with probability proportional to a numeric column, such as 'Tot_Srvcs' or
+    'Avg_Mdcr_Alowd_Amt' (A-ExpJ weighted reservoir sampling).
+
+    Each row gets the key u ** (1 / weight) and the sample_size largest keys are kept. Rows
+    that can't beat the smallest key are skipped by subtracting their weights from a random
+    jump, so random numbers are only drawn for rows that enter the reservoir. Keys are kept
+    as logarithms so large weights don't all round to 1. Rows with a weight of 0 are never
+    sampled.
+
+    One extra row is kept to find the threshold key t, and each sampled row gets the
+    inclusion weight 1 / (1 - t ** weight) in the Smpl_Wt column, which makes weighted
+    SUM aggregates unbiased.
+
+    args:
+        file_name (str): path to the csv file to sample
+        sample_size (int): number of rows to keep
+        weight_column (str): raw numeric column to weight rows by
+        seed: optional seed so the same sample can be reproduced
+        encoding (str): text encoding of the csv file
+
+    returns:
+        header (list) and reservoir (list of rows), both ending with the Smpl_Wt column
+    """
+    rng = random.Random(seed)
+    capacity = sample_size + 1
+    # Min-heap of (log key, row number, weight, row), the row number breaks ties
+    heap = []
+    jump = 0.0
+
+    with open(file_name, 'r', encoding=encoding, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        weight_index = header.index(weight_column)
+
+        for n, row in enumerate(reader):
+            weight = _parse_number(row[weight_index])
+            if weight <= 0:
+                continue
+
+            if len(heap) < capacity:
+                heapq.heappush(heap, (math.log(1.0 - rng.random()) / weight, n, weight, row))
+                if len(heap) == capacity:
+                    jump = math.log(1.0 - rng.random()) / heap[0][0]
+                continue
+
+            jump -= weight
+            if jump > 0:
+                continue
+
+            # The row beats the threshold: draw its key from the part above the threshold
+            log_threshold = heap[0][0]
+            low = math.exp(weight * log_threshold)
+            log_key = math.log(low + (1.0 - low) * (1.0 - rng.random())) / weight
+            heapq.heapreplace(heap, (log_key, n, weight, row))
+            jump = math.log(1.0 - rng.random()) / heap[0][0]
+
+    if len(heap) == capacity:
+        log_threshold = heapq.heappop(heap)[0]
+        weights = [1.0 / -math.expm1(weight * log_threshold) for key, n, weight, row in heap]
+    else:
+        weights = [1.0] * len(heap)
+
+    reservoir = [item[3] + [repr(w)] for item, w in zip(heap, weights)]
+    return header + [WEIGHT_COLUMN], reservoir
+
+
+def main():
+    instrumentation.configure_from_env()
+    file_name = 'medicare_data.csv'
+    sample_size = 50000
+
+    # Set one of these to sample per stratum (sample_size rows each) or in proportion
+    # to a column, instead of uniformly
+    stratum_column = None  # e.g. 'Rndrng_Prvdr_Type', 'Rndrng_Prvdr_State_Abrvtn', 'HCPCS_Cd'
+    weight_column = None  # e.g. 'Tot_Srvcs', 'Avg_Mdcr_Alowd_Amt'
+
+    if stratum_column:
+        header, sample = stratified_reservoir_sampling(file_name, sample_size, stratum_column)
+    elif weight_column:
+        header, sample = weighted_reservoir_sampling(file_name, sample_size, weight_column)
+    else:
+        header, sample = reservoir_sampling_skip(file_name, sample_size)
+
+    # Write sampled data to a new csv file
+
+    new_file = open('sampled_medicare_data.csv', 'w+', newline='')
+
+    with new_file:
+        write = csv.writer(new_file)
+        write.writerow(header)
+        write.writerows(sample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+
+## Memoization of query results: the charts ask for the same aggregates again and
+## again (e.g. the scatter and bubble versions of the total cost chart), so results
+## are kept by query, parameters and the version of the data they were computed from
+
+class ResultCache:
+    """
+    LRU cache of query result dataframes, with an optional time to live and disk tier
+
+    args:
+        max_entries (int): most results kept in memory
+        max_bytes (int): most bytes of results kept in memory (deep memory_usage)
+        ttl (float): seconds a result stays valid, or None to keep it until evicted.
+            Results never outlive the data they came from either way, since the data
+            version is part of the key
+        disk_dir (str): optional directory for a second tier of pickled results, which
+            keeps them across processes. Looked up on a memory miss
+
+    The hits, disk_hits, misses and evictions counters (see stats) show how well the
+    cache is sized.
+    """
+    def __init__(self, max_entries=256, max_bytes=64 * 2**20, ttl=None, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(query, params, version):
+        """
+        Returns the cache key of a query run: parameters are compared by value, not by
+        the order they were passed in
+        """
+        normalized = json.dumps([query, params, version], sort_keys=True, default=str)
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f'{key}.pkl')
+
+    def get(self, key):
+        """
+        Returns a copy of the cached result for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1].copy()
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                stored_at = os.path.getmtime(path)
+                if not self._expired(stored_at):
+                    result = pd.read_pickle(path)
+                    with self._lock:
+                        self.disk_hits += 1
+                    self._store(key, result, stored_at)
+                    return result.copy()
+            except OSError:
+                pass
+            except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                # A truncated or corrupt file, or one pickled by an incompatible pandas:
+                # a miss, and the file goes so the result is stored again
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """
+        Stores a copy of result under key, in memory and on disk
+        """
+        self._store(key, result.copy(), time.time())
+        if self.disk_dir is not None:
+            # Written to a temporary name first so a reader never sees half a file
+            path = self._disk_path(key)
+            result.to_pickle(f'{path}.{os.getpid()}.tmp')
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def _store(self, key, result, stored_at):
+        size = int(result.memory_usage(deep=True).sum())
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (stored_at, result, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """
+        Empties the memory tier (the disk tier is left for other processes)
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the counters and current size of the memory tier
+        """
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self._bytes}
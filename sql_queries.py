@@ -0,0 +1,235 @@
+import json
+import sqlite3
+import sys
+
+## SQL for every query the analysis scripts run, with bound parameters instead of
+## values formatted into the text
+
+# The charts are answered from medicare_rollup, the procedure x specialty x state cube
+# built by the ETL, which stores additive partial aggregates for each group. Averages
+# are recombined as SUM(sum_allowed_amount) / SUM(allowed_amount_count), which equals
+# AVG(average_medicare_allowed_amount) over the raw rows of the same groups
+
+# Procedures are matched through the hcpcs_search trigram index (built by the ETL),
+# which finds the matching (code, description) pairs without scanning every row for
+# LIKE '%...%'. Rows are joined on the pair, as a code can have several descriptions
+# and only the rows whose own description matches belong in the result. The join is a
+# CROSS JOIN so SQLite keeps the matches as the outer loop and searches the cube's
+# primary key for each one, instead of scanning the cube
+HCPCS_MATCHING = """
+    SELECT hcpcs_code, hcpcs_description FROM hcpcs_search WHERE hcpcs_description LIKE :pattern
+"""
+
+TOP_PROCEDURES_BY_MEDICARE_COST = """
+    SELECT hcpcs_description, SUM(sum_allowed_amount) / SUM(allowed_amount_count) AS average_cost
+    FROM medicare_rollup
+    GROUP BY hcpcs_description
+    ORDER BY average_cost DESC
+    LIMIT :limit
+"""
+
+TOP_PROCEDURES_BY_TOTAL_COST = """
+    SELECT
+    hcpcs_description,
+    SUM(sum_allowed_amount) / SUM(allowed_amount_count) AS average_cost,
+    SUM(sum_services) AS total_services,
+    (SUM(sum_allowed_amount) / SUM(allowed_amount_count) * SUM(sum_services)) AS total_spending
+    FROM medicare_rollup
+    GROUP BY hcpcs_description
+    ORDER BY total_spending DESC
+    LIMIT :limit
+"""
+
+TOP_PROCEDURES_BY_PROVIDER = f"""
+    WITH matching AS MATERIALIZED ({HCPCS_MATCHING})
+    SELECT
+        provider_type,
+        hcpcs_description,
+        SUM(sum_services) AS total_services,
+        SUM(sum_allowed_amount) / SUM(allowed_amount_count) AS average_cost
+    FROM
+        matching CROSS JOIN medicare_rollup USING (hcpcs_code, hcpcs_description)
+    GROUP BY
+        provider_type, hcpcs_description
+    ORDER BY
+        total_services DESC
+    LIMIT :limit;
+"""
+
+COST_BY_SPECIALTY_AND_STATE = """
+    SELECT
+        provider_type,
+        provider_state_abbreviation AS state,
+        SUM(sum_allowed_amount) / SUM(allowed_amount_count) AS average_cost,
+        SUM(sum_services) AS total_services,
+        (SUM(sum_allowed_amount) / SUM(allowed_amount_count) * SUM(sum_services)) AS total_spending
+        FROM
+            medicare_rollup
+        WHERE provider_type = :specialty
+        GROUP BY state
+        ORDER BY
+            total_spending DESC;
+"""
+
+STATE_SERVICES_FOR_PROVIDER_AND_PROCEDURE = f"""
+    WITH matching AS MATERIALIZED ({HCPCS_MATCHING})
+    SELECT
+        provider_state_abbreviation AS state,
+        SUM(sum_services) AS total_services
+    FROM
+        matching CROSS JOIN medicare_rollup USING (hcpcs_code, hcpcs_description)
+    WHERE
+        provider_type = :provider
+    GROUP BY
+        state
+    ORDER BY
+        total_services DESC;
+"""
+
+STATE_SERVICES_FOR_PROCEDURE = f"""
+    WITH matching AS MATERIALIZED ({HCPCS_MATCHING})
+    SELECT
+        provider_state_abbreviation AS state,
+        SUM(sum_services) AS total_services
+    FROM
+        matching CROSS JOIN medicare_rollup USING (hcpcs_code, hcpcs_description)
+    GROUP BY
+        state
+    ORDER BY
+        total_services DESC;
+"""
+
+# Batched versions of the two state breakdowns, computing every requested specialty or
+# procedure in one statement. The lists are bound as one JSON parameter (see bind_params)
+# and read with json_each, so the SQL text stays the same for any number of items
+STATE_SERVICES_FOR_PROVIDERS_AND_PROCEDURE = f"""
+    WITH matching AS MATERIALIZED ({HCPCS_MATCHING})
+    SELECT
+        provider_type,
+        provider_state_abbreviation AS state,
+        SUM(sum_services) AS total_services
+    FROM
+        matching CROSS JOIN medicare_rollup USING (hcpcs_code, hcpcs_description)
+    WHERE
+        provider_type IN (SELECT value FROM json_each(:providers))
+    GROUP BY
+        provider_type, state
+    ORDER BY
+        provider_type, total_services DESC;
+"""
+
+# :procedures is a {name: LIKE pattern} object. The matching procedures of every pattern
+# are found first, so the cube is only searched by hcpcs_code and hcpcs_description
+STATE_SERVICES_FOR_PROCEDURES = """
+    WITH matching AS MATERIALIZED (
+        SELECT DISTINCT procedures.key AS procedure, hcpcs_search.hcpcs_code, hcpcs_search.hcpcs_description
+        FROM json_each(:procedures) AS procedures
+        JOIN hcpcs_search ON hcpcs_search.hcpcs_description LIKE procedures.value
+    )
+    SELECT
+        matching.procedure,
+        medicare_rollup.provider_state_abbreviation AS state,
+        SUM(medicare_rollup.sum_services) AS total_services
+    FROM
+        matching
+        CROSS JOIN medicare_rollup ON medicare_rollup.hcpcs_code = matching.hcpcs_code
+            AND medicare_rollup.hcpcs_description = matching.hcpcs_description
+    GROUP BY
+        matching.procedure, state
+    ORDER BY
+        matching.procedure, total_services DESC;
+"""
+
+ESTABLISHED_VISIT = 'Established patient office or other outpatient visit'
+
+# Specialties the charts break down, spelled as the CMS provider type, and how many
+# states the spending by state chart of each shows
+SPECIALTIES = {'Internal Medicine': 10,
+               'Family Practice': 5,
+               'Nurse Practitioner': 5,
+               'Cardiology': 5,
+               'Physician Assistant': 5,
+               'Dermatology': 5}
+
+
+def like_pattern(text):
+    """
+    Returns the LIKE pattern matching any description that contains text
+    """
+    return f'%{text}%'
+
+
+def bind_params(params):
+    """
+    Returns params ready to bind, with lists and dicts passed as JSON text for json_each
+    """
+    return {name: json.dumps(value) if isinstance(value, (list, tuple, dict)) else value
+            for name, value in params.items()}
+
+
+# Every shipped query with example parameters, for check_query_plans
+SHIPPED_QUERIES = {
+    'top_procedures_by_medicare_cost': (TOP_PROCEDURES_BY_MEDICARE_COST, {'limit': 10}),
+    'top_procedures_by_total_cost': (TOP_PROCEDURES_BY_TOTAL_COST, {'limit': 10}),
+    'top_procedures_by_provider': (TOP_PROCEDURES_BY_PROVIDER,
+                                   {'pattern': like_pattern(ESTABLISHED_VISIT), 'limit': 10}),
+    'analyze_cost_by_speciality_and_state': (COST_BY_SPECIALTY_AND_STATE, {'specialty': 'Internal Medicine'}),
+    'generate_pie_charts_by_provider': (STATE_SERVICES_FOR_PROVIDER_AND_PROCEDURE,
+                                        {'pattern': like_pattern(ESTABLISHED_VISIT), 'provider': 'Cardiology'}),
+    'generate_pie_chart_for_proc_by_state': (STATE_SERVICES_FOR_PROCEDURE,
+                                             {'pattern': like_pattern('Injection, aflibercept')}),
+    'state_services_for_providers': (STATE_SERVICES_FOR_PROVIDERS_AND_PROCEDURE,
+                                     {'pattern': like_pattern(ESTABLISHED_VISIT),
+                                      'providers': ['Cardiology', 'Dermatology']}),
+    'state_services_for_procedures': (STATE_SERVICES_FOR_PROCEDURES,
+                                      {'procedures': {'Cataract Extraction': like_pattern('Removal of cataract'),
+                                                      'AMD Injection 1': like_pattern('Injection, aflibercept')}}),
+}
+
+
+# Queries that rank every procedure, and so read the whole cube by design, with the
+# table they are expected to scan
+WHOLE_TABLE_QUERIES = {
+    'top_procedures_by_medicare_cost': 'medicare_rollup',
+    'top_procedures_by_total_cost': 'medicare_rollup',
+}
+
+
+def check_query_plans(sql_connect, tables=None):
+    """
+    Runs EXPLAIN QUERY PLAN on every shipped query and finds the ones that read a whole table.
+
+    A plan step that scans a stored table is reported, whether it reads the rows or walks
+    a whole index (a covering index still reads every entry). Searches, scans of virtual
+    tables such as the hcpcs_search index, and the scans in WHOLE_TABLE_QUERIES are not.
+
+    args:
+        sql_connect: SQLite connection object
+        tables: tables that must not be scanned, every table in the database by default
+
+    returns:
+        dict of query name -> plan steps that scan a table (empty if none do)
+    """
+    if tables is None:
+        tables = [name for name, in sql_connect.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql NOT LIKE 'CREATE VIRTUAL TABLE%';")]
+    scans = {}
+    for name, (query, params) in SHIPPED_QUERIES.items():
+        plan = sql_connect.execute(f"EXPLAIN QUERY PLAN {query}", bind_params(params)).fetchall()
+        full_scans = [step[-1] for step in plan
+                      if any(step[-1] == f'SCAN {table}' or step[-1].startswith(f'SCAN {table} ')
+                             for table in tables if table != WHOLE_TABLE_QUERIES.get(name))]
+        if full_scans:
+            scans[name] = full_scans
+    return scans
+
+
+if __name__ == '__main__':
+    sql_connect = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'medicare_database.db')
+    scans = check_query_plans(sql_connect)
+    for name, steps in scans.items():
+        print(f"[SQL] {name} scans the whole table: {'; '.join(steps)}")
+    if not scans:
+        print(f"[SQL] None of the {len(SHIPPED_QUERIES)} shipped queries scan the whole table")
+    sql_connect.close()
+    sys.exit(1 if scans else 0)
@@ -0,0 +1,325 @@
+import argparse
+import math
+import time
+import numpy as np
+import pandas as pd
+from handler_funcs import convert_numberobjs_to_numeric
+from instrumentation import timed
+
+## One pass over the raw CMS file, without sampling or loading it: the exact
+## procedure x specialty x state cube the ETL builds (medicare_rollup), a Space-Saving
+## sketch of the procedures with the most services and a t-digest style sketch of the
+## allowed amounts in every state. Memory depends on the number of distinct groups,
+## not on the number of rows
+
+# Raw CMS columns read, and the medicare_rollup names they are reported under
+RAW_COLUMNS = {'HCPCS_Cd': 'hcpcs_code',
+               'HCPCS_Desc': 'hcpcs_description',
+               'Rndrng_Prvdr_Type': 'provider_type',
+               'Rndrng_Prvdr_State_Abrvtn': 'provider_state_abbreviation',
+               'Tot_Srvcs': 'number_of_services',
+               'Avg_Mdcr_Alowd_Amt': 'average_medicare_allowed_amount'}
+
+KEY_COLUMNS = ['hcpcs_code', 'hcpcs_description', 'provider_type', 'provider_state_abbreviation']
+
+# Bits of the packed group key given to the id of each key column
+KEY_BITS = {'hcpcs_code': 20, 'hcpcs_description': 20, 'provider_type': 12, 'provider_state_abbreviation': 11}
+
+
+class SpaceSaving:
+    """
+    Space-Saving sketch of the heaviest items of a weighted stream, in k counters
+
+    Every item whose total weight is more than (stream weight / k) is kept. A kept
+    item's count is an upper bound of its true total, at most its error above it.
+
+    args:
+        k (int): number of counters
+    """
+    def __init__(self, k=100):
+        self.k = k
+        self.counters = {}
+
+    def update(self, items, weights):
+        """
+        Adds the weight of every item (items may repeat; pre-summing them is faster)
+        """
+        for item, weight in zip(items, weights):
+            counter = self.counters.get(item)
+            if counter is not None:
+                counter[0] += weight
+            elif len(self.counters) < self.k:
+                self.counters[item] = [weight, 0.0]
+            else:
+                # The new item takes over the smallest counter, and its count as the error
+                smallest = min(self.counters, key=lambda key: self.counters[key][0])
+                count = self.counters.pop(smallest)[0]
+                self.counters[item] = [count + weight, count]
+
+    def top(self, limit=None):
+        """
+        Returns [(item, count, error)] by count, largest first
+        """
+        ranked = sorted(((item, count, error) for item, (count, error) in self.counters.items()),
+                        key=lambda entry: entry[1], reverse=True)
+        return ranked[:limit]
+
+
+class QuantileSketch:
+    """
+    t-digest style sketch of a weighted distribution, for estimating its quantiles
+
+    Points are kept as centroids (mean, weight). When a batch is added the centroids
+    and points are sorted together and merged so that no centroid spans more than one
+    unit of the scale k(q) = compression / (2 pi) * asin(2q - 1), which keeps the
+    centroids near the extremes small and the tail quantiles accurate. There are at
+    most about compression / 2 centroids however many points are added.
+
+    args:
+        compression (float): bound on the number of centroids, larger is more accurate
+    """
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values, weights):
+        """
+        Adds values with their weights (both arrays)
+        """
+        keep = weights > 0
+        values, weights = values[keep], weights[keep]
+        if not len(values):
+            return
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, weights])
+        order = means.argsort(kind='stable')
+        means, weights = means[order], weights[order]
+
+        # Cluster of each point: the unit of k its middle falls in, so the clusters are
+        # contiguous runs of the sorted points
+        cumulative = weights.cumsum()
+        middle = (cumulative - weights / 2) / cumulative[-1]
+        scale = self.compression / (2 * math.pi) * np.arcsin(2 * middle - 1)
+        clusters = np.floor(scale - scale[0]).astype(np.int64)
+        sums = np.bincount(clusters, weights=weights)
+        filled = sums > 0
+        self.weights = sums[filled]
+        self.means = np.bincount(clusters, weights=weights * means)[filled] / self.weights
+
+    def quantiles(self, quantiles):
+        """
+        Returns the estimated value at each quantile (0 to 1), interpolating between centroids
+        """
+        if not len(self.weights):
+            return np.full(len(quantiles), np.nan)
+        cumulative = self.weights.cumsum()
+        total = cumulative[-1]
+        positions = np.concatenate([[0.0], cumulative - self.weights / 2, [total]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(np.asarray(quantiles) * total, positions, values)
+
+
+class StreamingAggregator:
+    """
+    Aggregates chunks of the raw CMS file as they are read
+
+    args:
+        top_k (int): counters of the Space-Saving sketch of services per procedure code
+        compression (float): compression of the allowed amount sketch of every state
+
+    The group totals are kept in parallel numpy arrays indexed by a packed key of the
+    ids of the four key columns (see KEY_BITS), sorted so a chunk's groups are found
+    with one searchsorted.
+    """
+    def __init__(self, top_k=100, compression=100):
+        self.ids = {column: {} for column in KEY_COLUMNS}
+        self.keys = np.empty(0, dtype=np.int64)
+        self.totals = {name: np.empty(0) for name in ['row_count', 'allowed_amount_count',
+                                                       'sum_allowed_amount', 'sum_services']}
+        self.procedures = SpaceSaving(top_k)
+        self.compression = compression
+        self.amounts = {}
+        self.rows = 0
+
+    def _intern(self, column, values):
+        # Ids of the values of a categorical column, new values getting the next ids
+        ids = self.ids[column]
+        categories = [ids.setdefault(value, len(ids)) for value in values.cat.categories]
+        missing = ids.setdefault(None, len(ids))
+        if len(ids) >= 1 << KEY_BITS[column]:
+            raise ValueError(f"More than {(1 << KEY_BITS[column]) - 1} distinct values of {column}")
+        lookup = np.array(categories + [missing], dtype=np.int64)
+        # Missing values have code -1, the last entry of lookup
+        return lookup[values.cat.codes.to_numpy()]
+
+    def update(self, chunk):
+        """
+        Adds a chunk with the RAW_COLUMNS, the key columns read as categoricals
+        """
+        chunk = chunk.rename(columns=RAW_COLUMNS)
+        chunk, _ = convert_numberobjs_to_numeric(chunk, ['number_of_services', 'average_medicare_allowed_amount'])
+        services = chunk['number_of_services'].to_numpy(dtype=np.float64)
+        allowed = chunk['average_medicare_allowed_amount'].to_numpy(dtype=np.float64)
+        self.rows += len(chunk)
+
+        ids = {column: self._intern(column, chunk[column].astype('category')) for column in KEY_COLUMNS}
+        packed = np.zeros(len(chunk), dtype=np.int64)
+        for column in KEY_COLUMNS:
+            packed = (packed << KEY_BITS[column]) | ids[column]
+        self._add_totals(packed, services, allowed)
+
+        code_services = np.bincount(ids['hcpcs_code'], weights=services)
+        codes = code_services.nonzero()[0]
+        order = code_services[codes].argsort()[::-1]
+        self.procedures.update(codes[order], code_services[codes][order])
+
+        states = ids['provider_state_abbreviation']
+        order = states.argsort(kind='stable')
+        bounds = (np.diff(states[order]) != 0).nonzero()[0] + 1
+        for rows in np.split(order, bounds):
+            state = states[rows[0]]
+            if state not in self.amounts:
+                self.amounts[state] = QuantileSketch(self.compression)
+            self.amounts[state].update(allowed[rows], services[rows])
+
+    def _add_totals(self, packed, services, allowed):
+        groups, inverse = np.unique(packed, return_inverse=True)
+        sums = {'row_count': np.bincount(inverse, minlength=len(groups)).astype(np.float64),
+                'allowed_amount_count': np.bincount(inverse, weights=~np.isnan(allowed), minlength=len(groups)),
+                'sum_allowed_amount': np.bincount(inverse, weights=np.nan_to_num(allowed), minlength=len(groups)),
+                'sum_services': np.bincount(inverse, weights=services, minlength=len(groups))}
+
+        positions = np.searchsorted(self.keys, groups)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == groups[found]
+        for name, values in sums.items():
+            self.totals[name][positions[found]] += values[found]
+
+        if not found.all():
+            self.keys = np.concatenate([self.keys, groups[~found]])
+            order = self.keys.argsort(kind='stable')
+            self.keys = self.keys[order]
+            for name, values in sums.items():
+                self.totals[name] = np.concatenate([self.totals[name], values[~found]])[order]
+
+    def _values(self, column):
+        values = np.empty(len(self.ids[column]), dtype=object)
+        for value, id in self.ids[column].items():
+            values[id] = value
+        return values
+
+    def rollup(self):
+        """
+        Returns the group totals with the columns of the medicare_rollup table
+        """
+        df = {}
+        shift = sum(KEY_BITS.values())
+        for column in KEY_COLUMNS:
+            shift -= KEY_BITS[column]
+            df[column] = self._values(column)[(self.keys >> shift) & ((1 << KEY_BITS[column]) - 1)]
+        df = pd.DataFrame(df)
+        for name, values in self.totals.items():
+            df[name] = values.astype(np.int64) if name.endswith('count') else values
+        return df
+
+    def top_procedures_by_total_cost(self, limit=10):
+        """
+        Returns the same columns as the top_procedures_by_total_cost query, computed exactly
+        """
+        grouped = self.rollup().groupby('hcpcs_description')
+        df = pd.DataFrame({'average_cost': grouped['sum_allowed_amount'].sum() / grouped['allowed_amount_count'].sum(),
+                           'total_services': grouped['sum_services'].sum()})
+        df['total_spending'] = df['average_cost'] * df['total_services']
+        return df.sort_values('total_spending', ascending=False).head(limit).reset_index()
+
+    def state_services_for_procedure(self, text, provider=None):
+        """
+        Returns the services of every state for the procedures whose description contains
+        text (as the generate_pie_chart_for_proc_by_state query), only of provider if given
+        """
+        df = self.rollup()
+        matches = df['hcpcs_description'].astype(str).str.contains(text, case=False, regex=False)
+        if provider is not None:
+            matches &= df['provider_type'] == provider
+        df = df[matches].groupby('provider_state_abbreviation')['sum_services'].sum()
+        df = df.rename('total_services').rename_axis('state').reset_index()
+        return df.sort_values('total_services', ascending=False).reset_index(drop=True)
+
+    def top_procedures_by_services(self, limit=10):
+        """
+        Returns the procedure codes with the most services from the Space-Saving sketch,
+        with the largest possible overcount of each (error)
+        """
+        codes = self._values('hcpcs_code')
+        top = self.procedures.top(limit)
+        return pd.DataFrame({'hcpcs_code': [codes[item] for item, _, _ in top],
+                             'total_services': [count for _, count, _ in top],
+                             'error': [error for _, _, error in top]})
+
+    def allowed_amount_quantiles(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Returns the estimated quantiles of the allowed amount of a service in every state
+        """
+        states = self._values('provider_state_abbreviation')
+        rows = [[states[state], *sketch.quantiles(quantiles)] for state, sketch in self.amounts.items()]
+        columns = ['state'] + [f'p{quantile * 100:g}' for quantile in quantiles]
+        return pd.DataFrame(rows, columns=columns).sort_values('state', na_position='last').reset_index(drop=True)
+
+
+def _read_mmap(file_name, chunksize):
+    # The same chunks through a memory map, the numbers parsed straight into float arrays
+    from mmap_scan import ROW_BYTES, CSVScanner
+
+    numeric = [column for column, name in RAW_COLUMNS.items() if name not in KEY_COLUMNS]
+    with CSVScanner(file_name, block_size=chunksize * ROW_BYTES) as scanner:
+        yield from scanner.frames(numeric=numeric, columns=list(RAW_COLUMNS))
+
+
+@timed('stream.aggregate_file')
+def aggregate_file(file_name, chunksize=200000, top_k=100, compression=100, reader='pandas'):
+    """
+    Reads the raw CMS csv file once and returns a StreamingAggregator of all its rows
+
+    Only the RAW_COLUMNS are parsed, the key columns straight into categoricals. With
+    reader='mmap' the file is scanned by mmap_scan.CSVScanner instead of pd.read_csv.
+    """
+    aggregator = StreamingAggregator(top_k, compression)
+    if reader == 'mmap':
+        chunks = _read_mmap(file_name, chunksize)
+    elif reader == 'pandas':
+        dtypes = {column: 'category' for column, name in RAW_COLUMNS.items() if name in KEY_COLUMNS}
+        chunks = pd.read_csv(file_name, usecols=list(RAW_COLUMNS), dtype=dtypes, chunksize=chunksize)
+    else:
+        raise ValueError(f"Unknown reader {reader!r}, expected 'pandas' or 'mmap'")
+    for chunk in chunks:
+        aggregator.update(chunk)
+    return aggregator
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the raw CMS file in one pass, without sampling it')
+    parser.add_argument('file', nargs='?', default='medicare_data.csv')
+    parser.add_argument('--chunksize', type=int, default=200000)
+    parser.add_argument('--top-k', type=int, default=100, help='counters of the heavy hitter sketch')
+    parser.add_argument('--compression', type=float, default=100, help='compression of the quantile sketches')
+    parser.add_argument('--reader', choices=['pandas', 'mmap'], default='pandas', help='how the file is read')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    aggregator = aggregate_file(args.file, args.chunksize, args.top_k, args.compression, args.reader)
+    seconds = time.perf_counter() - start
+    print(f"[Stream] {aggregator.rows:,} rows in {seconds:.2f}s ({aggregator.rows / seconds:,.0f} rows/sec), "
+          f"{len(aggregator.keys):,} groups")
+    print(aggregator.top_procedures_by_total_cost(10).to_string(index=False))
+    print(aggregator.top_procedures_by_services(10).to_string(index=False))
+    print(aggregator.allowed_amount_quantiles().to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import csv
+import os
+import random
+import sys
+
+import pytest
+
+# The scripts live at the top of the repository and some have dashes in their names,
+# so the tests import them with importlib from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEADER = ['Rndrng_NPI', 'Rndrng_Prvdr_Last_Org_Name', 'Rndrng_Prvdr_City', 'HCPCS_Desc', 'Tot_Srvcs']
+
+
+@pytest.fixture(scope='session')
+def varied_csv(tmp_path_factory):
+    """
+    A csv of 100k rows whose lengths vary from a few dozen to a few hundred bytes,
+    with quoted commas in some fields. Returns the path and the set of rows.
+    """
+    rng = random.Random(7)
+    path = tmp_path_factory.mktemp('data') / 'varied.csv'
+    rows = set()
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(HEADER)
+        for i in range(100_000):
+            row = (str(1000000000 + i), 'x' * rng.randint(1, 200), rng.choice(['AUSTIN', 'NEW YORK, NY']),
+                   'd' * rng.randint(0, 100), str(rng.randint(1, 500)))
+            writer.writerow(row)
+            rows.add(row)
+    return str(path), rows
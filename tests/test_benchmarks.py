@@ -0,0 +1,10 @@
+import benchmarks
+from sql_queries import SHIPPED_QUERIES
+
+
+def test_bench_cache_runs_every_shipped_query(tmp_path, capsys):
+    # The varied_csv fixture is not in the CMS layout run_etl loads, so this uses bench_cache's own synthetic file
+    benchmarks.bench_cache(2000, repeats=1, directory=str(tmp_path))
+
+    timed = [line.split()[0] for line in capsys.readouterr().out.splitlines() if 'parquet cold' in line]
+    assert timed == list(SHIPPED_QUERIES)
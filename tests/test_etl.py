@@ -0,0 +1,114 @@
+import csv
+import importlib
+import random
+import sqlite3
+
+import pytest
+
+import columnar_cache
+
+etl = importlib.import_module('data-etl')
+
+STATES = ['TX', 'NY', 'CA']
+SPECIALTIES = ['Cardiology', 'Dermatology']
+
+
+def write_csv(path, codes, rows, seed, mode='w'):
+    # Raw CMS layout with every column run_etl reads, and only the given hcpcs codes
+    rng = random.Random(seed)
+    with open(path, mode, newline='') as file:
+        writer = csv.writer(file)
+        if mode == 'w':
+            writer.writerow(etl.COLUMN_NAMES)
+        for _ in range(rows):
+            code = rng.choice(codes)
+            npi = 1000000000 + rng.randrange(40)
+            values = {'Rndrng_NPI': npi, 'Rndrng_Prvdr_Last_Org_Name': f'Provider {npi}',
+                      'Rndrng_Prvdr_State_Abrvtn': STATES[npi % 3], 'Rndrng_Prvdr_Type': SPECIALTIES[npi % 2],
+                      'Rndrng_Prvdr_City': 'Austin', 'Rndrng_Prvdr_Zip5': '07001', 'Rndrng_Prvdr_RUCA': 1.1,
+                      'HCPCS_Cd': code, 'HCPCS_Desc': f'Procedure {code}', 'HCPCS_Drug_Ind': 'N',
+                      'Place_Of_Srvc': rng.choice('FO'), 'Tot_Benes': rng.randint(11, 90),
+                      'Tot_Srvcs': rng.randint(11, 400), 'Tot_Bene_Day_Srvcs': rng.randint(11, 90),
+                      'Avg_Sbmtd_Chrg': f'${rng.randint(100, 99999) / 100:,.2f}',
+                      'Avg_Mdcr_Alowd_Amt': rng.randint(100, 9999) / 100, 'Avg_Mdcr_Pymt_Amt': 12.34,
+                      'Avg_Mdcr_Stdzd_Amt': 12.34}
+            writer.writerow([values.get(column, '') for column in etl.COLUMN_NAMES])
+
+
+def snapshot(database_file):
+    sql_connect = sqlite3.connect(database_file)
+    tables = {table: sql_connect.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3, 4;").fetchall()
+              for table in ['providers', 'hcpcs', 'services', 'medicare_rollup']}
+    joined = sql_connect.execute("SELECT COUNT(*) FROM medicare_database;").fetchone()[0]
+    sql_connect.close()
+    return tables, joined
+
+
+def cached_rows(database_file):
+    return len(columnar_cache.read_cache(columnar_cache.cache_path(database_file), ['number_of_services']))
+
+
+@pytest.fixture
+def files(tmp_path):
+    return str(tmp_path / 'medicare.csv'), str(tmp_path / 'medicare.db')
+
+
+def test_incremental_run_twice_changes_nothing(files):
+    csv_file, database_file = files
+    write_csv(csv_file, ['99213', 'G0008', '99214'], 500, seed=1)
+    etl.run_etl(csv_file, database_file, chunksize=120, incremental=True)
+    before = snapshot(database_file)
+
+    etl.run_etl(csv_file, database_file, chunksize=120, incremental=True)
+
+    assert snapshot(database_file) == before
+    assert before[1] == len(before[0]['services']) == 500
+    assert cached_rows(database_file) == 500
+
+
+@pytest.mark.parametrize('reader', ['pandas', 'mmap'])
+def test_numeric_only_delta_joins_existing_procedures(files, reader):
+    csv_file, database_file = files
+    write_csv(csv_file, ['99213', 'G0008'], 300, seed=2)
+    etl.run_etl(csv_file, database_file, incremental=True, reader=reader)
+
+    # Every code in the appended rows is numeric, one of them new
+    write_csv(csv_file, ['99213', '99215'], 200, seed=3, mode='a')
+    etl.run_etl(csv_file, database_file, incremental=True, reader=reader)
+
+    tables, joined = snapshot(database_file)
+    assert joined == len(tables['services']) == 500
+    assert sorted(code for _, code, _, _ in tables['hcpcs']) == ['99213', '99215', 'G0008']
+    assert sum(row[-1] for row in tables['medicare_rollup']) == sum(row[5] for row in tables['services'])
+
+
+def test_changed_file_replaces_its_rows(files):
+    csv_file, database_file = files
+    write_csv(csv_file, ['99213', 'G0008'], 400, seed=4)
+    etl.run_etl(csv_file, database_file, incremental=True)
+
+    write_csv(csv_file, ['99213', 'G0008'], 250, seed=5)
+    etl.run_etl(csv_file, database_file, incremental=True)
+
+    tables, joined = snapshot(database_file)
+    expected = {}
+    with open(csv_file, newline='') as file:
+        for row in csv.DictReader(file):
+            expected[row['HCPCS_Cd']] = expected.get(row['HCPCS_Cd'], 0) + int(row['Tot_Srvcs'])
+    totals = {}
+    for code, _, _, _, _, _, _, sum_services in tables['medicare_rollup']:
+        totals[code] = totals.get(code, 0) + sum_services
+    assert joined == len(tables['services']) == 250
+    assert totals == expected
+    assert cached_rows(database_file) == 250
+
+
+def test_amounts_are_stored_exactly(files):
+    csv_file, database_file = files
+    write_csv(csv_file, ['99213'], 50, seed=6)
+    etl.run_etl(csv_file, database_file)
+
+    sql_connect = sqlite3.connect(database_file)
+    amounts = {amount for amount, in sql_connect.execute("SELECT average_medicare_payment_amount FROM services;")}
+    sql_connect.close()
+    assert amounts == {12.34}
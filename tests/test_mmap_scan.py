@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import mmap_scan
+from mmap_scan import CSVScanner
+
+
+def numbers(*fields):
+    buf = np.frombuffer(''.join(fields).encode(), dtype=np.uint8)
+    ends = np.cumsum([len(field) for field in fields])
+    return mmap_scan.parse_numbers(buf, ends - [len(field) for field in fields], ends)
+
+
+@pytest.mark.parametrize('text', ['0.1', '12.34', '-0.07', '999999999999999', '1234567890.12345',
+                                  '12345678901234567', '9007199254740993', '0.30000000000000004', '-.5',
+                                  '43591.010316006538', '92.87403708276331', '5.66304711993058567'])
+def test_parse_numbers_rounds_like_float(text):
+    assert numbers(text)[0] == float(text)
+
+
+def test_parse_numbers_currency_and_invalid():
+    values = numbers('"$1,234.50"', '', 'abc', '1-2', '1.2.3', '2e3', ' 7 ')
+    assert values[0] == 1234.5
+    assert np.isnan(values[1:5]).all()
+    assert values[5] == 2000.0
+    assert values[6] == 7.0
+
+
+def test_scanner_quoting(tmp_path):
+    path = tmp_path / 'quoted.csv'
+    path.write_bytes(b'id,text,amount\n'
+                     b'1,plain,2.5\n'
+                     b'2,"comma, inside","$1,000.25"\n'
+                     b'3,"a ""quoted"" word",-3\r\n'
+                     b'4,"line\nbreak",\n'
+                     b'5,,7\n')
+
+    # A small block size splits the file between rows, one of them inside quotes
+    with CSVScanner(str(path), block_size=32) as scanner:
+        frame = pd.concat(scanner.frames(numeric=['id', 'amount'], categorical=[]), ignore_index=True)
+
+    assert frame['id'].tolist() == [1, 2, 3, 4, 5]
+    assert frame['text'].tolist()[:4] == ['plain', 'comma, inside', 'a "quoted" word', 'line\nbreak']
+    assert pd.isna(frame['text'][4])
+    assert frame['amount'].tolist()[:3] == [2.5, 1000.25, -3.0]
+    assert np.isnan(frame['amount'][3]) and frame['amount'][4] == 7.0
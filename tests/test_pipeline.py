@@ -0,0 +1,139 @@
+import importlib
+import sqlite3
+
+import pytest
+
+import pipeline
+import sql_queries
+from pipeline import Pipeline, Stage
+from test_etl import write_csv
+
+etl = importlib.import_module('data-etl')
+
+
+def make_stages(tmp_path, runs, params=None, fail=()):
+    # source.txt -> a -> b, and c on its own; every stage writes its name to a file
+    def step(name):
+        def run():
+            if name in fail:
+                raise RuntimeError(f'{name} failed')
+            runs.append(name)
+            (tmp_path / f'{name}.txt').write_text(name)
+        return run
+
+    out = {name: str(tmp_path / f'{name}.txt') for name in 'abc'}
+    return [Stage('a', step('a'), inputs=[str(tmp_path / 'source.txt')], outputs=[out['a']], params=params or {}),
+            Stage('b', step('b'), deps=['a'], outputs=[out['b']]),
+            Stage('c', step('c'), outputs=[out['c']])]
+
+
+@pytest.fixture
+def state(tmp_path):
+    (tmp_path / 'source.txt').write_text('one')
+    return str(tmp_path / 'state.json')
+
+
+def statuses(results):
+    return {name: result['status'] for name, result in results.items()}
+
+
+def test_second_run_is_all_cache_hits(tmp_path, state):
+    runs = []
+    assert set(statuses(Pipeline(make_stages(tmp_path, runs), state).run()).values()) == {'ran'}
+
+    results = Pipeline(make_stages(tmp_path, runs), state).run()
+
+    assert statuses(results) == {'a': 'cached', 'b': 'cached', 'c': 'cached'}
+    assert sorted(runs) == ['a', 'b', 'c']
+
+
+def test_changed_input_or_params_rerun_the_stage_and_what_follows(tmp_path, state):
+    runs = []
+    Pipeline(make_stages(tmp_path, runs), state).run()
+
+    (tmp_path / 'source.txt').write_text('two')
+    assert statuses(Pipeline(make_stages(tmp_path, runs), state).run()) == {'a': 'ran', 'b': 'ran', 'c': 'cached'}
+
+    results = Pipeline(make_stages(tmp_path, runs, params={'size': 2}), state).run()
+    assert statuses(results) == {'a': 'ran', 'b': 'ran', 'c': 'cached'}
+
+
+def test_changed_output_reruns_only_that_stage(tmp_path, state):
+    runs = []
+    Pipeline(make_stages(tmp_path, runs), state).run()
+
+    (tmp_path / 'b.txt').unlink()
+
+    assert statuses(Pipeline(make_stages(tmp_path, runs), state).run()) == {'a': 'cached', 'b': 'ran', 'c': 'cached'}
+
+
+def test_force_runs_the_stage_and_its_dependents_only(tmp_path, state):
+    runs = []
+    Pipeline(make_stages(tmp_path, runs), state).run()
+    runs.clear()
+
+    results = Pipeline(make_stages(tmp_path, runs), state).run(force=['a'])
+
+    assert statuses(results) == {'a': 'ran', 'b': 'ran', 'c': 'cached'}
+    runs.clear()
+    assert statuses(Pipeline(make_stages(tmp_path, runs), state).run(['b'], force=['b'])) == {'a': 'cached', 'b': 'ran'}
+    assert runs == ['b']
+
+
+def test_dry_run_and_failures(tmp_path, state):
+    runs = []
+    assert set(statuses(Pipeline(make_stages(tmp_path, runs), state).run(dry_run=True)).values()) == {'stale'}
+    assert runs == []
+
+    results = Pipeline(make_stages(tmp_path, runs, fail=['a']), state).run()
+    assert statuses(results) == {'a': 'failed', 'b': 'blocked', 'c': 'ran'}
+
+    # The failed stage and the one it blocked run again next time
+    assert statuses(Pipeline(make_stages(tmp_path, runs), state).run()) == {'a': 'ran', 'b': 'ran', 'c': 'cached'}
+
+
+def test_cycle_is_an_error(tmp_path):
+    stages = [Stage('a', lambda: None, deps=['b']), Stage('b', lambda: None, deps=['a'])]
+    with pytest.raises(ValueError, match='cycle'):
+        Pipeline(stages, str(tmp_path / 'state.json'))
+
+
+def test_rollup_stage_reruns_without_doubling(tmp_path):
+    csv_file, database_file = str(tmp_path / 'sample.csv'), str(tmp_path / 'medicare.db')
+    write_csv(csv_file, ['99213', 'G0008'], 200, seed=1)
+    etl.run_etl(csv_file, database_file, cache=False)
+
+    def rollup():
+        sql_connect = sqlite3.connect(database_file)
+        rows = sql_connect.execute("SELECT * FROM medicare_rollup ORDER BY 1, 2, 3, 4;").fetchall()
+        sql_connect.close()
+        return rows
+
+    built = rollup()
+    pipeline._database_step(database_file, 'build_rollup')
+    pipeline._database_step(database_file, 'build_rollup')
+
+    # The rows may be summed in another order, so the amounts can differ in the last bit
+    rebuilt = rollup()
+    assert [row[:6] for row in rebuilt] == [row[:6] for row in built]
+    assert [row[6:] for row in rebuilt] == [pytest.approx(row[6:]) for row in built]
+
+
+def test_editing_a_query_changes_its_fingerprint(tmp_path, monkeypatch):
+    def fingerprints():
+        stages = pipeline.medicare_stages(raw_file=str(tmp_path / 'raw.csv'), cache=False)
+        runner = Pipeline(stages, str(tmp_path / 'state.json'))
+        result = {}
+        for name in runner.order:
+            if name not in ('sample', 'load', 'rollup', 'index'):
+                result[name] = runner.fingerprint(runner.stages[name], {'index': ''})
+        return result
+
+    (tmp_path / 'raw.csv').write_text('')
+    before = fingerprints()
+    sql, params = sql_queries.SHIPPED_QUERIES['top_procedures_by_total_cost']
+    monkeypatch.setitem(sql_queries.SHIPPED_QUERIES, 'top_procedures_by_total_cost', (sql + '-- edited\n', params))
+    after = fingerprints()
+
+    changed = {name for name in before if before[name] != after[name]}
+    assert changed == {'analyze:top_procedures_by_total_cost', 'render'}
@@ -0,0 +1,42 @@
+import matplotlib
+import pandas as pd
+import pytest
+from matplotlib.figure import Figure
+
+import charts
+import render_charts
+from charts import draw_state_pie
+
+
+def test_render_in_process_keeps_the_callers_backend(tmp_path):
+    df = pd.DataFrame({'state': ['CA', 'NY'], 'total_services': [3.0, 1.0]})
+    backend = matplotlib.get_backend()
+    matplotlib.use('svg')
+    try:
+        paths = render_charts.render_charts([('pie', draw_state_pie, df, {'title': 'Pie'})], str(tmp_path),
+                                            processes=1)
+        assert matplotlib.get_backend() == 'svg'
+    finally:
+        matplotlib.use(backend)
+    assert paths == [str(tmp_path / 'pie.png')]
+    assert (tmp_path / 'pie.png').stat().st_size > 0
+
+
+@pytest.mark.parametrize('draw, kwargs', [(charts.draw_top_procedures_by_medicare_cost, {'limit': 10}),
+                                          (charts.draw_top_procedures_by_total_cost, {}),
+                                          (charts.draw_top_procedures_by_total_cost_bubble, {}),
+                                          (charts.draw_top_procedures_by_provider, {}),
+                                          (charts.draw_cost_by_speciality_and_state, {}),
+                                          (charts.draw_state_pie, {'title': 'Pie'})])
+def test_empty_result_is_drawn_as_a_note(draw, kwargs):
+    df = pd.DataFrame(columns=['hcpcs_description', 'provider_type', 'state', 'average_cost',
+                               'total_services', 'total_spending'], dtype=float)
+    fig = draw(Figure(), df, **kwargs)
+    assert [text.get_text() for text in fig.axes[0].texts] == ['No data']
+
+
+def test_empty_result_does_not_stop_the_batch(tmp_path):
+    full = pd.DataFrame({'state': ['CA', 'NY'], 'total_services': [3.0, 1.0]})
+    jobs = [('empty', draw_state_pie, full[:0], {'title': 'Empty'}), ('full', draw_state_pie, full, {'title': 'Full'})]
+    paths = render_charts.render_charts(jobs, str(tmp_path), processes=1)
+    assert paths == [str(tmp_path / 'empty.png'), str(tmp_path / 'full.png')]
@@ -0,0 +1,39 @@
+import importlib
+
+import pytest
+
+from conftest import HEADER
+
+reservoir = importlib.import_module('reservoir-sampling')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_skip_sampler_returns_whole_rows(varied_csv, seed):
+    path, rows = varied_csv
+    header, sample = reservoir.reservoir_sampling_skip(path, 100, seed=seed)
+
+    assert header == HEADER
+    assert len(sample) == 100
+    for row in sample:
+        assert len(row) == len(header)
+        assert tuple(row) in rows
+
+
+def test_skip_sampler_keeps_every_row_of_a_short_file(varied_csv):
+    path, rows = varied_csv
+    header, sample = reservoir.reservoir_sampling_skip(path, len(rows) + 10, seed=1)
+
+    assert {tuple(row) for row in sample} == rows
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_parallel_sampler_returns_whole_rows(varied_csv, processes):
+    path, rows = varied_csv
+    header, sample = reservoir.reservoir_sampling_parallel(path, 100, processes=processes, seed=3)
+
+    assert header == HEADER
+    assert len(sample) == 100
+    for row in sample:
+        assert len(row) == len(header)
+        assert tuple(row) in rows
+    assert len({tuple(row) for row in sample}) == 100